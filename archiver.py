@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: archiver.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Compression of the finished log files, the job of zipdata.pyc as
+#     source: every .csv in DataLogs/ that was not modified for minAge
+#     seconds is cleaned from NUL bytes and a truncated last line (power
+#     loss while writing) and zipped into <name>.zip next to it. Files
+#     that already have an archive, of any codec, are skipped. New
+#     archives are added to the spatial index.
+#     Framed logs (.cpfl, see framedlog.py) need no repair pass: the
+#     damaged end is found by a scan of the block headers, the valid
+#     blocks go into the zip as .csv.
+#     The codec is pluggable (compression.py), -c auto uses the one chosen
+#     by the benchmark of compression.py.
+#     One file per archiveOne() call, so a scheduler can run it in small
+#     steps (see carpcd.py).
+#
+# Usage
+#     python archiver.py [-a MINAGE] [-c CODEC[:LEVEL]] [-s] [datadir]
+#
+# ----------------------------------------------------------------------
+
+import os
+import time
+import uselogging
+import framedlog
+import compression
+
+DATA_DIR = os.path.join(os.curdir, 'DataLogs')
+MIN_AGE = 300 # seconds without modification before a file is archived
+
+
+def CrawlData(dataDir=DATA_DIR):
+    """
+    All log files below dataDir
+    @param dataDir: directory of the logs
+    @return: sorted list of paths of the .csv and framed log files
+    """
+    found = []
+    for root, dirs, files in os.walk(dataDir):
+        for name in files:
+            if name.endswith('.csv') or name.endswith(framedlog.FRAMED_SUFFIX):
+                found.append(os.path.join(root, name))
+    return sorted(found)
+
+
+def JustOldOnes(fileNames, minAge=MIN_AGE, now=None):
+    """
+    Files not modified for minAge seconds, the loggers are done with them
+    @param fileNames: list of paths
+    @param minAge: seconds
+    @return: list of paths
+    """
+    if now is None:
+        now = time.time()
+    return [f for f in fileNames if now - os.path.getmtime(f) >= minAge]
+
+
+def DelNul(fileName):
+    """
+    Remove NUL bytes and a truncated last line, both left by a power loss while writing
+    @param fileName: path of the log file, repaired in place
+    @return: True if the file was changed
+    """
+    with open(fileName, 'rb') as f:
+        data = f.read()
+    repaired = data.replace(b'\0', b'')
+    if repaired and not repaired.endswith(b'\n'):
+        repaired = repaired[:repaired.rfind(b'\n') + 1]
+    if repaired == data:
+        return False
+    tmpFileName = fileName + '.tmp'
+    with open(tmpFileName, 'wb') as f:
+        f.write(repaired)
+    os.replace(tmpFileName, fileName)
+    return True
+
+
+class Archiver:
+    """
+    Zips finished log files one at a time
+    """
+    def __init__(self, dataDir=DATA_DIR, minAge=MIN_AGE, codec=None, spatialIndex=None):
+        """
+        Class Constructor
+        @param dataDir: directory of the logs
+        @param minAge: seconds without modification before a file is archived
+        @param codec: compression.Codec, the default codec if None
+        @param spatialIndex: SpatialIndex the new archives are added to, None for no indexing
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.dataDir = dataDir
+        self.minAge = minAge
+        self.codec = codec or compression.GetCodec()
+        self.spatialIndex = spatialIndex
+        self.archived = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def pending(self):
+        """
+        Log files ready to be archived, a file archived with another codec before is not archived again
+        @return: list of paths
+        """
+        return [f for f in JustOldOnes(CrawlData(self.dataDir), self.minAge)
+                if compression.FindArchive(f) is None]
+
+    def archiveOne(self, fileName):
+        """
+        Repair and zip one log file
+        @param fileName: path of the .csv or framed log file
+        @return: path of the archive
+        """
+        archiveName = compression.ArchiveName(fileName, self.codec)
+        csvName = os.path.splitext(os.path.basename(fileName))[0] + '.csv'
+        if fileName.endswith(framedlog.FRAMED_SUFFIX):
+            framedlog.Recover(fileName)
+            chunks = framedlog.ReadBlocks(fileName)
+        else:
+            if DelNul(fileName):
+                self.logger.info('Repaired {0}'.format(fileName))
+            chunks = compression.FileChunks(fileName)
+        compression.WriteArchive(self.codec, archiveName, csvName, chunks)
+        self.archived += 1
+        self.bytesIn += os.path.getsize(fileName)
+        self.bytesOut += os.path.getsize(archiveName)
+        self.logger.info('Archived {0} ({1})'.format(archiveName, self.codec))
+        if self.spatialIndex is not None:
+            self.spatialIndex.indexArchive(archiveName)
+        return archiveName
+
+    def run(self):
+        """
+        Archive all pending files
+        @return: number of archived files
+        """
+        count = 0
+        for fileName in self.pending():
+            self.archiveOne(fileName)
+            count += 1
+        return count
+
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+
+    parser = OptionParser('usage: %prog [options] [datadir]')
+    parser.add_option('-a', action='store', type='int', dest='minage', metavar='SECONDS',
+                      help='minimum age of the files, default = {0}'.format(MIN_AGE), default=MIN_AGE)
+    parser.add_option('-c', action='store', type='string', dest='codec', metavar='CODEC[:LEVEL]',
+                      help='compression codec, auto = choice of the benchmark, default = auto', default='auto')
+    parser.add_option('-s', action='store_true', dest='spatial',
+                      help='add the new archives to the spatial index', default=False)
+    (options, args) = parser.parse_args()
+
+    dataDir = args[0] if args else DATA_DIR
+    spatialIndex = None
+    if options.spatial:
+        import spatialindex
+        spatialIndex = spatialindex.SpatialIndex(os.path.join(dataDir, 'spatialindex.db'), tripIndexDir=dataDir)
+    if options.codec == 'auto':
+        codec = compression.LoadCodecChoice(dataDir)
+    else:
+        codec = compression.GetCodec(options.codec)
+    archiver = Archiver(dataDir, options.minage, codec=codec, spatialIndex=spatialIndex)
+    count = archiver.run()
+    if spatialIndex is not None:
+        spatialIndex.close()
+    print('{0} files archived, {1} -> {2} bytes'.format(count, archiver.bytesIn, archiver.bytesOut))
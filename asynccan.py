@@ -0,0 +1,197 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: asynccan.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     asyncio interface for the tinyCAN driver. The Rx event callback of
+#     the driver runs on the driver's own thread, it only schedules a read
+#     in the event loop by loop.call_soon_threadsafe (once until the read
+#     has run). The read drains the FIFO in one batch.
+#     Backpressure: if the consumer does not keep up and maxQueue batches
+#     are waiting, the Rx events are disabled and the frames stay in the
+#     driver FIFO until the queue is half empty again.
+#     Sending waits while more than maxTxPending messages are in the
+#     transmit FIFO.
+#
+# Usage
+#     >>> bus = asynccan.AsyncCanBus(canDriver)
+#     >>> await bus.open()
+#     >>> async for batch in bus.frames():
+#     ...     for msg in batch: ...
+#     >>> await bus.send(0x610, [1, 2, 3])
+#
+# ----------------------------------------------------------------------
+
+import asyncio
+from ctypes import memmove, sizeof
+import uselogging
+import mhsTinyCanDriver
+from mhsTinyCanDriver import TCanMsg, EVENT_ENABLE_RX_MESSAGES, EVENT_DISABLE_RX_MESSAGES
+
+
+class AsyncCanBus:
+    """
+    Batched frames of one MhsTinyCanDriver as async iterator, sending as coroutine
+    """
+    def __init__(self, canDriver, maxQueue=64, maxBatch=1000, maxTxPending=32, txPollTime=0.001):
+        """
+        Class Constructor
+        @param canDriver: opened MhsTinyCanDriver
+        @param maxQueue: number of batches waiting for the consumer before the Rx events are paused
+        @param maxBatch: maximum number of frames read at once
+        @param maxTxPending: maximum number of messages in the transmit FIFO before send() waits
+        @param txPollTime: seconds between the checks of the transmit FIFO while send() waits
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.canDriver = canDriver
+        self.index = canDriver.Index
+        self.maxQueue = maxQueue
+        self.maxBatch = maxBatch
+        self.maxTxPending = maxTxPending
+        self.txPollTime = txPollTime
+        self.loop = None
+        self.queue = None
+        self.readScheduled = False
+        self.paused = False
+        self.closed = False
+        self.pauseCount = 0
+
+    async def open(self):
+        """
+        Attach to the running event loop and enable the Rx events
+        @return: Nothing
+        """
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        err = self.canDriver._CanSetRxEventCallback(self.rxEvent)
+        if err < 0:
+            raise RuntimeError('Could not set Rx Event Callback, Error-Code: {0}'.format(err))
+        self.canDriver.CanSetEvents(EVENT_ENABLE_RX_MESSAGES)
+        self.scheduleRead() # frames received before the callback was set
+
+    def close(self):
+        self.closed = True
+        self.canDriver.CanSetEvents(EVENT_DISABLE_RX_MESSAGES)
+        if self.queue is not None:
+            self.queue.put_nowait(None)
+
+    def rxEvent(self, index, RxMessagePointer, count):
+        """
+        Rx Event Callback, runs on the driver thread
+        @param index: Struct commonly used by the Tiny Can API
+        @param RxMessagePointer: Pointer to the messages if CanRxDMode is set, NULL Pointer otherwise
+        @param count: Number of Messages
+        @return: Nothing
+        """
+        if RxMessagePointer and count:
+            batch = (TCanMsg * count)()
+            memmove(batch, RxMessagePointer, sizeof(TCanMsg) * count)
+            self.loop.call_soon_threadsafe(self.deliver, batch)
+        elif not self.readScheduled:
+            self.readScheduled = True
+            self.loop.call_soon_threadsafe(self.readPending)
+
+    def scheduleRead(self):
+        if not self.readScheduled:
+            self.readScheduled = True
+            self.loop.call_soon(self.readPending)
+
+    def readPending(self):
+        """
+        Drain the driver FIFO into the queue, runs in the event loop
+        @return: Nothing
+        """
+        self.readScheduled = False
+        if self.paused or self.closed:
+            return
+        count = self.canDriver._CanReceiveGetCount(self.index)
+        if count > 0:
+            msgs = self.canDriver._CanReceive(self.index, min(count, self.maxBatch))
+            if isinstance(msgs, int):
+                self.logger.error('CanReceive Error-Code: {0}'.format(msgs))
+            elif len(msgs):
+                self.deliver(msgs)
+            if count > self.maxBatch:
+                self.scheduleRead()
+
+    def deliver(self, batch):
+        if self.closed:
+            return
+        self.queue.put_nowait(batch)
+        if not self.paused and self.queue.qsize() >= self.maxQueue:
+            self.paused = True
+            self.pauseCount += 1
+            self.canDriver.CanSetEvents(EVENT_DISABLE_RX_MESSAGES)
+            self.logger.info('Rx paused, consumer too slow')
+
+    async def frames(self):
+        """
+        Async iterator of the received frames in batches
+        @return: batches (sequences of TCanMsg)
+        """
+        while not self.closed:
+            batch = await self.queue.get()
+            if batch is None:
+                return
+            if self.paused and self.queue.qsize() <= self.maxQueue // 2:
+                self.paused = False
+                self.canDriver.CanSetEvents(EVENT_ENABLE_RX_MESSAGES)
+                self.scheduleRead() # frames kept in the FIFO while paused
+            yield batch
+
+    async def send(self, msgId, msgData, rtr=None):
+        """
+        Transmit a CAN Message, waits while the transmit FIFO is full
+        @param msgId: CAN ID of the Message
+        @param msgData: Data of the Message, List of Integers
+        @param rtr: Remote Transmission Request
+        @return: Error Code (0 = No Error)
+        """
+        while self.canDriver._CanTransmitGetCount(self.index) >= self.maxTxPending:
+            await asyncio.sleep(self.txPollTime)
+        return self.canDriver.TransmitData(msgId, msgData, index=self.index, rtr=rtr)
+
+
+if __name__ == '__main__':
+
+    async def main():
+        canDriver = mhsTinyCanDriver.MhsTinyCanDriver(0, options = {'CanRxDMode':1,
+                                                                    'AutoConnect':1,
+                                                                    'CanSpeed1':250})
+        bus = AsyncCanBus(canDriver)
+        await bus.open()
+
+        async def hello():
+            while True:
+                await bus.send(0x610, [ord(x) for x in "Hello"])
+                await asyncio.sleep(1.0)
+
+        sender = asyncio.ensure_future(hello())
+        try:
+            async for batch in bus.frames():
+                for msg in batch:
+                    print('ID:{0:08x} Data:{1}'.format(msg.Id, [hex(x) for x in msg.Data]))
+        finally:
+            sender.cancel()
+            bus.close()
+            canDriver.shutdown()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
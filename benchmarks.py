@@ -0,0 +1,277 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: benchmarks.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Micro-benchmarks for the CAN logging path. Every benchmark prints
+#     one line per variant with the time per call and calls per second.
+#
+# Usage
+#     python benchmarks.py -h
+#     python benchmarks.py logging
+#     python benchmarks.py -d ./libmhstcan.so api
+#     python benchmarks.py isotp
+#     python benchmarks.py fd
+#     python benchmarks.py text
+#
+# ----------------------------------------------------------------------
+
+import sys
+import time
+import logging
+import uselogging
+import tracing
+
+
+def Measure(func, number):
+    """
+    Time a function
+    @param func: function without arguments
+    @param number: number of calls
+    @return: seconds per call
+    """
+    t0 = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - t0) / number
+
+
+def Report(name, perCall):
+    print('{0:<40s} {1:10.3f} us/call {2:12.0f} calls/s'.format(name, perCall * 1e6, 1.0 / perCall if perCall else 0))
+
+
+# --------------------------------------------------------------------
+# ------------------ Logging Overhead --------------------------------
+# --------------------------------------------------------------------
+
+def BenchLogging(options):
+    """
+    Per call logging overhead of the driver hot paths with logging disabled (the uselogging default)
+    """
+    number = options.number
+    logger = uselogging.getLogger()
+    num = 42
+
+    def eager():
+        logger.info('CanReceiveGetCount')
+        logger.info('CanReceive {0} message(s) received'.format(num))
+
+    def guarded():
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('CanReceiveGetCount')
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('CanReceive %d message(s) received', num)
+
+    def bare():
+        pass
+
+    tracer = tracing.SampledTracer(sampleRate=100)
+    traced = tracer.wrap('bare', bare)
+
+    Report('eager format + info (before)', Measure(eager, number))
+    Report('level guarded (after)', Measure(guarded, number))
+    Report('no logging at all', Measure(bare, number))
+    Report('sampled tracer 1/100 hook', Measure(traced, number))
+
+
+# --------------------------------------------------------------------
+# ------------------ Driver API Calls --------------------------------
+# --------------------------------------------------------------------
+
+def OpenDriver(options):
+    """
+    Open the tinyCAN device for the benchmarks that need the hardware
+    """
+    import mhsTinyCanDriver
+    return mhsTinyCanDriver.MhsTinyCanDriver(options.dll, options = {'CanRxDMode':1,
+                                                                    'AutoConnect':1,
+                                                                    'CanSpeed1':options.bitrate})
+
+def BenchApi(options):
+    """
+    Calls per second of the API functions, unprototyped calls with fresh argument objects (before)
+    against the prototypes bound at load time (after). Needs a tinyCAN device.
+    """
+    import mhsTinyCanDriver
+    from ctypes import c_ulong, c_int, pointer
+    number = options.number // 10
+    canDriver = OpenDriver(options)
+    index = canDriver.Index
+    raw = canDriver.loadLibrary(canDriver.cache.get('library', options.dll)) # fresh function objects without prototypes
+    status = mhsTinyCanDriver.TDeviceStatus()
+    msgs = (mhsTinyCanDriver.TCanMsg * 1)()
+
+    # the unprototyped calls build their arguments like the driver methods, only the call differs
+    def transmitBefore():
+        canMSG = mhsTinyCanDriver.TCanMsg()
+        canMSG.Id = 0x7FF
+        canMSG.Data[:8] = [1, 2, 3, 4, 5, 6, 7, 8]
+        canMSG.Flags.Uint32 = 8
+        return raw.CanTransmit(c_ulong(index.Uint32), pointer(canMSG), c_int(1))
+
+    def setFilterBefore():
+        canMSGFilter = mhsTinyCanDriver.TMsgFilter()
+        canMSGFilter.Mask = 0x7FF
+        canMSGFilter.Code = 0x7FF
+        canMSGFilter.Flags.Uint32 = 0
+        return raw.CanSetFilter(c_ulong(index.Uint32), pointer(canMSGFilter))
+
+    Report('CanReceiveGetCount before', Measure(lambda: raw.CanReceiveGetCount(c_ulong(index.Uint32)), number))
+    Report('CanReceiveGetCount after', Measure(lambda: canDriver._CanReceiveGetCount(index), number))
+    Report('CanReceive(1) before', Measure(lambda: raw.CanReceive(c_ulong(index.Uint32), pointer(msgs), c_int(1)), number))
+    Report('CanReceive(1) after', Measure(lambda: canDriver._CanReceive(index, 1), number))
+    Report('CanTransmitGetCount before', Measure(lambda: raw.CanTransmitGetCount(c_ulong(index.Uint32)), number))
+    Report('CanTransmitGetCount after', Measure(lambda: canDriver._CanTransmitGetCount(index), number))
+    Report('CanGetDeviceStatus before', Measure(lambda: raw.CanGetDeviceStatus(c_ulong(index.Uint32), pointer(status)), number))
+    Report('CanGetDeviceStatus after', Measure(lambda: canDriver._CanGetDeviceStatus(index), number))
+    Report('CanDrvHwInfo before', Measure(lambda: raw.CanDrvHwInfo(c_ulong(index.Uint32)), number))
+    Report('CanDrvHwInfo after', Measure(lambda: canDriver._CanDrvHwInfo(index), number))
+    Report('CanDrvInfo before', Measure(lambda: raw.CanDrvInfo(), number))
+    Report('CanDrvInfo after', Measure(lambda: canDriver._CanDrvInfo(), number))
+    if options.tx:
+        Report('CanTransmit before', Measure(transmitBefore, number))
+        Report('CanTransmit after', Measure(lambda: canDriver._CanTransmit(index, 0x7FF, [1, 2, 3, 4, 5, 6, 7, 8], 8), number))
+        Report('CanSetFilter before', Measure(setFilterBefore, number))
+        Report('CanSetFilter after', Measure(lambda: canDriver._CanSetFilter(index, 0x7FF, 0x7FF, 0), number))
+    canDriver.resetCanBus()
+    canDriver._CanDownDriver()
+
+
+# --------------------------------------------------------------------
+# ------------------ ISO-TP Throughput -------------------------------
+# --------------------------------------------------------------------
+
+def BenchIsoTp(options):
+    """
+    Large ReadDataByIdentifier responses of a simulated ECU over the loopback bus, consecutive frames
+    one CanTransmit call each (before) against batched (after), without bus delay and at the bitrate
+    """
+    import isotp
+    count = max(5, options.number // 10000)
+    for name, txBatch in (('one by one', 1), ('batched', isotp.TX_BATCH)):
+        for bitrate in (None, options.bitrate):
+            perTransfer, rate = isotp.Throughput(4095, count if bitrate is None else 3, bitrate, txBatch)
+            Report('ISO-TP 4095 bytes {0}, {1}'.format(name, '{0} kBit/s'.format(bitrate) if bitrate else 'no bus'), perTransfer)
+            print('{0:<40s} {1:10.1f} kB/s'.format('', rate / 1e3))
+
+
+# --------------------------------------------------------------------
+# ------------------ CAN FD ------------------------------------------
+# --------------------------------------------------------------------
+
+def BenchFd(options):
+    """
+    Format and encode path per frame: classic TCanMsgs as before, the same frames read as TCanFdMsgs
+    and CAN FD frames with 64 bytes. The classic path is the code path of logs without CAN FD.
+    """
+    import canencoding
+    from mhsTinyCanDriver import MhsTinyCanDriver, TCanMsg, TCanFdMsg
+    count = 1000
+    number = max(1, options.number // 20000)
+    classic = (TCanMsg * count)()
+    asFd = (TCanFdMsg * count)()
+    fd = (TCanFdMsg * count)()
+    for i in range(count):
+        classic[i].Id = asFd[i].Id = fd[i].Id = 0x100 + i % 16
+        classic[i].Flags.FlagBits.DLC = asFd[i].Flags.FlagBits.Len = 8
+        fd[i].Flags.FlagBits.Len = 64
+        fd[i].Flags.FlagBits.FDF = fd[i].Flags.FlagBits.BRS = 1
+        for k in range(8):
+            classic[i].Data[k] = asFd[i].Data[k] = (i >> k) & 0xFF
+        for k in range(64):
+            fd[i].Data[k] = (i + k) & 0xFF
+
+    def text(decode, format, msgs):
+        return lambda: format(None, decode(None, msgs))
+
+    def encode(frame, msgs):
+        return lambda: canencoding.EncodeBlock([frame(msg) for msg in msgs])
+
+    Report('text classic TCanMsg, per frame', Measure(text(MhsTinyCanDriver.DecodeMessages, MhsTinyCanDriver.FormatDecodedSimple, classic), number) / count)
+    Report('text classic as TCanFdMsg, per frame', Measure(text(MhsTinyCanDriver.DecodeFdMessages, MhsTinyCanDriver.FormatFdDecodedSimple, asFd), number) / count)
+    Report('text CAN FD 64 bytes, per frame', Measure(text(MhsTinyCanDriver.DecodeFdMessages, MhsTinyCanDriver.FormatFdDecodedSimple, fd), number) / count)
+    Report('encode classic TCanMsg, per frame', Measure(encode(canencoding.MessageFrame, classic), number) / count)
+    Report('encode classic as TCanFdMsg, per frame', Measure(encode(canencoding.FdMessageFrame, asFd), number) / count)
+    Report('encode CAN FD 64 bytes, per frame', Measure(encode(canencoding.FdMessageFrame, fd), number) / count)
+
+
+# --------------------------------------------------------------------
+# ------------------ Text Log Lines ----------------------------------
+# --------------------------------------------------------------------
+
+def BenchText(options):
+    """
+    CANlog.txt lines of a batch written as bytes: SIMPLE_FORMAT with hex() per byte as in
+    CanReceiveAndFormatSimple against the tables of textformat.TextFormatter, same output
+    """
+    import random
+    import textformat
+    from mhsTinyCanDriver import MhsTinyCanDriver, TCanMsg
+    count = 1000
+    number = max(1, options.number // 2000)
+    msgs = (TCanMsg * count)()
+    for i in range(count):
+        msgs[i].Id = 0x100 + i % 64
+        msgs[i].Flags.FlagBits.DLC = 8
+        for k in range(8):
+            msgs[i].Data[k] = random.getrandbits(8)
+    formatter = textformat.TextFormatter()
+
+    def simple():
+        lines = MhsTinyCanDriver.FormatDecodedSimple(None, MhsTinyCanDriver.DecodeMessages(None, msgs))
+        return ''.join([line + '\n' for line in lines]).encode()
+
+    def tables():
+        return formatter.encode(msgs)
+
+    if simple() != tables():
+        print('output differs')
+    before = Measure(simple, number) / count
+    after = Measure(tables, number) / count
+    Report('SIMPLE_FORMAT and hex(), per line', before)
+    Report('TextFormatter.encode, per line', after)
+    print('{0:<40s} {1:10.1f} x'.format('speedup', before / after))
+
+
+BENCHMARKS = {'logging':BenchLogging,
+              'api':BenchApi,
+              'isotp':BenchIsoTp,
+              'fd':BenchFd,
+              'text':BenchText}
+
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+
+    parser = OptionParser('usage: %prog [options] benchmark...\n\nbenchmarks: ' + ', '.join(sorted(BENCHMARKS)))
+    parser.add_option('-n', action='store', type='int', dest='number', metavar='N',
+                      help='number of calls per variant, default = 200000', default=200000)
+    parser.add_option('-d', action='store', type='string', dest='dll', metavar='LIB',
+                      help='path of the tinyCAN library for the hardware benchmarks', default=None)
+    parser.add_option('-b', action='store', type='int', dest='bitrate', metavar='KBIT',
+                      help='can bitrate in kBit/s, default = 250', default=250)
+    parser.add_option('-t', action='store_true', dest='tx',
+                      help='include benchmarks that transmit on the bus', default=False)
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error('no benchmark given')
+    for name in args:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {0}'.format(name))
+        print('--- {0} ---'.format(name))
+        BENCHMARKS[name](options)
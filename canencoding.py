@@ -0,0 +1,433 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: canencoding.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     CAN specific encoding of frames before the generic compression.
+#     Frames are collected in blocks. Within a block the frames are
+#     grouped by ID, every ID stores
+#         time deltas to its previous frame (microseconds, varint)
+#         flags XOR the previous flags (varint, 0 if unchanged)
+#         a change mask per frame (bit n = data byte n changed)
+#         the XOR of the changed data bytes only
+#     Unchanged payloads cost one mask byte. The order of the frames is
+#     kept by a column of ID numbers in receive order.
+#     CAN FD frames carry FLAG_FDF (and FLAG_BRS, FLAG_ESI) above the 32
+#     bits of the driver flags, the DLC code in the flags gives their
+#     length. Their masks are varints (up to 64 bits), the data is XORed
+#     to the previous payload of the ID cut or zero padded to the length.
+#     Blocks with CAN FD frames have version 2.
+#     Every column is stored contiguous, the block is compressed by a
+#     codec of compression.py and written as one block of a framed log
+#     (framedlog.py), so the files are power loss safe as well.
+#
+#     Block layout (before compression), integers little endian:
+#         'CANB', version (1 byte), frame count (4), base time us (8),
+#         ID count (2), IDs (4 each), then the columns
+#         order, time, flags, mask, data, each as length (4) + bytes
+#     The first block of the file names the codec.
+#
+# Usage
+#     >>> writer = canencoding.CanLogWriter('CANlog.canb')
+#     >>> writer.addMessages(canDriver._CanReceive(index, count))
+#     >>> writer.close()
+#     >>> writer.addMessages(canDriver._CanFdReceive(index, count))   # CAN FD bus
+#     >>> for t, msgId, flags, data in canencoding.ReadCanLog('CANlog.canb'): ...
+#
+#     python canencoding.py CANlog.canb            (print as CANlog.txt lines)
+#     python canencoding.py -e CANlog.txt out.canb (convert a text log)
+#
+# ----------------------------------------------------------------------
+
+import time
+import struct
+import framedlog
+import compression
+from mhsTinyCanDriver import SIMPLE_FORMAT, FD_FORMAT, FD_DLC_LENGTHS, FD_LENGTH_DLC, TCanFdMsg
+from onchange import SKIPPED_FORMAT
+
+BLOCK_MAGIC = b'CANB'
+VERSION = 1
+FD_VERSION = 2 # blocks with CAN FD frames
+ENCODED_SUFFIX = '.canb'
+FILE_HEADER = b'CANLOG codec='  # first block of the file, followed by the codec name
+FRAMES_PER_BLOCK = 4096
+BLOCK_HEADER = struct.Struct('<4sBIQH')
+COLUMN_LENGTH = struct.Struct('<I')
+ZERO_DATA = bytes(8)
+
+# frame flags above the driver flags
+FLAG_FDF = 1 << 32
+FLAG_BRS = 1 << 33
+FLAG_ESI = 1 << 34
+
+
+def PutVarint(out, value):
+    """
+    Append an unsigned integer in 7 bit groups
+    @param out: bytearray
+    @param value: integer >= 0
+    @return: Nothing
+    """
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def GetVarint(buf, pos):
+    """
+    @return: (value, next position)
+    """
+    value = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
+def ZigZag(value):
+    return (value << 1) if value >= 0 else ((-value << 1) - 1)
+
+
+def UnZigZag(value):
+    return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+
+def EncodeBlock(frames):
+    """
+    Encode frames into one block
+    @param frames: list of (time in us, id, flags, data as 8 bytes, CAN FD frames as many as their DLC code gives)
+    @return: bytes
+    """
+    # unsigned in the header, the time deltas are signed, so earlier (negative) times still round trip
+    baseTime = max(0, frames[0][0]) if frames else 0
+    idNumbers = {}
+    ids = []
+    perId = [] # per ID: [last time, last flags, last data, time column, flags column, mask column, data column]
+    order = bytearray()
+    fd = False
+    for t, msgId, flags, data in frames:
+        n = idNumbers.get(msgId)
+        if n is None:
+            n = idNumbers[msgId] = len(ids)
+            ids.append(msgId)
+            perId.append([baseTime, 0, ZERO_DATA, bytearray(), bytearray(), bytearray(), bytearray()])
+        PutVarint(order, n)
+        state = perId[n]
+        PutVarint(state[3], ZigZag(t - state[0]))
+        PutVarint(state[4], flags ^ state[1])
+        last = state[2]
+        if data == last:
+            state[5].append(0)
+        elif flags < FLAG_FDF and len(last) == 8:
+            mask = 0
+            changed = state[6]
+            for i in range(8):
+                x = data[i] ^ last[i]
+                if x:
+                    mask |= 1 << i
+                    changed.append(x)
+            state[5].append(mask)
+        else:
+            length = len(data)
+            if len(last) != length:
+                last = last[:length].ljust(length, b'\0')
+            mask = 0
+            changed = state[6]
+            for i in range(length):
+                x = data[i] ^ last[i]
+                if x:
+                    mask |= 1 << i
+                    changed.append(x)
+            if flags >= FLAG_FDF:
+                fd = True
+                PutVarint(state[5], mask)
+            else:
+                state[5].append(mask)
+        state[0] = t
+        state[1] = flags
+        state[2] = data
+    out = bytearray(BLOCK_HEADER.pack(BLOCK_MAGIC, FD_VERSION if fd else VERSION, len(frames), baseTime, len(ids)))
+    out += struct.pack('<{0}I'.format(len(ids)), *ids)
+    columns = [order]
+    for column in range(3, 7):
+        columns.append(b''.join(state[column] for state in perId))
+    for column in columns:
+        out += COLUMN_LENGTH.pack(len(column))
+        out += column
+    return bytes(out)
+
+
+def DecodeBlock(block):
+    """
+    Decode one block
+    @param block: bytes of EncodeBlock
+    @return: list of (time in us, id, flags, data as 8 bytes or the length of the CAN FD frame)
+    """
+    magic, version, count, baseTime, idCount = BLOCK_HEADER.unpack_from(block, 0)
+    if magic != BLOCK_MAGIC or version not in (VERSION, FD_VERSION):
+        raise ValueError('not an encoded CAN block')
+    pos = BLOCK_HEADER.size
+    ids = struct.unpack_from('<{0}I'.format(idCount), block, pos)
+    pos += 4 * idCount
+    columns = []
+    for i in range(5):
+        length, = COLUMN_LENGTH.unpack_from(block, pos)
+        pos += COLUMN_LENGTH.size
+        columns.append(block[pos:pos + length])
+        pos += length
+    order, times, flagsColumn, masks, changed = columns
+    # frames per ID in receive order
+    sequence = []
+    counts = [0] * idCount
+    p = 0
+    for i in range(count):
+        n, p = GetVarint(order, p)
+        sequence.append(n)
+        counts[n] += 1
+    # the per ID columns are concatenated in ID order
+    perId = []
+    tp = fp = mp = dp = 0
+    for n in range(idCount):
+        t = baseTime
+        flags = 0
+        data = bytearray(8)
+        frames = []
+        for k in range(counts[n]):
+            delta, tp = GetVarint(times, tp)
+            t += UnZigZag(delta)
+            x, fp = GetVarint(flagsColumn, fp)
+            flags ^= x
+            if flags < FLAG_FDF:
+                mask = masks[mp]
+                mp += 1
+                length = 8
+            else:
+                mask, mp = GetVarint(masks, mp)
+                length = FD_DLC_LENGTHS[flags & 0xf]
+            if len(data) != length:
+                data = data[:length].ljust(length, b'\0')
+            if mask:
+                for i in range(length):
+                    if mask & (1 << i):
+                        data[i] ^= changed[dp]
+                        dp += 1
+            frames.append((t, ids[n], flags, bytes(data)))
+        frames.reverse()
+        perId.append(frames)
+    return [perId[n].pop() for n in sequence]
+
+
+def MessageFrame(msg, suppressed=0):
+    """
+    Frame tuple of a TCanMsg
+    @param suppressed: frames of the ID suppressed before this one (change-only logging),
+                       kept in the unused upper 16 bits of the flags
+    @return: (time in us, id, flags, data as 8 bytes)
+    """
+    flags = msg.Flags.Uint32
+    if suppressed:
+        flags |= min(suppressed, 0xffff) << 16
+    return (msg.Sec * 1000000 + msg.USec, msg.Id, flags, bytes(msg.Data))
+
+
+def FdMessageFrame(msg, suppressed=0):
+    """
+    Frame tuple of a TCanFdMsg, classic frames give the same tuple as MessageFrame
+    @param suppressed: see MessageFrame
+    @return: (time in us, id, flags, data)
+    """
+    bits = msg.Flags.FlagBits
+    flags = bits.TxD << 4 | bits.RTR << 6 | bits.EFF << 7 | bits.Source << 8
+    if bits.FDF:
+        dlc = FD_LENGTH_DLC[bits.Len]
+        flags |= dlc | FLAG_FDF | bits.BRS << 33 | bits.ESI << 34
+        data = bytes(msg.Data[:FD_DLC_LENGTHS[dlc]])
+    else:
+        flags |= bits.Len & 0xf
+        data = bytes(msg.Data[:8])
+    if suppressed:
+        flags |= min(suppressed, 0xffff) << 16
+    return (msg.Sec * 1000000 + msg.USec, msg.Id, flags, data)
+
+
+def FormatSimple(frame):
+    """
+    Frame as a CANlog.txt line (same format as CanReceiveAndFormatSimple, change-only logs
+    with the number of suppressed frames)
+    @param frame: (time in us, id, flags, data)
+    @return: String
+    """
+    t, msgId, flags, data = frame
+    line = SIMPLE_FORMAT.format(msgId, flags & 0xf, (flags >> 4) & 1, (flags >> 6) & 1, (flags >> 7) & 1, (flags >> 8) & 0xff,
+        [hex(x) for x in data])
+    if flags >= FLAG_FDF:
+        line += FD_FORMAT.format((flags >> 33) & 1, (flags >> 34) & 1)
+    if flags & 0xffff0000:
+        line += SKIPPED_FORMAT.format((flags >> 16) & 0xffff)
+    return line
+
+
+class CanLogWriter:
+    """
+    Encoded, compressed CAN log in a framed log file
+    """
+    def __init__(self, fileName, framesPerBlock=FRAMES_PER_BLOCK, codec='deflate:6', flushInterval=5.0):
+        """
+        Class Constructor, an existing file is appended to with its own codec
+        @param fileName: output file, usually <name>.canb
+        @param framesPerBlock: frames per encoded block
+        @param codec: name of a codec of compression.py, 'stored' for no compression
+        @param flushInterval: seconds after which a partial block is written
+        @return: nothing
+        """
+        self.framesPerBlock = framesPerBlock
+        self.flushInterval = flushInterval
+        self.frames = []
+        self.framesStart = None # time the oldest buffered frame came
+        self.log = framedlog.FramedLogWriter(fileName, blockSize=1) # every write is a block
+        if self.log.tell() == len(framedlog.FILE_MAGIC):
+            self.log.write(FILE_HEADER + codec.encode())
+        else:
+            codec = ReadCodec(fileName)
+        self.codec = compression.GetCodec(codec)
+
+    def addFrames(self, frames):
+        """
+        Add frames
+        @param frames: list of (time in us, id, flags, data), see EncodeBlock
+        @return: Nothing
+        """
+        if not frames:
+            return
+        now = time.monotonic()
+        if not self.frames:
+            self.framesStart = now
+        self.frames.extend(frames)
+        if len(self.frames) >= self.framesPerBlock or now - self.framesStart >= self.flushInterval:
+            self.flush()
+
+    def addMessages(self, msgs, suppressed=None, times=None):
+        """
+        Add TCanMsgs or TCanFdMsgs, e.g. the result of _CanReceive or _CanFdReceive
+        @param suppressed: frames suppressed before each message, see MessageFrame
+        @param times: seconds per message replacing the device timestamps, e.g. of
+                      timesync.ClockCorrelator.sessionTimes
+        @return: Nothing
+        """
+        if isinstance(msgs, int) or not len(msgs):
+            return
+        frame = FdMessageFrame if type(msgs[0]) is TCanFdMsg else MessageFrame
+        if suppressed is None:
+            frames = [frame(msg) for msg in msgs]
+        else:
+            frames = [frame(msg, n) for msg, n in zip(msgs, suppressed)]
+        if times is not None:
+            frames = [(int(t * 1000000), msgId, flags, data) for t, (_, msgId, flags, data) in zip(times, frames)]
+        self.addFrames(frames)
+
+    def poll(self):
+        """
+        Write the partial block if its oldest frame is flushInterval seconds old, call it every poll
+        @return: Nothing
+        """
+        if self.frames and time.monotonic() - self.framesStart >= self.flushInterval:
+            self.flush()
+
+    def flush(self):
+        while self.frames:
+            block = self.frames[:self.framesPerBlock]
+            del self.frames[:self.framesPerBlock]
+            self.log.write(self.codec.compress(EncodeBlock(block)))
+
+    def tell(self):
+        return self.log.tell()
+
+    def close(self):
+        self.flush()
+        self.log.close()
+
+
+def ReadCodec(fileName):
+    """
+    @return: name of the codec of an encoded CAN log
+    """
+    for payload in framedlog.ReadBlocks(fileName):
+        if payload.startswith(FILE_HEADER):
+            return payload[len(FILE_HEADER):].decode()
+        break
+    raise ValueError('{0} is not an encoded CAN log'.format(fileName))
+
+
+def ReadCanLog(fileName):
+    """
+    Frames of an encoded CAN log, up to the first damaged block
+    @param fileName: file written by CanLogWriter
+    @return: generator of (time in us, id, flags, data)
+    """
+    blocks = framedlog.ReadBlocks(fileName)
+    header = next(blocks, b'')
+    if not header.startswith(FILE_HEADER):
+        raise ValueError('{0} is not an encoded CAN log'.format(fileName))
+    codec = compression.GetCodec(header[len(FILE_HEADER):].decode())
+    for payload in blocks:
+        for frame in DecodeBlock(codec.decompress(payload)):
+            yield frame
+
+
+if __name__ == '__main__':
+
+    import re
+    import sys
+    import zlib
+    from optparse import OptionParser
+
+    parser = OptionParser('usage: %prog file.canb\n       %prog -e CANlog.txt file.canb')
+    parser.add_option('-e', action='store_true', dest='encode',
+                      help='encode a text log', default=False)
+    (options, args) = parser.parse_args()
+
+    if options.encode:
+        if len(args) != 2:
+            parser.error('incorrect number of arguments')
+        pattern = re.compile(r"ID:(\w+), DLC:(\d+),TxD:(\d), RTR:(\d), EFF:(\d), Source:(\d+), Data:\[(.*?)\](?:, FDF:1, BRS:(\d), ESI:(\d))?")
+        frames = []
+        text = open(args[0], 'rb').read()
+        for line in text.decode().splitlines():
+            m = pattern.match(line)
+            if m:
+                flags = int(m.group(2)) | int(m.group(3)) << 4 | int(m.group(4)) << 6 | int(m.group(5)) << 7 | int(m.group(6)) << 8
+                data = bytes(int(x.strip(" '"), 16) for x in m.group(7).split(',') if x.strip())
+                if m.group(8) is not None:
+                    flags |= FLAG_FDF | int(m.group(8)) << 33 | int(m.group(9)) << 34
+                frames.append((0, int(m.group(1), 16), flags, data))
+        writer = CanLogWriter(args[1])
+        writer.addFrames(frames)
+        writer.close()
+        encoded = open(args[1], 'rb').read()
+        print('{0} frames: text {1} bytes, text deflated {2} bytes, encoded and deflated {3} bytes'.format(
+            len(frames), len(text), len(zlib.compress(text, 6)), len(encoded)))
+    else:
+        if len(args) != 1:
+            parser.error('incorrect number of arguments')
+        for frame in ReadCanLog(args[0]):
+            sys.stdout.write(FormatSimple(frame) + '\n')
@@ -1,36 +1,267 @@
 import mhsTinyCanDriver
+import timesync
+import tripindex
+import health
+import metrics
+import framedlog
+import canencoding
+import onchange
+import textformat
+import reconnect
 import time
+import os
+from optparse import OptionParser
+
+# files next to the log, moved with it when it is rotated
+LOG_SIDECARS = (timesync.SIDECAR_SUFFIX, reconnect.GAPS_SUFFIX, onchange.COUNTS_SUFFIX)
+
+
+def RotateLog(logFileName, sidecars=LOG_SIDECARS):
+	"""
+	Move the log of the last start aside to <name>-<number><ext>, carpcd restarts canpi after
+	any exit and a new start must not overwrite the log of the one before
+	@param logFileName: log file, e.g. CANlog.txt
+	@param sidecars: suffixes of the files next to the log
+	@return: new name of the old log, None if there was none
+	"""
+	if not os.path.exists(logFileName) or not os.path.getsize(logFileName):
+		return None
+	base, ext = os.path.splitext(logFileName)
+	number = 1
+	while os.path.exists('{0}-{1:03d}{2}'.format(base, number, ext)):
+		number += 1
+	rotated = '{0}-{1:03d}{2}'.format(base, number, ext)
+	# the log last, an interrupted rotation ends up with the same number next time
+	for suffix in sidecars:
+		if os.path.exists(logFileName + suffix):
+			os.replace(logFileName + suffix, rotated + suffix)
+	os.replace(logFileName, rotated)
+	return rotated
+
 
 if __name__ == '__main__':
-	
+
+	parser = OptionParser('usage: %prog [options]')
+	parser.add_option('--profile', action='store_true', dest='profile',
+		help='time the receive/decode/format/write stages, stack samples to canpi.folded', default=False)
+	parser.add_option('--framed', action='store_true', dest='framed',
+		help='write CANlog.cpfl in the power loss safe framed format instead of CANlog.txt', default=False)
+	parser.add_option('--encoded', action='store_true', dest='encoded',
+		help='write CANlog.canb, delta encoded and compressed, instead of CANlog.txt', default=False)
+	parser.add_option('--on-change', action='store', type='float', dest='keyframe', metavar='SECONDS',
+		help='write a frame only if its payload changed or SECONDS passed since the last one of its ID', default=None)
+	parser.add_option('--timestamps', action='store_true', dest='timestamps',
+		help='append the session time of every frame (hardware timestamp, drift corrected) to the text lines', default=False)
+	parser.add_option('--gps', action='store', type='string', dest='gps', metavar='UID',
+		help='Tinkerforge GPS Bricklet (brickd on localhost) giving the wall clock reference of the log', default=None)
+	parser.add_option('--fd', action='store_true', dest='fd',
+		help='read CAN FD frames (up to 64 bytes) too, needs a library with CanFdReceive', default=False)
+	(options, args) = parser.parse_args()
+	if options.profile and (options.encoded or options.keyframe is not None or options.timestamps):
+		parser.error('--profile times the plain text pipeline only')
+
+	if options.encoded:
+		logFileName = "CANlog" + canencoding.ENCODED_SUFFIX
+	elif options.framed:
+		logFileName = "CANlog" + framedlog.FRAMED_SUFFIX
+	else:
+		logFileName = "CANlog.txt"
+	# every start gets a new log, the one of the last start is kept as CANlog-<number>.txt
+	rotatedLogFileName = RotateLog(logFileName)
+	if rotatedLogFileName:
+		print('Log of the last start moved to {0}'.format(rotatedLogFileName))
+	# logging starts right away, the wall clock offset goes to CANlog.txt.time
+	# the session starts before the driver, frame times are not negative then
+	clock = timesync.SessionClock(logFileName)
+	# wall clock reference: the system time if NTP synced it, replaced by the GPS time once there is a fix
+	if timesync.SystemTimeSynchronized():
+		clock.setReference(time.time(), source='ntp')
+	gpsSync = None
+	if options.gps:
+		try:
+			gpsSync = timesync.GpsTimeSync(timesync.ConnectGps(options.gps), clock)
+		except Exception as e:
+			parser.error('GPS {0}: {1}'.format(options.gps, e))
+		gpsSync.start()
+
 	# create the driver
-	canDriver = mhsTinyCanDriver.MhsTinyCanDriver(0,options = {'CanRxDMode':1,
+	driverOptions = {'CanRxDMode':1,
 		'AutoConnect':1,
-		'CanSpeed1':250})
+		'CanSpeed1':250}
+	if options.encoded or options.timestamps:
+		driverOptions['TimeStampMode'] = 1 # hardware timestamps for the time column
+	canDriver = mhsTinyCanDriver.MhsTinyCanDriver(0,options = driverOptions)
+	if options.fd:
+		receive, decode, formatDecoded = canDriver._CanFdReceive, canDriver.DecodeFdMessages, canDriver.FormatFdDecodedSimple
+	else:
+		receive, decode, formatDecoded = canDriver._CanReceive, canDriver.DecodeMessages, canDriver.FormatDecodedSimple
 		
-	polltime = 0.5
-	log = open("CANlog.txt","w")
+	if options.encoded:
+		log = canencoding.CanLogWriter(logFileName)
+	elif options.framed:
+		log = framedlog.FramedLogWriter(logFileName)
+	else:
+		log = open(logFileName,"wb")
+	# frame times on the session clock, the wall clock is session time + offset of the sidecar
+	correlator = None
+	if options.encoded or options.timestamps:
+		correlator = timesync.ClockCorrelator(clock)
+	# session times, a trip keeps the wall clock offset, the trips of the last start point to its rotated log
+	trips = tripindex.TripIndex("CANlog" + tripindex.INDEX_SUFFIX, clock=clock)
+	if rotatedLogFileName:
+		trips.renameFile(logFileName, rotatedLogFileName)
+
+	# overrun accounting and poll interval / batch size from the FIFO fill level
+	monitor = health.FifoHealthMonitor(canDriver)
+	poller = health.AdaptivePoller(monitor.fifoSize)
+	received = 0
+	lastReport = time.monotonic()
 
+	# live metrics on http://127.0.0.1:9105/metrics, updated by plain additions in the loop
+	framesReceived = metrics.Counter('carpc_can_frames_received_total', 'CAN frames read from the driver')
+	framesWritten = metrics.Counter('carpc_can_frames_written_total', 'CAN frames written to the log file')
+	receiveLatency = metrics.Histogram('carpc_can_receive_seconds', 'Duration of a read and format of one batch')
+	metrics.Gauge('carpc_can_log_bytes', 'Bytes of the CAN log file on disk', function=lambda: os.path.getsize(logFileName))
+	metrics.Gauge('carpc_can_fifo_fill', 'Frames waiting in the Rx FIFO at the last poll', function=lambda: monitor.lastCount)
+	metrics.Gauge('carpc_can_fifo_size', 'Size of the Rx FIFO', function=lambda: monitor.fifoSize)
+	metrics.Gauge('carpc_can_frame_rate', 'CAN frames per second, smoothed', function=lambda: monitor.rate)
+	metrics.Gauge('carpc_can_fifo_overruns', 'Rx FIFO overruns', function=lambda: monitor.overruns)
+	metrics.Gauge('carpc_can_frames_lost', 'Estimated frames lost by FIFO overruns', function=lambda: monitor.lostFrames)
+	metrics.Gauge('carpc_can_poll_seconds', 'Sleep time between the polls', function=lambda: poller.pollTime)
+	metrics.StartHttpServer()
+
+	# text lines from tables, same lines as CanReceiveAndFormatSimple
+	formatter = textformat.TextFormatter()
+
+	# reopen after the adapter was unplugged, the log stays open, the gaps go to <log>.gaps.json
+	# as soon as they start and end, a power cut during the session does not lose them
+	def gapStart(start):
+		log.flush()
+		link.save(logFileName)
+	link = reconnect.ReconnectMonitor(canDriver, clock, onLost=gapStart, onGap=lambda start, end: link.save(logFileName))
+	metrics.Gauge('carpc_can_connected', 'CAN device connected (1) or lost (0)', function=lambda: int(link.connected))
+	metrics.Gauge('carpc_can_reconnects', 'Reopens of the CAN device after it was lost', function=lambda: link.reconnects)
+
+	changes = None
+	if options.keyframe is not None:
+		changes = onchange.ChangeFilter(options.keyframe)
+
+	timer = sampler = None
+	if options.profile:
+		import profiling
+		timer = profiling.StageTimer()
+		sampler = profiling.SamplingProfiler()
+		sampler.start()
+
+	firstFrame = True
 	try:
 		while True:
-			print('Polling Rx FIFO - Filter')
 			myFilterCount = canDriver._CanReceiveGetCount(canDriver.Index)
-			print('{0} Messages in FiFO'.format(myFilterCount))
-			if myFilterCount:
-				msg = canDriver.CanReceiveAndFormatSimple(canDriver.Index,count = myFilterCount)
-				print(msg) 
-				for m in msg:
-					log.write(m+'\n')                                      
+			if not link.check(myFilterCount):
+				received = 0
+				time.sleep(link.sleepTime())
+				continue
+			monitor.sample(myFilterCount, received)
+			polltime, batch = poller.next(myFilterCount)
+			received = 0
+			if batch:
+				t0 = time.monotonic()
+				data = msg = None
+				if options.encoded or changes is not None or correlator is not None:
+					rx = receive(canDriver.Index, batch)
+					if isinstance(rx, int):
+						rx = []
+					received = len(rx)
+					msgIds = [m.Id for m in rx]
+					times = None
+					if correlator is not None:
+						times = correlator.sessionTimes(rx)
+					skipped = None
+					if changes is not None:
+						if times is not None:
+							# the filter keeps the message objects, their times follow them
+							rx = list(rx)
+							times = dict(zip(map(id, rx), times))
+						rx, skipped = changes.filter(rx)
+						if times is not None:
+							times = [times[id(m)] for m in rx]
+					written = len(rx)
+					if options.encoded:
+						# no text lines, the frames go to the encoder as they are
+						log.addMessages(rx, skipped, times)
+						msg = ()
+					elif options.fd:
+						msg = formatDecoded(decode(rx))
+					else:
+						msg = formatter.lines(rx)
+					if msg:
+						if skipped is not None:
+							msg = [m + onchange.SKIPPED_FORMAT.format(n) if n else m for m, n in zip(msg, skipped)]
+						if times is not None:
+							msg = [m + timesync.TIME_FORMAT.format(t) for m, t in zip(msg, times)]
+				elif options.fd and timer is None:
+					# CanFdReceiveAndFormatSimple in its steps, the IDs come from the decoded messages
+					decoded = decode(receive(canDriver.Index, batch))
+					msgIds = [d[0] for d in decoded]
+					msg = formatDecoded(decoded)
+					received = written = len(msgIds)
+				elif timer is None:
+					msgIds = []
+					data = formatter.encode(receive(canDriver.Index, batch), msgIds)
+					received = written = len(msgIds)
+				else:
+					t = timer.start()
+					rx = receive(canDriver.Index, batch)
+					t = timer.lap('receive', t)
+					decoded = decode(rx)
+					t = timer.lap('decode', t)
+					msg = formatDecoded(decoded)
+					t = timer.lap('format', t)
+					msgIds = [d[0] for d in decoded]
+					received = written = len(msgIds)
+				receiveLatency.observe(time.monotonic() - t0)
+				framesReceived.inc(received)
+				if firstFrame and canDriver.timeToFirstFrame is not None:
+					print('First frame {0:.3f}s after driver start'.format(canDriver.timeToFirstFrame))
+					firstFrame = False
+				if msg:
+					data = ''.join([m + '\n' for m in msg]).encode()
+				if data:
+					log.write(data)
+				framesWritten.inc(written)
+				if timer is not None:
+					timer.lap('write', t)
+					timer.frames(written)
+				now = clock.now()
+				trips.addCanIds(now, msgIds)
+				trips.addFileOffset(logFileName, log.tell(), now)
+			if options.encoded or options.framed:
+				log.poll() # buffered frames are written after flushInterval even if the bus went quiet
+			if time.monotonic() - lastReport > 10.0:
+				print(monitor)
+				if changes is not None:
+					changes.save(logFileName) # the counts survive a power cut, at most 10 s old
+				lastReport = time.monotonic()
 			time.sleep(polltime)    
 	except KeyboardInterrupt:
 		pass
 		
 	# shutdown
-	canDriver.resetCanBus()
-	canDriver._CanDownDriver()
-	canDriver.so = None
+	canDriver.shutdown()
+	if gpsSync is not None:
+		gpsSync.stop()
 	
 	log.close()
-	
-	
+	trips.close()
+	print(monitor)
+	link.save(logFileName)
+	print(link)
+	if changes is not None:
+		changes.save(logFileName)
+		print(changes)
+	if sampler is not None:
+		sampler.stop()
+		sampler.write('canpi.folded')
+		print(timer.totalSummary())
+
 	print ('done')
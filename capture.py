@@ -0,0 +1,231 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: capture.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Parallel capture from several tinyCAN adapters (e.g. powertrain,
+#     body and chassis bus). One receive worker thread per device drains
+#     its FIFO, the frames of all devices are merged into one stream
+#     ordered by timestamp.
+#     The adapter timestamps (Sec/USec) of each device are mapped to the
+#     host monotonic clock by the smallest observed host-device offset,
+#     frames without adapter timestamp get the host receive time.
+#     A frame is released once every worker has polled past its
+#     timestamp, so the merged stream is ordered across devices.
+#
+# Usage
+#     >>> manager = capture.CaptureManager({'powertrain':drv1, 'body':drv2})
+#     >>> manager.start()
+#     >>> for t, name, msg in manager.read(timeout=1.0): ...
+#     >>> manager.stop()
+#
+#     python capture.py -S 12345678=powertrain,23456789=body -o CANlog.txt
+#
+# ----------------------------------------------------------------------
+
+import time
+import heapq
+import threading
+import collections
+import uselogging
+
+
+class ReceiveWorker(threading.Thread):
+    """
+    Receive thread of one device, drains the device FIFO into a deque
+    """
+    def __init__(self, name, canDriver, pollTime=0.01, maxCount=1000):
+        """
+        Class Constructor
+        @param name: name of the bus/device in the merged stream
+        @param canDriver: opened MhsTinyCanDriver
+        @param pollTime: seconds to sleep if the FIFO was empty
+        @param maxCount: maximum number of frames per read
+        @return: nothing
+        """
+        threading.Thread.__init__(self, name='ReceiveWorker-{0}'.format(name))
+        self.daemon = True
+        self.logger = uselogging.getLogger()
+        self.busName = name
+        self.canDriver = canDriver
+        self.pollTime = pollTime
+        self.maxCount = maxCount
+        self.frames = collections.deque() # (host time, sequence, name, TCanMsg)
+        self.watermark = time.monotonic() # frames up to this host time have been read, never decreases
+        self.offset = None # host - device time, smallest seen
+        self.received = 0
+        self.sequence = 0
+        self.stopped = threading.Event()
+        self.wakeup = None
+
+    def hostTime(self, msg, receiveTime):
+        """
+        Map the adapter timestamp of a frame to the host monotonic clock
+        @param msg: TCanMsg
+        @param receiveTime: host monotonic time of the read
+        @return: host monotonic time of the frame
+        """
+        deviceTime = msg.Sec + msg.USec * 1e-6
+        if not deviceTime:
+            return receiveTime
+        offset = receiveTime - deviceTime
+        if self.offset is None or offset < self.offset:
+            self.offset = offset
+        return deviceTime + self.offset
+
+    def run(self):
+        canDriver = self.canDriver
+        index = canDriver.Index
+        while not self.stopped.is_set():
+            pollStart = time.monotonic()
+            watermark = pollStart
+            count = canDriver._CanReceiveGetCount(index)
+            if count > 0:
+                msgs = canDriver._CanReceive(index, min(count, self.maxCount))
+                receiveTime = time.monotonic()
+                if isinstance(msgs, int) or not len(msgs):
+                    watermark = self.watermark # nothing read, the FIFO is not drained
+                else:
+                    busName = self.busName
+                    for msg in msgs:
+                        self.sequence += 1
+                        t = self.hostTime(msg, receiveTime)
+                        self.frames.append((t, self.sequence, busName, msg))
+                        self.received += 1
+                    if len(msgs) < count:
+                        # the rest is still in the FIFO, only the frames read are complete
+                        watermark = min(pollStart, max(self.watermark, t))
+            self.watermark = watermark
+            if self.wakeup:
+                self.wakeup.set()
+            if count <= 0:
+                self.stopped.wait(self.pollTime)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class CaptureManager:
+    """
+    One ReceiveWorker per device and a merge of their frames by timestamp
+    """
+    def __init__(self, canDrivers, pollTime=0.01):
+        """
+        Class Constructor
+        @param canDrivers: dictionary of name: opened MhsTinyCanDriver
+        @param pollTime: seconds the workers sleep if their FIFO was empty
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.wakeup = threading.Event()
+        self.workers = []
+        for name in sorted(canDrivers):
+            worker = ReceiveWorker(name, canDrivers[name], pollTime=pollTime)
+            worker.wakeup = self.wakeup
+            self.workers.append(worker)
+        self.heap = []
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join()
+
+    def read(self, timeout=None):
+        """
+        Get the next frames of all devices in timestamp order
+        @param timeout: seconds to wait for frames, None to wait forever
+        @return: list of (host monotonic time, name, TCanMsg), empty on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        heap = self.heap
+        while True:
+            self.wakeup.clear()
+            for worker in self.workers:
+                frames = worker.frames
+                while frames:
+                    heapq.heappush(heap, frames.popleft())
+            watermark = min(worker.watermark for worker in self.workers)
+            result = []
+            while heap and heap[0][0] <= watermark:
+                t, seq, name, msg = heapq.heappop(heap)
+                result.append((t, name, msg))
+            if result:
+                return result
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return result
+            self.wakeup.wait(remaining)
+
+    def flush(self):
+        """
+        Get all remaining frames after stop()
+        @return: list of (host monotonic time, name, TCanMsg)
+        """
+        for worker in self.workers:
+            while worker.frames:
+                heapq.heappush(self.heap, worker.frames.popleft())
+        result = []
+        while self.heap:
+            t, seq, name, msg = heapq.heappop(self.heap)
+            result.append((t, name, msg))
+        return result
+
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+    import mhsTinyCanDriver
+
+    parser = OptionParser('usage: %prog [options]')
+    parser.add_option('-S', action='store', type='string', dest='devices', metavar='SNR=NAME,...',
+                      help='serial numbers and bus names of the devices', default=None)
+    parser.add_option('-b', action='store', type='int', dest='bitrate', metavar='KBIT',
+                      help='can bitrate in kBit/s, default = 250', default=250)
+    parser.add_option('-o', action='store', type='string', dest='logfile', metavar='FILE',
+                      help='log file, default = CANlog.txt', default='CANlog.txt')
+    (options, args) = parser.parse_args()
+    if not options.devices:
+        parser.error('no devices given')
+
+    canDrivers = {}
+    for device in options.devices.split(','):
+        snr, name = device.split('=')
+        canDrivers[name] = mhsTinyCanDriver.MhsTinyCanDriver(0, options = {'CanRxDMode':1,
+                                                                           'AutoConnect':1,
+                                                                           'TimeStampMode':1,
+                                                                           'CanSpeed1':options.bitrate}, snr=snr)
+    manager = CaptureManager(canDrivers)
+    log = open(options.logfile, 'w')
+    manager.start()
+    try:
+        while True:
+            for t, name, msg in manager.read(timeout=1.0):
+                log.write('{0:.6f} {1} ID:{2:08x}, DLC:{3}, Data:{4}\n'.format(t, name, msg.Id, msg.Flags.FlagBits.DLC, [hex(x) for x in msg.Data]))
+    except KeyboardInterrupt:
+        pass
+    manager.stop()
+    for t, name, msg in manager.flush():
+        log.write('{0:.6f} {1} ID:{2:08x}, DLC:{3}, Data:{4}\n'.format(t, name, msg.Id, msg.Flags.FlagBits.DLC, [hex(x) for x in msg.Data]))
+    log.close()
+    for canDriver in canDrivers.values():
+        canDriver.shutdown()
+    print('done')
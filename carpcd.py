@@ -0,0 +1,259 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: carpcd.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Supervisor of the CarPC, replaces the three @reboot cron jobs.
+#     Acquisition stages (IMU/GPS logger, CAN logger) run all the time and
+#     are restarted if they exit. Background stages (compression by
+#     archiver.py, storage by store.sh) run periodically with the lowest
+#     CPU priority (nice 19) and the idle I/O class (ionice -c 3), so they
+#     only get the CPU and the SD card when the loggers do not need them.
+#     Storage runs after each compression run instead of after a fixed
+#     sleep.
+#     The background stages follow loadwatch.LoadGovernor: they are
+#     stopped (SIGSTOP) while the CPU, the SD card or the CAN logger FIFO
+#     are over their limits and run more often while the vehicle is idle.
+#     The supervisor's metrics are on http://127.0.0.1:9106/metrics.
+#
+# Usage
+#     python carpcd.py [options]
+#     SIGTERM or Ctrl-C stops all stages, the loggers get SIGINT first
+#     to close their files.
+#
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import time
+import shlex
+import shutil
+import signal
+import subprocess
+import uselogging
+import metrics
+import loadwatch
+
+BACKGROUND_NICE = 19
+STOP_TIMEOUT = 10.0 # seconds a stage gets to exit after SIGINT
+
+
+class ProcessStage:
+    """
+    One pipeline stage running as a subprocess
+    """
+    def __init__(self, name, args, nice=0, idleIo=False, cwd=None):
+        """
+        Class Constructor
+        @param name: name of the stage in the log
+        @param args: command line as list
+        @param nice: niceness added to the process
+        @param idleIo: run in the idle I/O scheduling class
+        @param cwd: working directory, the current directory if None
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.name = name
+        self.args = list(args)
+        self.nice = nice
+        self.idleIo = idleIo
+        self.cwd = cwd
+        self.process = None
+        self.starts = 0
+        self.lastStart = None
+        self.lastExit = None
+
+    def commandLine(self):
+        args = self.args
+        if self.idleIo and shutil.which('ionice'):
+            args = ['ionice', '-c', '3'] + args
+        return args
+
+    def preexec(self):
+        if self.nice:
+            os.nice(self.nice)
+
+    def start(self):
+        self.logger.info('Start {0}: {1}'.format(self.name, ' '.join(self.args)))
+        try:
+            self.process = subprocess.Popen(self.commandLine(), cwd=self.cwd, preexec_fn=self.preexec)
+        except OSError as e:
+            self.logger.error('Could not start {0}: {1}'.format(self.name, e))
+            self.process = None
+            self.lastExit = -1
+        self.starts += 1
+        self.lastStart = time.monotonic()
+
+    def running(self):
+        if self.process is None:
+            return False
+        returncode = self.process.poll()
+        if returncode is None:
+            return True
+        self.logger.info('{0} exited with {1}'.format(self.name, returncode))
+        self.lastExit = returncode
+        self.process = None
+        return False
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """
+        Stop the process, SIGINT first so the loggers can close their files
+        @param timeout: seconds to wait before SIGKILL
+        @return: Nothing
+        """
+        if not self.running():
+            return
+        self.process.send_signal(signal.SIGCONT) # in case it is paused
+        self.process.send_signal(signal.SIGINT)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.logger.error('{0} did not stop, killed'.format(self.name))
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
+class AcquisitionStage(ProcessStage):
+    """
+    Logger running all the time, restarted after restartDelay if it exits
+    """
+    def __init__(self, name, args, restartDelay=5.0, **kwargs):
+        ProcessStage.__init__(self, name, args, **kwargs)
+        self.restartDelay = restartDelay
+
+    def step(self, now, state=None):
+        if self.running():
+            return
+        if self.lastStart is None or now - self.lastStart >= self.restartDelay:
+            self.start()
+
+
+class BackgroundStage(ProcessStage):
+    """
+    Job started every interval seconds at low priority, never twice at a time,
+    paused while the load governor says so
+    """
+    def __init__(self, name, args, interval, then=None, idleInterval=None, nice=BACKGROUND_NICE, idleIo=True, **kwargs):
+        """
+        Class Constructor
+        @param interval: seconds between the starts
+        @param then: stage started after each successful run of this one
+        @param idleInterval: seconds between the starts while the system is idle, interval if None
+        @return: nothing
+        """
+        ProcessStage.__init__(self, name, args, nice=nice, idleIo=idleIo, **kwargs)
+        self.interval = interval
+        self.idleInterval = idleInterval if idleInterval is not None else interval
+        self.then = then
+        self.triggered = False
+        self.paused = False
+
+    def trigger(self):
+        self.triggered = True
+
+    def pause(self, paused):
+        if paused != self.paused:
+            self.process.send_signal(signal.SIGSTOP if paused else signal.SIGCONT)
+            self.paused = paused
+
+    def step(self, now, state=loadwatch.THROTTLE):
+        if self.process is not None:
+            if self.running():
+                self.pause(state == loadwatch.PAUSE)
+                return
+            self.paused = False
+            if self.lastExit == 0 and self.then is not None:
+                self.then.trigger()
+        if state == loadwatch.PAUSE:
+            return
+        interval = self.idleInterval if state == loadwatch.RUN else self.interval
+        if self.triggered or (interval and (self.lastStart is None or now - self.lastStart >= interval)):
+            self.triggered = False
+            self.start()
+
+
+class Supervisor:
+    """
+    Runs the stages until stopped
+    """
+    def __init__(self, stages, governor=None, tick=1.0):
+        self.logger = uselogging.getLogger()
+        self.stages = stages
+        self.governor = governor
+        self.tick = tick
+        self.stopped = False
+
+    def stop(self, *args):
+        self.stopped = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        try:
+            while not self.stopped:
+                now = time.monotonic()
+                state = self.governor.decide() if self.governor else loadwatch.THROTTLE
+                for stage in self.stages:
+                    stage.step(now, state)
+                time.sleep(self.tick)
+        except KeyboardInterrupt:
+            pass
+        for stage in self.stages:
+            stage.stop()
+
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+
+    parser = OptionParser('usage: %prog [options]')
+    parser.add_option('--imu', action='store', type='string', dest='imu', metavar='CMD',
+                      help='IMU/GPS logger, empty to disable, default = "python logAccPos.pyc"', default='python logAccPos.pyc')
+    parser.add_option('--can', action='store', type='string', dest='can', metavar='CMD',
+                      help='CAN logger, empty to disable, default = "python3 canpi.py"', default='python3 canpi.py')
+    parser.add_option('--store', action='store', type='string', dest='store', metavar='CMD',
+                      help='storage job after each compression run, empty to disable, default = "./store.sh"', default='./store.sh')
+    parser.add_option('-i', action='store', type='float', dest='interval', metavar='SECONDS',
+                      help='seconds between the compression runs, default = 300', default=300.0)
+    parser.add_option('--idle-interval', action='store', type='float', dest='idleinterval', metavar='SECONDS',
+                      help='seconds between the compression runs while idle, default = 30', default=30.0)
+    parser.add_option('--max-load', action='store', type='float', dest='maxload', metavar='LOAD',
+                      help='load average that pauses the background work, default = 0.75 per CPU', default=None)
+    parser.add_option('--max-disk-busy', action='store', type='float', dest='maxdiskbusy', metavar='FRACTION',
+                      help='SD card busy fraction that pauses the background work, default = 0.5', default=0.5)
+    (options, args) = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(sys.argv[0])))
+
+    stages = []
+    if options.imu:
+        stages.append(AcquisitionStage('imu', shlex.split(options.imu)))
+    if options.can:
+        stages.append(AcquisitionStage('can', shlex.split(options.can)))
+    store = None
+    if options.store:
+        store = BackgroundStage('store', shlex.split(options.store), interval=0)
+    stages.append(BackgroundStage('archive', [sys.executable, 'archiver.py', '-s'], interval=options.interval,
+                                  idleInterval=options.idleinterval, then=store))
+    if store is not None:
+        stages.append(store)
+
+    governor = loadwatch.LoadGovernor(maxLoad=options.maxload, maxDiskBusy=options.maxdiskbusy,
+                                      metricsUrl=loadwatch.LOGGER_METRICS_URL if options.can else None)
+    metrics.StartHttpServer(metrics.DEFAULT_PORT + 1)
+    Supervisor(stages, governor).run()
+    print('done')
@@ -0,0 +1,342 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: compression.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Compression codecs of the archiving paths (archiver.py, the log
+#     rotation of uselogging).
+#     stored, deflate and bzip2 are written as zip archives, lzma, zstd
+#     and lz4 (only if the zstandard / lz4 packages are installed) as
+#     single compressed streams <name>.csv.xz / <name>.csv.zst /
+#     <name>.csv.lz4. zipfile ignores the level for ZIP_LZMA, the xz
+#     stream keeps the preset.
+#     The benchmark compresses a sample of DataLogs/ with every codec and
+#     level and picks the one with the best ratio that is still fast
+#     enough for the CPU budget. The choice is saved to
+#     DataLogs/codec.json and used by archiver.py -c auto.
+#
+# Usage
+#     >>> codec = compression.GetCodec('lzma:1')
+#     >>> WriteArchive(codec, ArchiveName('x-Data.csv', codec), 'x-Data.csv', FileChunks('x-Data.csv'))
+#
+#     python compression.py [-m MB/s] [-w] [datadir]
+#
+# ----------------------------------------------------------------------
+
+import os
+import bz2
+import json
+import lzma
+import time
+import zlib
+import zipfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+DEFAULT_CODEC = 'deflate'
+CHOICE_FILE = 'codec.json'
+CHUNK_SIZE = 1024 * 1024
+
+
+class Codec:
+    """
+    One compression method at one level
+    """
+    def __init__(self, name, level, zipMethod=None, suffix='.zip', compress=None, decompress=None, open=None):
+        """
+        Class Constructor
+        @param name: name of the codec
+        @param level: compression level, None for the default
+        @param zipMethod: zipfile compression type, None for stream codecs
+        @param suffix: file name suffix of the archives
+        @param compress: function(data, level) -> compressed bytes
+        @param decompress: function(data) -> bytes
+        @param open: function(fileName, mode, level) -> file object, stream codecs only
+        @return: nothing
+        """
+        self.name = name
+        self.level = level
+        self.zipMethod = zipMethod
+        self.suffix = suffix
+        self.compressFunction = compress
+        self.decompress = decompress
+        self.openFunction = open
+
+    def compress(self, data):
+        return self.compressFunction(data, self.level)
+
+    def open(self, fileName, mode='rb'):
+        return self.openFunction(fileName, mode, self.level)
+
+    def __str__(self):
+        return self.name if self.level is None else '{0}:{1}'.format(self.name, self.level)
+
+
+def _lzmaOpen(fileName, mode, level):
+    if 'r' in mode:
+        return lzma.open(fileName, mode)
+    return lzma.open(fileName, mode, preset=level)
+
+
+def _zstdOpen(fileName, mode, level):
+    if 'r' in mode:
+        return zstandard.open(fileName, mode)
+    return zstandard.open(fileName, mode, cctx=zstandard.ZstdCompressor(level=level or 3))
+
+
+def _lz4Open(fileName, mode, level):
+    if 'r' in mode:
+        return lz4.frame.open(fileName, mode)
+    return lz4.frame.open(fileName, mode, compression_level=level or 0)
+
+
+# name: (zip method, suffix, compress function, decompress function, open function, levels for the benchmark)
+CODECS = {
+    'stored':  (zipfile.ZIP_STORED, '.zip', lambda data, level: data, bytes, None, [None]),
+    'deflate': (zipfile.ZIP_DEFLATED, '.zip', lambda data, level: zlib.compress(data, 6 if level is None else level),
+                zlib.decompress, None, [1, 6, 9]),
+    'bzip2':   (zipfile.ZIP_BZIP2, '.zip', lambda data, level: bz2.compress(data, level or 9), bz2.decompress, None, [1, 9]),
+    'lzma':    (None, '.xz', lambda data, level: lzma.compress(data, preset=level), lzma.decompress, _lzmaOpen, [0, 1, 6]),
+}
+if zstandard is not None:
+    CODECS['zstd'] = (None, '.zst', lambda data, level: zstandard.ZstdCompressor(level=level or 3).compress(data),
+                      lambda data: zstandard.ZstdDecompressor().decompress(data), _zstdOpen, [1, 3, 9, 19])
+if lz4 is not None:
+    CODECS['lz4'] = (None, '.lz4', lambda data, level: lz4.frame.compress(data, compression_level=level or 0),
+                     lz4.frame.decompress, _lz4Open, [0, 9])
+
+
+def GetCodec(spec=DEFAULT_CODEC):
+    """
+    Codec by name
+    @param spec: name or name:level, e.g. 'lzma:1'
+    @return: Codec
+    """
+    name, _, level = spec.partition(':')
+    if name not in CODECS:
+        raise ValueError('Codec {0} not available, one of {1}'.format(name, ', '.join(sorted(CODECS))))
+    zipMethod, suffix, compress, decompress, open, levels = CODECS[name]
+    return Codec(name, int(level) if level else None, zipMethod, suffix, compress, decompress, open)
+
+
+def LoadCodecChoice(dataDir):
+    """
+    Codec chosen by the last benchmark
+    @param dataDir: directory of the logs
+    @return: Codec, the default codec if there is no choice or it is not available
+    """
+    try:
+        with open(os.path.join(dataDir, CHOICE_FILE)) as f:
+            return GetCodec(json.load(f)['codec'])
+    except (OSError, ValueError, KeyError):
+        return GetCodec(DEFAULT_CODEC)
+
+
+def ArchiveName(fileName, codec):
+    """
+    Archive of a log file
+    @return: <name>.zip for zip codecs, <name>.csv.zst etc. for stream codecs
+    """
+    base = os.path.splitext(fileName)[0]
+    if codec.zipMethod is not None:
+        return base + '.zip'
+    return base + '.csv' + codec.suffix
+
+
+# suffixes of the stream archives of all codecs, also the ones whose package is not installed here
+STREAM_SUFFIXES = ('.xz', '.zst', '.lz4')
+
+
+def ArchiveNames(fileName):
+    """
+    Names the archive of a log file has under any codec
+    @return: list of <name>.zip and <name>.csv.xz etc.
+    """
+    base = os.path.splitext(fileName)[0]
+    return [base + '.zip'] + [base + '.csv' + suffix for suffix in STREAM_SUFFIXES]
+
+
+def FindArchive(fileName):
+    """
+    Existing archive of a log file, whatever codec wrote it
+    @return: archive name, None if the file is not archived
+    """
+    for archiveName in ArchiveNames(fileName):
+        if os.path.exists(archiveName):
+            return archiveName
+    return None
+
+
+def IsArchive(fileName):
+    return fileName.endswith('.zip') or any(fileName.endswith('.csv' + suffix) for suffix in STREAM_SUFFIXES)
+
+
+def FileChunks(fileName, size=CHUNK_SIZE):
+    with open(fileName, 'rb') as f:
+        while True:
+            data = f.read(size)
+            if not data:
+                return
+            yield data
+
+
+def WriteArchive(codec, archiveName, memberName, chunks):
+    """
+    Write an archive with one member, through a temporary file so there is no half written archive
+    @param codec: Codec
+    @param archiveName: file name of the archive
+    @param memberName: name of the file in a zip archive, ignored by stream codecs
+    @param chunks: iterable of bytes
+    @return: Nothing
+    """
+    tmpFileName = archiveName + '.tmp'
+    if codec.zipMethod is not None:
+        with zipfile.ZipFile(tmpFileName, mode='w', compression=codec.zipMethod, compresslevel=codec.level) as z:
+            with z.open(memberName, 'w') as f:
+                for data in chunks:
+                    f.write(data)
+    else:
+        with codec.open(tmpFileName, 'wb') as f:
+            for data in chunks:
+                f.write(data)
+    os.replace(tmpFileName, archiveName)
+
+
+def OpenArchive(archiveName):
+    """
+    csv files of an archive
+    @param archiveName: zip archive or compressed stream
+    @return: generator of (member name, binary file object)
+    """
+    if archiveName.endswith('.zip'):
+        with zipfile.ZipFile(archiveName) as z:
+            for member in z.namelist():
+                if member.endswith('.csv'):
+                    with z.open(member) as f:
+                        yield member, f
+        return
+    for name in CODECS:
+        codec = GetCodec(name)
+        if codec.zipMethod is None and archiveName.endswith(codec.suffix):
+            with codec.open(archiveName, 'rb') as f:
+                yield os.path.basename(archiveName)[:-len(codec.suffix)], f
+            return
+    raise ValueError('Unknown archive type of {0}'.format(archiveName))
+
+
+# --------------------------------------------------------------------
+# ------------------ Benchmark ---------------------------------------
+# --------------------------------------------------------------------
+
+def SampleDataLogs(dataDir, maxBytes=4 * CHUNK_SIZE):
+    """
+    Sample of our own logs, from the csv files or the archives
+    @param dataDir: directory of the logs
+    @param maxBytes: size of the sample
+    @return: bytes
+    """
+    sample = []
+    size = 0
+    for root, dirs, files in os.walk(dataDir):
+        for name in sorted(files):
+            fileName = os.path.join(root, name)
+            if name.endswith('.csv'):
+                with open(fileName, 'rb') as f:
+                    data = f.read(maxBytes - size)
+            elif IsArchive(name):
+                data = b''
+                for member, f in OpenArchive(fileName):
+                    data = f.read(maxBytes - size)
+                    break
+            else:
+                continue
+            sample.append(data)
+            size += len(data)
+            if size >= maxBytes:
+                return b''.join(sample)
+    return b''.join(sample)
+
+
+def Benchmark(sample, minTime=0.2):
+    """
+    Compress the sample with every codec and level
+    @param sample: bytes
+    @param minTime: seconds each codec runs at least
+    @return: list of (codec spec, MB/s, ratio)
+    """
+    results = []
+    for name in sorted(CODECS):
+        for level in CODECS[name][5]:
+            codec = GetCodec(name if level is None else '{0}:{1}'.format(name, level))
+            runs = 0
+            start = time.perf_counter()
+            while True:
+                compressed = codec.compress(sample)
+                runs += 1
+                elapsed = time.perf_counter() - start
+                if elapsed >= minTime:
+                    break
+            speed = len(sample) * runs / elapsed / 1e6
+            results.append((str(codec), speed, len(sample) / max(1, len(compressed))))
+    return results
+
+
+def ChooseCodec(results, minSpeed):
+    """
+    Best ratio of the codecs fast enough
+    @param results: result of Benchmark
+    @param minSpeed: MB/s the codec has to reach within the CPU budget
+    @return: codec spec, the fastest one if none is fast enough
+    """
+    fast = [r for r in results if r[1] >= minSpeed]
+    if not fast:
+        return max(results, key=lambda r: r[1])[0]
+    return max(fast, key=lambda r: r[2])[0]
+
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+
+    parser = OptionParser('usage: %prog [options] [datadir]')
+    parser.add_option('-m', action='store', type='float', dest='minspeed', metavar='MB/S',
+                      help='compression speed needed within the CPU budget, default = 2.0', default=2.0)
+    parser.add_option('-w', action='store_true', dest='write',
+                      help='save the choice to datadir/' + CHOICE_FILE, default=False)
+    (options, args) = parser.parse_args()
+
+    dataDir = args[0] if args else os.path.join(os.curdir, 'DataLogs')
+    sample = SampleDataLogs(dataDir)
+    if not sample:
+        parser.error('no log files in {0}'.format(dataDir))
+    print('Sample of {0} bytes'.format(len(sample)))
+    results = Benchmark(sample)
+    for spec, speed, ratio in results:
+        print('{0:<12} {1:8.1f} MB/s  ratio {2:5.2f}'.format(spec, speed, ratio))
+    choice = ChooseCodec(results, options.minspeed)
+    print('Chosen: {0}'.format(choice))
+    if options.write:
+        with open(os.path.join(dataDir, CHOICE_FILE), 'w') as f:
+            json.dump({'codec':choice, 'minSpeed':options.minspeed, 'results':results}, f, indent=1)
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: framedlog.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Append-only log file format that survives power loss.
+#     The file starts with FILE_MAGIC, followed by blocks:
+#         magic (2 bytes), payload length (4 bytes), crc32 of the payload
+#         (4 bytes), payload
+#     all little endian. A block holds whole records (lines) and is
+#     written by a single write() call.
+#     A power loss can only damage the end of the file: a partial block
+#     or a tail of NUL bytes. Recover() walks the block headers (seeks, no
+#     reading of the payloads), then checks the checksums from the end
+#     backwards and truncates the file after the last valid block.
+#
+# Usage
+#     >>> log = framedlog.FramedLogWriter('DataLogs/x-Data.cpfl')
+#     >>> log.writeLines(['a,b,c\n', '1,2,3\n'])
+#     >>> log.poll()      # from the poll loop, writes records older than flushInterval
+#     >>> log.close()
+#     >>> for line in framedlog.ReadLines('DataLogs/x-Data.cpfl'): ...
+#
+#     python framedlog.py -r file.cpfl      (recover)
+#     python framedlog.py file.cpfl > x.csv (convert to text)
+#
+# ----------------------------------------------------------------------
+
+import os
+import time
+import zlib
+import struct
+import uselogging
+
+FILE_MAGIC = b'CPFLOG\x01\n'
+FRAMED_SUFFIX = '.cpfl'
+BLOCK_MAGIC = 0xB10C
+BLOCK_HEADER = struct.Struct('<HII')
+BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 64 * 1024 * 1024 # larger lengths are damaged headers
+
+
+def ScanBlocks(f, fileSize):
+    """
+    Walk the block headers without reading the payloads
+    @param f: file opened in binary mode
+    @param fileSize: size of the file
+    @return: list of (offset, length, crc) of the blocks with a plausible header
+    """
+    blocks = []
+    offset = len(FILE_MAGIC)
+    f.seek(offset)
+    while offset + BLOCK_HEADER.size <= fileSize:
+        header = f.read(BLOCK_HEADER.size)
+        magic, length, crc = BLOCK_HEADER.unpack(header)
+        end = offset + BLOCK_HEADER.size + length
+        if magic != BLOCK_MAGIC or length > MAX_BLOCK_SIZE or end > fileSize:
+            break
+        blocks.append((offset, length, crc))
+        offset = end
+        f.seek(offset)
+    return blocks
+
+
+def Recover(fileName, truncate=True):
+    """
+    Find the end of the last valid block, only the damaged tail is read
+    @param fileName: framed log file
+    @param truncate: cut the file after the last valid block
+    @return: offset of the end of the valid data, 0 if the file is not a framed log
+    """
+    fileSize = os.path.getsize(fileName)
+    with open(fileName, 'rb') as f:
+        if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            return 0
+        blocks = ScanBlocks(f, fileSize)
+        while blocks:
+            offset, length, crc = blocks[-1]
+            f.seek(offset + BLOCK_HEADER.size)
+            if zlib.crc32(f.read(length)) == crc:
+                break
+            blocks.pop()
+    end = blocks[-1][0] + BLOCK_HEADER.size + blocks[-1][1] if blocks else len(FILE_MAGIC)
+    if truncate and end < fileSize:
+        uselogging.getLogger().info('Recovered {0}: {1} damaged bytes cut off'.format(fileName, fileSize - end))
+        with open(fileName, 'r+b') as f:
+            f.truncate(end)
+    return end
+
+
+def ReadBlocks(fileName, verify=True):
+    """
+    Payloads of all valid blocks, stops at the first damaged block
+    @param fileName: framed log file
+    @param verify: check the checksums
+    @return: generator of bytes
+    """
+    with open(fileName, 'rb') as f:
+        if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError('{0} is not a framed log file'.format(fileName))
+        while True:
+            header = f.read(BLOCK_HEADER.size)
+            if len(header) < BLOCK_HEADER.size:
+                return
+            magic, length, crc = BLOCK_HEADER.unpack(header)
+            if magic != BLOCK_MAGIC or length > MAX_BLOCK_SIZE:
+                return
+            payload = f.read(length)
+            if len(payload) < length or (verify and zlib.crc32(payload) != crc):
+                return
+            yield payload
+
+
+def ReadLines(fileName, verify=True):
+    """
+    Text lines of all valid blocks
+    @return: generator of strings including the line end
+    """
+    for payload in ReadBlocks(fileName, verify):
+        for line in payload.decode().splitlines(True):
+            yield line
+
+
+class FramedLogWriter:
+    """
+    Buffers records and appends them as checksummed blocks
+    """
+    def __init__(self, fileName, blockSize=BLOCK_SIZE, flushInterval=1.0, sync=False):
+        """
+        Class Constructor, an existing file is recovered and appended to
+        @param fileName: framed log file
+        @param blockSize: payload bytes that trigger a block write
+        @param flushInterval: seconds a record may stay in the buffer, see poll()
+        @param sync: fsync after every block
+        @return: nothing
+        """
+        self.fileName = fileName
+        self.blockSize = blockSize
+        self.flushInterval = flushInterval
+        self.sync = sync
+        self.buffer = []
+        self.buffered = 0
+        self.bufferStart = None # time the oldest buffered record came
+        self.blocks = 0
+        if os.path.exists(fileName) and os.path.getsize(fileName):
+            self.offset = Recover(fileName)
+            if not self.offset:
+                raise ValueError('{0} is not a framed log file'.format(fileName))
+            self.fd = os.open(fileName, os.O_WRONLY | os.O_APPEND)
+        else:
+            self.fd = os.open(fileName, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            os.write(self.fd, FILE_MAGIC)
+            self.offset = len(FILE_MAGIC)
+
+    def write(self, record):
+        """
+        Add one record
+        @param record: bytes or string, including its line end
+        @return: Nothing
+        """
+        if isinstance(record, str):
+            record = record.encode()
+        now = time.monotonic()
+        if not self.buffer:
+            self.bufferStart = now
+        self.buffer.append(record)
+        self.buffered += len(record)
+        if self.buffered >= self.blockSize or now - self.bufferStart >= self.flushInterval:
+            self.flush()
+
+    def writeLines(self, lines):
+        """
+        Add several text records at once
+        @param lines: strings including their line ends
+        @return: Nothing
+        """
+        if lines:
+            self.write(''.join(lines))
+
+    def poll(self):
+        """
+        Write the buffered records if the oldest one is flushInterval seconds old, so a quiet
+        bus does not keep them in memory. Call it regularly, e.g. every poll of the driver.
+        @return: Nothing
+        """
+        if self.buffer and time.monotonic() - self.bufferStart >= self.flushInterval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records as one block
+        @return: Nothing
+        """
+        if not self.buffer:
+            return
+        payload = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.bufferStart = None
+        os.write(self.fd, BLOCK_HEADER.pack(BLOCK_MAGIC, len(payload), zlib.crc32(payload)) + payload)
+        self.offset += BLOCK_HEADER.size + len(payload)
+        self.blocks += 1
+        if self.sync:
+            os.fsync(self.fd)
+
+    def tell(self):
+        """
+        @return: file offset of the next block
+        """
+        return self.offset
+
+    def close(self):
+        if self.fd is not None:
+            self.flush()
+            os.close(self.fd)
+            self.fd = None
+
+
+if __name__ == '__main__':
+
+    import sys
+    from optparse import OptionParser
+
+    parser = OptionParser('usage: %prog [options] file')
+    parser.add_option('-r', action='store_true', dest='recover',
+                      help='cut off a damaged end of the file instead of printing it', default=False)
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error('incorrect number of arguments')
+
+    if options.recover:
+        print('{0} valid bytes'.format(Recover(args[0])))
+    else:
+        for line in ReadLines(args[0]):
+            sys.stdout.write(line)
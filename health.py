@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: health.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Health monitoring of the receive FIFO while logging.
+#     FifoHealthMonitor takes the FIFO fill level the poll loop reads anyway
+#     (_CanReceiveGetCount) and queries _CanGetDeviceStatus only every
+#     statusInterval seconds or when the FIFO is nearly full. Overruns are
+#     counted and cleared, lost frames are estimated from the frame rate.
+#     AdaptivePoller chooses the sleep time and read batch size of the
+#     next poll so the FIFO stays at targetFill: polls are rare while the
+#     bus is quiet and frequent under load.
+#
+# Usage
+#     >>> monitor = health.FifoHealthMonitor(canDriver)
+#     >>> poller = health.AdaptivePoller(monitor.fifoSize)
+#     >>> count = canDriver._CanReceiveGetCount(canDriver.Index)
+#     >>> monitor.sample(count)
+#     >>> sleep, batch = poller.next(count)
+#
+# ----------------------------------------------------------------------
+
+import time
+import uselogging
+from mhsTinyCanDriver import FIFO_STATUS_OVERRUN, CAN_STATUS_OK, CAN_STATUS_MODES, \
+                             OP_CAN_NO_CHANGE, CAN_CMD_RXD_OVERRUN_CLEAR
+
+DEFAULT_RX_FIFO_SIZE = 4096 # tinyCAN default if CanRxDFifoSize is not set
+
+
+class FifoHealthMonitor:
+    """
+    Counts FIFO overruns, estimated lost frames and CAN status changes
+    """
+    def __init__(self, canDriver, index=None, statusInterval=1.0, nearlyFull=0.9):
+        """
+        Class Constructor
+        @param canDriver: opened MhsTinyCanDriver
+        @param index: FIFO index, the driver index if None
+        @param statusInterval: seconds between the device status queries
+        @param nearlyFull: fill level (0..1) that triggers a status query right away
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.canDriver = canDriver
+        self.index = index if index is not None else canDriver.Index
+        self.fifoSize = canDriver.Options.get('CanRxDFifoSize') or DEFAULT_RX_FIFO_SIZE
+        self.statusInterval = statusInterval
+        self.nearlyFull = int(self.fifoSize * nearlyFull)
+        self.lastStatus = 0.0
+        self.lastSample = None
+        self.lastCount = 0
+        self.rate = 0.0 # frames per second, smoothed
+        self.maxFill = 0
+        self.overruns = 0
+        self.lostFrames = 0
+        self.canStatus = CAN_STATUS_OK
+        self.canStatusChanges = 0
+        self.statusQueries = 0
+
+    def sample(self, count, received=None):
+        """
+        Feed the fill level of a poll, queries the device status if due
+        @param count: result of _CanReceiveGetCount
+        @param received: frames read since the last sample, count of the last sample if None
+        @return: True if an overrun was detected
+        """
+        now = time.monotonic()
+        if count < 0:
+            return False
+        if self.lastSample is not None:
+            dt = now - self.lastSample
+            if dt > 0:
+                if received is None:
+                    received = self.lastCount
+                # frames that arrived since the last sample, the last fill level was read meanwhile
+                arrived = count + received - self.lastCount
+                self.rate += 0.2 * (max(0, arrived) / dt - self.rate)
+        self.lastSample = now
+        self.lastCount = count
+        if count > self.maxFill:
+            self.maxFill = count
+        if count >= self.nearlyFull or now - self.lastStatus >= self.statusInterval:
+            return self.checkStatus(now)
+        return False
+
+    def checkStatus(self, now=None):
+        """
+        Query the device status, count and clear an overrun
+        @return: True if an overrun was detected
+        """
+        if now is None:
+            now = time.monotonic()
+        dtSinceStatus = now - self.lastStatus if self.lastStatus else 0.0
+        self.lastStatus = now
+        self.statusQueries += 1
+        err, drvStatus, canStatus, fifoStatus = self.canDriver._CanGetDeviceStatus(self.index)
+        if err < 0:
+            return False
+        if canStatus != self.canStatus:
+            self.canStatusChanges += 1
+            self.logger.error('CAN status changed to {0}'.format(CAN_STATUS_MODES.get(canStatus, canStatus)))
+            self.canStatus = canStatus
+        if fifoStatus & FIFO_STATUS_OVERRUN:
+            self.overruns += 1
+            # estimate: frames arriving while the FIFO was full, at most the whole interval
+            lost = int(self.rate * dtSinceStatus) - (self.fifoSize - self.maxFill)
+            self.lostFrames += max(1, lost)
+            self.logger.error('FIFO overrun #{0}, about {1} frames lost'.format(self.overruns, max(1, lost)))
+            self.canDriver._CanSetMode(self.index, OP_CAN_NO_CHANGE, CAN_CMD_RXD_OVERRUN_CLEAR)
+            self.maxFill = 0
+            return True
+        self.maxFill = 0
+        return False
+
+    def __str__(self):
+        return 'FIFO: {0:.0f} frames/s, {1} overruns, ~{2} frames lost, {3} CAN status changes, {4} status queries'.format(
+            self.rate, self.overruns, self.lostFrames, self.canStatusChanges, self.statusQueries)
+
+
+class AdaptivePoller:
+    """
+    Poll interval and batch size from the FIFO fill level
+    """
+    def __init__(self, fifoSize=DEFAULT_RX_FIFO_SIZE, targetFill=0.25, minPollTime=0.002, maxPollTime=0.5, maxBatch=1000):
+        """
+        Class Constructor
+        @param fifoSize: size of the receive FIFO
+        @param targetFill: fill level (0..1) the next poll should find
+        @param minPollTime: shortest sleep between polls in seconds
+        @param maxPollTime: longest sleep between polls in seconds
+        @param maxBatch: maximum number of frames read at once
+        @return: nothing
+        """
+        self.fifoSize = fifoSize
+        self.target = max(1, int(fifoSize * targetFill))
+        self.minPollTime = minPollTime
+        self.maxPollTime = maxPollTime
+        self.maxBatch = maxBatch
+        self.pollTime = maxPollTime
+        self.lastPoll = None
+
+    def next(self, count):
+        """
+        Sleep time and batch size after a poll that found count frames
+        @param count: result of _CanReceiveGetCount
+        @return: (seconds to sleep, number of frames to read now)
+        """
+        now = time.monotonic()
+        if self.lastPoll is not None and count > 0:
+            dt = now - self.lastPoll
+            rate = count / dt if dt > 0 else 0.0
+            if rate > 0:
+                self.pollTime = self.target / rate
+        elif count <= 0:
+            self.pollTime *= 2 # quiet bus, back off
+        self.pollTime = min(self.maxPollTime, max(self.minPollTime, self.pollTime))
+        self.lastPoll = now
+        batch = min(max(count, 0), self.maxBatch)
+        if count > self.maxBatch:
+            return 0.0, batch # more than one batch waiting, read again right away
+        return self.pollTime, batch
@@ -0,0 +1,583 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: isotp.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     ISO-TP (ISO 15765-2) transport on top of MhsTinyCanDriver, for UDS
+#     requests of more than 7 bytes. Receiving runs in the Rx batch event
+#     of the driver (CanSetRxBatchEvent): frames of the rx ID are
+#     reassembled there and flow control is answered right away, the
+#     sender waits for the flow control of the peer on an Event, there is
+#     no polling. Consecutive frames of a block are prepared in one
+#     TCanMsg array and handed to the driver in one CanTransmit call
+#     (STmin 0) or paced by STmin. Frames that do not fit into the
+#     transmit FIFO are handed over again once it has room.
+#     LoopbackBus connects two transports without hardware, its nodes
+#     have a transmit FIFO of limited size like the adapter. SimulatedEcu
+#     answers ReadDataByIdentifier with a payload of any size; both are
+#     used by the throughput benchmark.
+#
+# Usage
+#     >>> tp = isotp.IsoTpTransport(canDriver, txId=0x7E0, rxId=0x7E8)
+#     >>> tp.attach()
+#     >>> response = tp.request(bytes([0x22, 0xF1, 0x90]))
+#
+#     python isotp.py [-s SIZE] [-n COUNT] [-b KBIT] [-u]
+#
+# ----------------------------------------------------------------------
+
+import time
+import queue
+import threading
+from ctypes import memmove, memset, addressof, sizeof
+import uselogging
+from mhsTinyCanDriver import TCanMsg, TCANFlags
+
+# protocol control information, upper nibble of the first byte
+PCI_SINGLE = 0x00
+PCI_FIRST = 0x10
+PCI_CONSECUTIVE = 0x20
+PCI_FLOW_CONTROL = 0x30
+
+FC_CONTINUE = 0
+FC_WAIT = 1
+FC_OVERFLOW = 2
+
+MAX_LENGTH = 0xFFFFFFFF # first frames with more than 4095 bytes use the 32 bit length escape
+TIMEOUT = 1.0 # N_Bs / N_Cr in seconds
+MAX_WAIT_FRAMES = 10 # flow control WAIT frames accepted in a row
+TX_BATCH = 64 # consecutive frames per CanTransmit call
+TX_POLL = 0.0005 # seconds between the fill level polls of a full transmit FIFO
+LOOPBACK_TX_FIFO = 128 # transmit FIFO size of a LoopbackDriver
+
+DATA_OFFSET = TCanMsg.Data.offset
+
+
+def StMinSeconds(stMin):
+    """
+    Separation time of a flow control frame
+    @param stMin: 0x00-0x7F milliseconds, 0xF1-0xF9 100-900 microseconds
+    @return: seconds
+    """
+    if stMin <= 0x7F:
+        return stMin / 1000.0
+    if 0xF1 <= stMin <= 0xF9:
+        return (stMin - 0xF0) / 10000.0
+    return 0.127 # reserved values are to be treated as the maximum
+
+
+def SeparationSleep(deadline):
+    """
+    Wait until deadline, sleeps only for the part longer than a scheduler tick
+    """
+    remaining = deadline - time.monotonic()
+    if remaining > 0.002:
+        time.sleep(remaining - 0.001)
+    while time.monotonic() < deadline:
+        pass
+
+
+class IsoTpTransport:
+    """
+    One ISO-TP connection (normal addressing) between txId and rxId
+    """
+    def __init__(self, canDriver, txId, rxId, blockSize=0, stMin=0, padding=0xCC, timeout=TIMEOUT, txBatch=TX_BATCH, index=None):
+        """
+        Class Constructor
+        @param canDriver: opened MhsTinyCanDriver (or LoopbackDriver)
+        @param txId: CAN ID of the frames sent
+        @param rxId: CAN ID of the frames received
+        @param blockSize: block size announced to the peer, 0 = no further flow control
+        @param stMin: separation time announced to the peer, see StMinSeconds
+        @param padding: fill byte of frames shorter than 8 bytes, None to send them short
+        @param timeout: seconds to wait for flow control and consecutive frames
+        @param txBatch: consecutive frames per CanTransmit call, 1 to send them one by one
+        @param index: TIndex of the transmit FIFO, the Index of the driver if None
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.canDriver = canDriver
+        self.index = index if index is not None else canDriver.Index
+        self.txId = txId
+        self.rxId = rxId
+        self.blockSize = blockSize
+        self.stMin = stMin
+        self.padding = padding
+        self.timeout = timeout
+        self.txBatch = max(1, txBatch)
+        self.forward = None
+        flags = TCANFlags()
+        flags.FlagBits.DLC = 8
+        flags.FlagBits.TxD = 1
+        if txId > 0x7FF:
+            flags.FlagBits.EFF = 1
+        self.txFlags = flags.Uint32
+        self.txBuffer = (TCanMsg * self.txBatch)()
+        self.received = queue.Queue()
+        self.flowControl = None
+        self.flowControlEvent = threading.Event()
+        self.sendLock = threading.Lock()
+        # reassembly of the current segmented message
+        self.rxData = None
+        self.rxLength = 0
+        self.rxSequence = 0
+        self.rxBlock = 0
+        self.rxTime = 0.0
+        self.errors = 0
+
+    def attach(self, forward=None):
+        """
+        Receive through the Rx batch events of the driver
+        @param forward: handler(index, messages, count) of the previous user of the Rx events, gets all
+                        batches too (e.g. the logger)
+        @return: Error Code (0 = No Error)
+        """
+        self.forward = forward
+        return self.canDriver.CanSetRxBatchEvent(self.rxEvent)
+
+    # ----------------------------------------------------------------
+    # ---- Receive, runs on the driver thread ------------------------
+    # ----------------------------------------------------------------
+
+    def rxEvent(self, index, messages, count):
+        """
+        Rx batch event handler
+        @param index: Struct commonly used by the Tiny Can API
+        @param messages: TCanMsg buffer, valid for count entries, None if the FIFO has to be read
+        @param count: Number of Messages
+        @return: Nothing
+        """
+        if messages is None:
+            messages = self.canDriver._CanReceive(self.index, count)
+            if isinstance(messages, int):
+                return
+            count = len(messages)
+        rxId = self.rxId
+        for i in range(count):
+            msg = messages[i]
+            if msg.Id == rxId:
+                self.frame(bytes(msg.Data)[:msg.Flags.FlagBits.DLC])
+        if self.forward is not None:
+            self.forward(index, messages, count)
+
+    def frame(self, data):
+        """
+        Handle one frame of the rx ID
+        @param data: payload bytes of the frame
+        @return: Nothing
+        """
+        if not data:
+            return
+        pci = data[0] & 0xF0
+        if pci == PCI_CONSECUTIVE:
+            self.consecutiveFrame(data)
+        elif pci == PCI_FLOW_CONTROL:
+            if len(data) >= 3:
+                self.flowControl = (data[0] & 0x0F, data[1], data[2])
+                self.flowControlEvent.set()
+        elif pci == PCI_SINGLE:
+            length = data[0] & 0x0F
+            if 0 < length < len(data):
+                self.rxData = None
+                self.received.put(data[1:1 + length])
+        elif pci == PCI_FIRST:
+            length = ((data[0] & 0x0F) << 8) | data[1]
+            if length == 0 and len(data) >= 6:
+                length = int.from_bytes(data[2:6], 'big')
+                first = data[6:]
+            else:
+                first = data[2:]
+            if length <= 7:
+                return
+            if self.rxData is not None:
+                self.logger.warning('ISO-TP {0:x}: first frame during reception, restarted'.format(self.rxId))
+                self.errors += 1
+            self.rxData = bytearray(first)
+            self.rxLength = length
+            self.rxSequence = 1
+            self.rxBlock = 0
+            self.rxTime = time.monotonic()
+            self.sendFlowControl(FC_CONTINUE)
+
+    def consecutiveFrame(self, data):
+        if self.rxData is None:
+            return
+        now = time.monotonic()
+        if (data[0] & 0x0F) != self.rxSequence or now - self.rxTime > self.timeout:
+            self.logger.warning('ISO-TP {0:x}: sequence error or timeout, message dropped'.format(self.rxId))
+            self.errors += 1
+            self.rxData = None
+            return
+        self.rxTime = now
+        self.rxSequence = (self.rxSequence + 1) & 0x0F
+        rxData = self.rxData
+        rxData += data[1:]
+        if len(rxData) >= self.rxLength:
+            self.rxData = None
+            self.received.put(bytes(rxData[:self.rxLength]))
+            return
+        if self.blockSize:
+            self.rxBlock += 1
+            if self.rxBlock == self.blockSize:
+                self.rxBlock = 0
+                self.sendFlowControl(FC_CONTINUE)
+
+    def sendFlowControl(self, status):
+        self.sendFrame([PCI_FLOW_CONTROL | status, self.blockSize, self.stMin])
+
+    def sendFrame(self, data):
+        if self.padding is not None and len(data) < 8:
+            data = list(data) + [self.padding] * (8 - len(data))
+        flags = TCANFlags()
+        flags.Uint32 = self.txFlags
+        flags.FlagBits.DLC = len(data)
+        err = self.canDriver._CanTransmit(self.index, self.txId, list(data), flags.Uint32)
+        if err < 0:
+            raise RuntimeError('ISO-TP transmit Error-Code: {0}'.format(err))
+
+    # ----------------------------------------------------------------
+    # ---- Send ------------------------------------------------------
+    # ----------------------------------------------------------------
+
+    def send(self, payload):
+        """
+        Send one message, segmented if it does not fit into a single frame
+        @param payload: bytes
+        @return: Nothing
+        """
+        length = len(payload)
+        if length > MAX_LENGTH:
+            raise ValueError('ISO-TP messages are limited to {0} bytes'.format(MAX_LENGTH))
+        with self.sendLock:
+            if length <= 7:
+                self.sendFrame(bytes([PCI_SINGLE | length]) + bytes(payload))
+                return
+            payload = bytes(payload)
+            if length <= 0xFFF:
+                first = bytes([PCI_FIRST | (length >> 8), length & 0xFF]) + payload[:6]
+            else:
+                first = bytes([PCI_FIRST, 0]) + length.to_bytes(4, 'big') + payload[:2]
+            self.flowControlEvent.clear()
+            self.sendFrame(first)
+            self.sendConsecutive(memoryview(payload)[6 if length <= 0xFFF else 2:])
+
+    def waitFlowControl(self):
+        """
+        Wait for a flow control frame of the peer
+        @return: (block size, separation time in seconds)
+        """
+        for _ in range(MAX_WAIT_FRAMES + 1):
+            if not self.flowControlEvent.wait(self.timeout):
+                raise TimeoutError('ISO-TP {0:x}: no flow control'.format(self.txId))
+            self.flowControlEvent.clear()
+            status, blockSize, stMin = self.flowControl
+            if status == FC_CONTINUE:
+                return blockSize, StMinSeconds(stMin)
+            if status == FC_OVERFLOW:
+                raise RuntimeError('ISO-TP {0:x}: message too long for the peer'.format(self.txId))
+        raise TimeoutError('ISO-TP {0:x}: too many flow control WAIT frames'.format(self.txId))
+
+    def sendConsecutive(self, rest):
+        """
+        Send the consecutive frames, block by block as the flow control of the peer allows
+        @param rest: memoryview of the payload after the first frame
+        @return: Nothing
+        """
+        sequence = 1
+        position = 0
+        total = len(rest)
+        while position < total:
+            blockSize, separation = self.waitFlowControl()
+            frames = (total - position + 6) // 7
+            if blockSize:
+                frames = min(frames, blockSize)
+            if separation > 0:
+                deadline = time.monotonic()
+                for _ in range(frames):
+                    SeparationSleep(deadline)
+                    chunk = rest[position:position + 7]
+                    self.sendFrame(bytes([PCI_CONSECUTIVE | sequence]) + chunk.tobytes())
+                    deadline = time.monotonic() + separation
+                    sequence = (sequence + 1) & 0x0F
+                    position += len(chunk)
+            else:
+                while frames:
+                    n = min(frames, self.txBatch)
+                    sequence, position = self.fillBuffer(rest, position, sequence, n)
+                    self.transmitBuffer(n)
+                    frames -= n
+
+    def transmitBuffer(self, n):
+        """
+        Hand the first n frames of the transmit buffer to the driver. It takes as many as fit
+        into the transmit FIFO, the others are moved to the front and handed over again
+        once the FIFO has room.
+        @return: Nothing
+        """
+        buf = self.txBuffer
+        size = sizeof(TCanMsg)
+        while True:
+            sent = self.canDriver._CanTransmitMsgs(self.index, buf, n)
+            if sent < 0:
+                raise RuntimeError('ISO-TP transmit Error-Code: {0}'.format(sent))
+            n -= sent
+            if n <= 0:
+                return
+            if sent:
+                memmove(buf, addressof(buf) + sent * size, n * size)
+            self.waitTxFifo(n)
+
+    def waitTxFifo(self, count):
+        """
+        Wait until count frames fit into the transmit FIFO (or it is empty), the FIFO is full now
+        @return: Nothing
+        """
+        full = self.canDriver._CanTransmitGetCount(self.index)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            time.sleep(TX_POLL)
+            pending = self.canDriver._CanTransmitGetCount(self.index)
+            if pending < 0:
+                raise RuntimeError('ISO-TP transmit FIFO Error-Code: {0}'.format(pending))
+            if pending <= max(0, full - count):
+                return
+            if time.monotonic() > deadline:
+                raise TimeoutError('ISO-TP {0:x}: transmit FIFO not emptied'.format(self.txId))
+
+    def fillBuffer(self, rest, position, sequence, n):
+        """
+        Prepare n consecutive frames in the transmit buffer
+        @return: (next sequence number, next position in rest)
+        """
+        buf = self.txBuffer
+        size = sizeof(TCanMsg)
+        base = addressof(buf) + DATA_OFFSET
+        total = len(rest)
+        for i in range(n):
+            msg = buf[i]
+            chunk = rest[position:position + 7].tobytes()
+            msg.Id = self.txId
+            msg.Flags.Uint32 = self.txFlags
+            address = base + i * size
+            memset(address, self.padding or 0, 8)
+            memmove(address + 1, chunk, len(chunk))
+            msg.Data[0] = PCI_CONSECUTIVE | sequence
+            if self.padding is None:
+                msg.Flags.FlagBits.DLC = len(chunk) + 1
+            sequence = (sequence + 1) & 0x0F
+            position += len(chunk)
+            if position >= total:
+                break
+        return sequence, position
+
+    def recv(self, timeout=None):
+        """
+        Next received message
+        @param timeout: seconds, self.timeout if None
+        @return: bytes
+        """
+        try:
+            return self.received.get(timeout=self.timeout if timeout is None else timeout)
+        except queue.Empty:
+            raise TimeoutError('ISO-TP {0:x}: no message received'.format(self.rxId))
+
+    def request(self, payload, timeout=None):
+        """
+        Send a request and wait for the response, e.g. UDS
+        @param payload: bytes
+        @param timeout: seconds to wait for the response
+        @return: bytes
+        """
+        while not self.received.empty():
+            self.received.get_nowait()
+        self.send(payload)
+        return self.recv(timeout)
+
+
+# --------------------------------------------------------------------
+# ------------------ Simulation --------------------------------------
+# --------------------------------------------------------------------
+
+class LoopbackDriver:
+    """
+    The part of the MhsTinyCanDriver interface the transport uses, one node of a LoopbackBus
+    """
+    def __init__(self, bus, txFifoSize=LOOPBACK_TX_FIFO):
+        """
+        Class Constructor
+        @param bus: LoopbackBus
+        @param txFifoSize: frames the transmit FIFO holds until the bus has delivered them
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.bus = bus
+        self.Index = None
+        self.handler = None
+        self.txFifoSize = txFifoSize
+        self.pending = 0 # frames in the transmit FIFO
+        self.lock = threading.Lock()
+        self.partialWrites = 0
+
+    def CanSetRxBatchEvent(self, handler, bufferSize=1024):
+        self.handler = handler
+        return 0
+
+    def _CanTransmit(self, index, msgId, msgData, flags):
+        msg = TCanMsg()
+        msg.Id = msgId
+        msg.Data[:len(msgData)] = msgData
+        msg.Flags.Uint32 = flags
+        with self.lock:
+            self.pending += 1
+        self.bus.put(self, [msg])
+        return 0
+
+    def _CanTransmitMsgs(self, index, msgs, count):
+        with self.lock:
+            free = self.txFifoSize - self.pending
+            if count > free:
+                self.partialWrites += 1
+                count = max(0, free)
+            self.pending += count
+        if not count:
+            return 0
+        batch = (TCanMsg * count)()
+        memmove(batch, msgs, sizeof(TCanMsg) * count)
+        self.bus.put(self, batch)
+        return count
+
+    def _CanTransmitGetCount(self, index):
+        return self.pending
+
+    def delivered(self, count):
+        with self.lock:
+            self.pending -= count
+
+    def _CanReceive(self, index, count=1):
+        return 0
+
+
+class LoopbackBus(threading.Thread):
+    """
+    Delivers the frames of each node to all others, optionally at the speed of a real bus
+    """
+    def __init__(self, bitrate=None):
+        """
+        Class Constructor
+        @param bitrate: kBit/s of the simulated bus, None to deliver without delay
+        @return: nothing
+        """
+        threading.Thread.__init__(self, name='LoopbackBus')
+        self.daemon = True
+        self.frameTime = 130.0 / (bitrate * 1000) if bitrate else 0.0 # 8 byte frame with stuff bits
+        self.nodes = []
+        self.queue = queue.Queue()
+        self.frames = 0
+        self.start()
+
+    def node(self):
+        driver = LoopbackDriver(self)
+        self.nodes.append(driver)
+        return driver
+
+    def put(self, sender, msgs):
+        self.queue.put((sender, msgs))
+
+    def run(self):
+        busFree = time.monotonic()
+        while True:
+            sender, msgs = self.queue.get()
+            count = len(msgs)
+            self.frames += count
+            if self.frameTime:
+                busFree = max(busFree, time.monotonic()) + count * self.frameTime
+                SeparationSleep(busFree)
+            for node in self.nodes:
+                if node is not sender and node.handler is not None:
+                    node.handler(None, msgs, count)
+            sender.delivered(count)
+
+
+class SimulatedEcu(threading.Thread):
+    """
+    ECU answering UDS ReadDataByIdentifier (0x22) with responseSize bytes, other services negatively
+    """
+    def __init__(self, canDriver, txId=0x7E8, rxId=0x7E0, responseSize=4095, **transportOptions):
+        threading.Thread.__init__(self, name='SimulatedEcu')
+        self.daemon = True
+        self.transport = IsoTpTransport(canDriver, txId, rxId, **transportOptions)
+        self.transport.attach()
+        self.responseSize = responseSize
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                request = self.transport.recv(timeout=3600)
+            except TimeoutError:
+                continue
+            if request[0] == 0x22 and len(request) >= 3:
+                body = bytes(i & 0xFF for i in range(self.responseSize - 3))
+                self.transport.send(bytes([0x62]) + request[1:3] + body)
+            else:
+                self.transport.send(bytes([0x7F, request[0], 0x11])) # service not supported
+
+
+def Throughput(size=4095, count=20, bitrate=None, txBatch=TX_BATCH, blockSize=0):
+    """
+    Transfer time of large responses from a simulated ECU
+    @param size: bytes per response
+    @param count: number of requests
+    @param bitrate: kBit/s of the simulated bus, None for the software overhead only
+    @param txBatch: consecutive frames per CanTransmit call of the ECU
+    @param blockSize: block size announced by the tester
+    @return: (seconds per transfer, bytes per second)
+    """
+    bus = LoopbackBus(bitrate)
+    tester = IsoTpTransport(bus.node(), txId=0x7E0, rxId=0x7E8, blockSize=blockSize)
+    tester.attach()
+    SimulatedEcu(bus.node(), responseSize=size, txBatch=txBatch)
+    tester.request(bytes([0x22, 0xF1, 0x90])) # warm up
+    t0 = time.perf_counter()
+    for _ in range(count):
+        response = tester.request(bytes([0x22, 0xF1, 0x90]), timeout=10.0)
+        if len(response) != size:
+            raise RuntimeError('response of {0} bytes, expected {1}'.format(len(response), size))
+    elapsed = (time.perf_counter() - t0) / count
+    return elapsed, size / elapsed
+
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+
+    parser = OptionParser('usage: %prog [options]')
+    parser.add_option('-s', action='store', type='int', dest='size', metavar='SIZE',
+                      help='bytes per response, default = 4095', default=4095)
+    parser.add_option('-n', action='store', type='int', dest='count', metavar='COUNT',
+                      help='number of requests, default = 20', default=20)
+    parser.add_option('-b', action='store', type='int', dest='bitrate', metavar='KBIT',
+                      help='bitrate of the simulated bus, default = no bus delay', default=None)
+    parser.add_option('-k', action='store', type='int', dest='blocksize', metavar='BS',
+                      help='block size of the flow control, default = 0', default=0)
+    parser.add_option('-u', action='store_true', dest='unbatched',
+                      help='send the consecutive frames one by one', default=False)
+    (options, args) = parser.parse_args()
+
+    perTransfer, rate = Throughput(options.size, options.count, options.bitrate,
+                                   1 if options.unbatched else TX_BATCH, options.blocksize)
+    print('{0} bytes in {1:.2f} ms, {2:.1f} kB/s'.format(options.size, perTransfer * 1e3, rate / 1e3))
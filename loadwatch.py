@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: loadwatch.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Decides whether background work (compression, archiving) may run.
+#     Inputs are the CPU load (/proc/loadavg), the busy time of the SD
+#     card (/proc/diskstats) and the Rx FIFO fill level of the CAN logger,
+#     read from its metrics endpoint.
+#     RUN      the system is idle, background work catches up
+#     THROTTLE acquisition is active, background work at low priority only
+#     PAUSE    a limit is exceeded, background work is stopped
+#     A pause ends when all inputs are below resumeRatio of their limits
+#     and it lasted minPause seconds. The inputs include the load of the
+#     background work itself, so it drops as soon as the work is stopped:
+#     after a pause the work runs at least minRun seconds before the load
+#     or the SD card pause it again, only the FIFO fill of the logger
+#     pauses it right away. Without the hold times SIGSTOP/SIGCONT of the
+#     archiver would flip-flop.
+#     The decisions are exported as metrics.
+#
+# Usage
+#     >>> governor = loadwatch.LoadGovernor()
+#     >>> state = governor.decide()
+#     >>> if state == loadwatch.PAUSE: ...
+#
+# ----------------------------------------------------------------------
+
+import os
+import time
+import urllib.request
+import uselogging
+import metrics
+
+RUN = 0
+THROTTLE = 1
+PAUSE = 2
+STATE_NAMES = {RUN:'run', THROTTLE:'throttle', PAUSE:'pause'}
+
+DISK_DEVICE = 'mmcblk0' # SD card of the RaspberryPi
+LOGGER_METRICS_URL = 'http://127.0.0.1:{0}/metrics'.format(metrics.DEFAULT_PORT)
+
+
+def ReadLoadAvg(fileName='/proc/loadavg'):
+    """
+    @return: load average of the last minute
+    """
+    with open(fileName) as f:
+        return float(f.read().split()[0])
+
+
+def ReadDiskTicks(device=DISK_DEVICE, fileName='/proc/diskstats'):
+    """
+    @return: milliseconds the device was busy with I/O since boot, None if the device does not exist
+    """
+    with open(fileName) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 12 and fields[2] == device:
+                return int(fields[12])
+    return None
+
+
+def ScrapeMetrics(url=LOGGER_METRICS_URL, timeout=0.2):
+    """
+    Read the metrics of a logger
+    @param url: metrics endpoint
+    @return: dictionary name: value, empty if the logger does not answer
+    """
+    values = {}
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            text = response.read().decode()
+    except (OSError, ValueError):
+        return values
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            try:
+                values[name] = float(value)
+            except ValueError:
+                pass
+    return values
+
+
+class LoadGovernor:
+    """
+    RUN, THROTTLE or PAUSE for background work from CPU load, SD card busy time and logger FIFO fill
+    """
+    def __init__(self, maxLoad=None, maxDiskBusy=0.5, maxFifoFill=0.25, idleLoad=0.5, idleFrameRate=1.0,
+                 resumeRatio=0.8, minPause=30.0, minRun=10.0, device=DISK_DEVICE, metricsUrl=LOGGER_METRICS_URL):
+        """
+        Class Constructor
+        @param maxLoad: 1 minute load average that pauses background work, 0.75 per CPU if None
+        @param maxDiskBusy: fraction of time the SD card is busy that pauses background work
+        @param maxFifoFill: Rx FIFO fill level (0..1) of the CAN logger that pauses background work
+        @param idleLoad: load average below which the system counts as idle
+        @param idleFrameRate: CAN frames per second below which the vehicle counts as idle
+        @param resumeRatio: a pause ends when all inputs are below this fraction of their limits
+        @param minPause: seconds a pause lasts at least
+        @param minRun: seconds after a pause before the load or the SD card pause again
+        @param device: block device of the log files
+        @param metricsUrl: metrics endpoint of the CAN logger, None to ignore it
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.maxLoad = maxLoad if maxLoad is not None else 0.75 * (os.cpu_count() or 1)
+        self.maxDiskBusy = maxDiskBusy
+        self.maxFifoFill = maxFifoFill
+        self.idleLoad = idleLoad
+        self.idleFrameRate = idleFrameRate
+        self.resumeRatio = resumeRatio
+        self.minPause = minPause
+        self.minRun = minRun
+        self.device = device
+        self.metricsUrl = metricsUrl
+        self.state = THROTTLE
+        self.stateSince = time.monotonic() # start of the pause or the end of the last one
+        self.load = 0.0
+        self.diskBusy = 0.0
+        self.fifoFill = 0.0
+        self.frameRate = 0.0
+        self.lastTicks = None
+        self.lastTime = None
+        metrics.Gauge('carpc_background_state', 'Background work 0 = run, 1 = throttle, 2 = pause', function=lambda: self.state)
+        metrics.Gauge('carpc_background_load', 'Load average seen by the background scheduler', function=lambda: self.load)
+        metrics.Gauge('carpc_background_disk_busy', 'Busy fraction of the SD card', function=lambda: self.diskBusy)
+        metrics.Gauge('carpc_background_fifo_fill', 'Rx FIFO fill level (0..1) of the CAN logger', function=lambda: self.fifoFill)
+        self.pauses = metrics.Counter('carpc_background_pauses_total', 'Pauses of the background work')
+
+    def measure(self):
+        """
+        Read all inputs
+        @return: Nothing
+        """
+        now = time.monotonic()
+        try:
+            self.load = ReadLoadAvg()
+        except OSError:
+            self.load = 0.0
+        try:
+            ticks = ReadDiskTicks(self.device)
+        except OSError:
+            ticks = None
+        if ticks is not None and self.lastTicks is not None and now > self.lastTime:
+            self.diskBusy = min(1.0, (ticks - self.lastTicks) / ((now - self.lastTime) * 1000.0))
+        self.lastTicks = ticks
+        self.lastTime = now
+        if self.metricsUrl:
+            values = ScrapeMetrics(self.metricsUrl)
+            size = values.get('carpc_can_fifo_size')
+            self.fifoFill = values.get('carpc_can_fifo_fill', 0.0) / size if size else 0.0
+            self.frameRate = values.get('carpc_can_frame_rate', 0.0)
+
+    def decide(self):
+        """
+        Measure and decide
+        @return: RUN, THROTTLE or PAUSE
+        """
+        self.measure()
+        now = time.monotonic()
+        fifoRatio = self.fifoFill / self.maxFifoFill
+        ratio = max(self.load / self.maxLoad, self.diskBusy / self.maxDiskBusy, fifoRatio)
+        if self.state == PAUSE:
+            paused = ratio >= self.resumeRatio or now - self.stateSince < self.minPause
+        else:
+            paused = fifoRatio >= 1.0 or (ratio >= 1.0 and now - self.stateSince >= self.minRun)
+        if paused:
+            state = PAUSE
+        elif self.load < self.idleLoad and self.frameRate < self.idleFrameRate:
+            state = RUN
+        else:
+            state = THROTTLE
+        if state != self.state:
+            if state == PAUSE:
+                self.pauses.inc()
+            if state == PAUSE or self.state == PAUSE:
+                self.stateSince = now
+            self.logger.info('Background work {0}: load {1:.2f}, disk busy {2:.0%}, FIFO fill {3:.0%}'.format(
+                STATE_NAMES[state], self.load, self.diskBusy, self.fifoFill))
+            self.state = state
+        return state
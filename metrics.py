@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: metrics.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Runtime metrics of the loggers: counters, gauges and histograms in a
+#     registry, exported in the Prometheus text format over a local HTTP
+#     endpoint (http://127.0.0.1:9105/metrics) or a Unix socket.
+#     Updating a metric on the hot path is a plain attribute update, no
+#     locks, no formatting. Gauges may be given a function instead, it is
+#     only evaluated when the metrics are scraped.
+#
+# Usage
+#     >>> frames = metrics.Counter('carpc_can_frames_received_total', 'CAN frames received')
+#     >>> frames.inc(n)
+#     >>> metrics.Gauge('carpc_can_fifo_fill', 'Rx FIFO fill level', function=lambda: fill)
+#     >>> metrics.StartHttpServer()
+#     $ curl http://127.0.0.1:9105/metrics
+#     $ socat - UNIX-CONNECT:/tmp/carpc-metrics.sock
+#
+# ----------------------------------------------------------------------
+
+import os
+import bisect
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import uselogging
+
+DEFAULT_PORT = 9105
+DEFAULT_SOCKET = '/tmp/carpc-metrics.sock'
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class Registry:
+    """
+    Collection of metrics, rendered in the Prometheus text format
+    """
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add a metric, replaces a metric of the same name
+        @return: the metric
+        """
+        with self.lock:
+            self.metrics = [m for m in self.metrics if m.name != metric.name]
+            self.metrics.append(metric)
+        return metric
+
+    def unregister(self, metric):
+        with self.lock:
+            if metric in self.metrics:
+                self.metrics.remove(metric)
+
+    def get(self, name):
+        for metric in self.metrics:
+            if metric.name == name:
+                return metric
+        return None
+
+    def render(self):
+        """
+        All metrics in the Prometheus text format
+        @return: String
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.value = 0
+        if registry is not None:
+            registry.register(self)
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        return ['{0} {1}'.format(self.name, self.value)]
+
+
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, help, function=None, registry=REGISTRY):
+        """
+        Class Constructor
+        @param function: evaluated at scrape time if given, set() is not needed then
+        """
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+        if registry is not None:
+            registry.register(self)
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.function() if self.function else self.value
+        return ['{0} {1}'.format(self.name, value)]
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        if registry is not None:
+            registry.register(self)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('{0}_bucket{{le="{1}"}} {2}'.format(self.name, bound, cumulative))
+        cumulative += self.counts[-1]
+        lines.append('{0}_bucket{{le="+Inf"}} {1}'.format(self.name, cumulative))
+        lines.append('{0}_sum {1}'.format(self.name, self.sum))
+        lines.append('{0}_count {1}'.format(self.name, cumulative))
+        return lines
+
+
+# --------------------------------------------------------------------
+# ------------------ Export ------------------------------------------
+# --------------------------------------------------------------------
+
+class MetricsHttpHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsSocketHandler(socketserver.StreamRequestHandler):
+    registry = REGISTRY
+
+    def handle(self):
+        self.wfile.write(self.registry.render().encode())
+
+
+def StartHttpServer(port=DEFAULT_PORT, address='127.0.0.1', registry=REGISTRY):
+    """
+    Serve the metrics over HTTP in a background thread
+    @param port: TCP port
+    @param address: address to bind to, local only by default
+    @return: server object or None if the port is not available
+    """
+    handler = type('Handler', (MetricsHttpHandler,), {'registry':registry})
+    try:
+        server = HTTPServer((address, port), handler)
+    except OSError as e:
+        uselogging.getLogger().error('Metrics server not started: {0}'.format(e))
+        return None
+    thread = threading.Thread(target=server.serve_forever, name='MetricsHttpServer')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def StartSocketServer(path=DEFAULT_SOCKET, registry=REGISTRY):
+    """
+    Serve the metrics over a Unix socket in a background thread, every connection gets the text once
+    @param path: path of the socket
+    @return: server object or None if the socket could not be created
+    """
+    handler = type('Handler', (MetricsSocketHandler,), {'registry':registry})
+    try:
+        if os.path.exists(path):
+            os.remove(path)
+        server = socketserver.UnixStreamServer(path, handler)
+    except OSError as e:
+        uselogging.getLogger().error('Metrics socket not started: {0}'.format(e))
+        return None
+    thread = threading.Thread(target=server.serve_forever, name='MetricsSocketServer')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -43,14 +43,21 @@
 #   - /usr/local/lib
 #   - /usr/lib
 #
-# TODO
-#   Callback functions (not implemented)
 # ---------------------------------------------------------------------- 
 # ChangeLog: 
 # 08.12.2013 V0.53 Changed to Python3, P.Menschel (menschel.p@posteo.de)
 # 02.01.2014 V0.54 Many Functions redone, Complete Event Handling Implemented, P.Menschel (menschel.p@posteo.de)
 #                  Changed Option Handling to Dictionary, XHandling of Status Values to readable Status Info  
 # 12.01.2014 V0.55 Read path of the Tiny-CAN API DLL from the windows registry
+#            V0.56 Cache library path and driver/device properties between runs, query properties on first use
+#            V0.57 Function prototypes (argtypes/restype) declared once at load time
+#            V0.58 Multi device support, per instance options, device selection by Snr
+#            V0.59 Rx Events with more than one message, batched Rx Event handling with statistics
+#            V0.60 Decode and format steps of CanReceiveAndFormatSimple separately callable, --profile option
+#            V0.61 Payload update and release of interval messages, transmit of several messages in one call
+#            V0.62 CAN FD messages (TCanFdMsg, up to 64 bytes, BRS/FDF), if the library has the CanFd* functions
+#            V0.63 Typed options (utils.CompiledOptions), option strings of the init stages built once
+#            V0.64 reopenDevice restores filters and interval messages, PnPEventCallback reopens the device
 # ---------------------------------------------------------------------- 
 #  DLL/SO Buglist/Issues
 # - EFF Flag in FilterFlags seems unimplemented, setting it makes the filter not work 
@@ -63,18 +70,24 @@ VERSION = \
 MhsTinyCanDriver V0.55, 12.01.2014 (LGPL)
 Last Change: P.Menschel (menschel.p@posteo.de)
 """
-from ctypes import Structure,c_int,c_ubyte,c_ulong,c_char_p,c_ushort,pointer,Union,POINTER
+from ctypes import Structure,c_int,c_ubyte,c_ulong,c_char_p,c_ushort,byref,Union,POINTER,memmove,sizeof,cast,c_void_p
 import os
 import sys
 import time
+import json
+import logging
+import threading
 import uselogging
-from utils import OptionDict2CsvString,UpdateOptionDict,CsvString2OptionDict
+import tracing
+from utils import CompiledOptions,ParseOptionString
 
 if sys.platform == "win32":
     from ctypes import WinDLL,WINFUNCTYPE
     from _winreg import OpenKey,CloseKey,QueryValueEx,HKEY_LOCAL_MACHINE,KEY_ALL_ACCESS
+    FUNCTYPE = WINFUNCTYPE
 else:
     from ctypes import CDLL,CFUNCTYPE  
+    FUNCTYPE = CFUNCTYPE
 
 
 # locations where we look for shared libraries
@@ -94,9 +107,53 @@ if sys.platform == "win32":
 else:
     sharedLibraryLocations = [os.curdir,
                               os.path.join(os.curdir,'lib'),
-                              os.path.join('usr','local','lib'),
-                              os.path.join('usr','lib')]
-    
+                              os.path.join(os.sep,'usr','local','lib'),
+                              os.path.join(os.sep,'usr','lib')]
+
+# line format of CanReceiveAndFormatSimple (CANlog.txt)
+SIMPLE_FORMAT = 'ID:{0:08x}, DLC:{1},TxD:{2}, RTR:{3}, EFF:{4}, Source:{5}, Data:{6}'
+FD_FORMAT = ', FDF:1, BRS:{0}, ESI:{1}' # appended to SIMPLE_FORMAT for CAN FD frames, DLC is the DLC code then
+
+# hot path API calls, instrumented by tracing.SampledTracer if MHSTCAN_TRACE is set
+HOT_PATH_CALLS = ['_CanReceive',
+                  '_CanReceiveGetCount',
+                  '_CanTransmit',
+                  '_CanTransmitMsgs',
+                  'TransmitData']
+
+# cache of the resolved library path and the parsed driver/device properties between runs
+DRIVER_CACHE_FILE = os.path.join(os.path.expanduser('~'),'.mhstcan_cache.json')
+
+def LoadDriverCache(cacheFile=DRIVER_CACHE_FILE):
+    """
+    Load the driver cache
+    @param cacheFile: json file of the cache, None to disable the cache
+    @return: cache dictionary, empty if there is no (valid) cache
+    """
+    if not cacheFile:
+        return {}
+    try:
+        with open(cacheFile) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def SaveDriverCache(cache, cacheFile=DRIVER_CACHE_FILE):
+    """
+    Save the driver cache, errors are ignored as the cache is optional
+    @param cache: cache dictionary
+    @param cacheFile: json file of the cache, None to disable the cache
+    @return: Nothing
+    """
+    if not cacheFile:
+        return
+    try:
+        with open(cacheFile + '.tmp','w') as f:
+            json.dump(cache, f)
+        os.replace(cacheFile + '.tmp', cacheFile)
+    except (IOError, OSError):
+        pass
+
 # Menschel 19.12.2013 - Start
 # CAN Bitrates
 CAN_10K_BIT     = 10
@@ -292,6 +349,13 @@ TCAN_Keys_CanSetOption = ['CanTxAckEnable',
                           'ExecuteCommandTimeout',
                           'LowPollIntervall',
                           'FilterReadIntervall']
+# option strings per init stage, see utils.CompiledOptions
+TCAN_Stages = {'CanInitDriver':TCAN_Keys_CanInitDriver,
+               'CanDeviceOpen':TCAN_Keys_CanDeviceOpen,
+               'CanSetOptions':TCAN_Keys_CanSetOption}
+# value types, the rest are numbers
+TCAN_String_Options = ['Hardware', 'CfgFile', 'Section', 'LogFile', 'ComDeviceName', 'Snr']
+TCAN_Types = dict((key, str if key in TCAN_String_Options else int) for key in TCAN_Options)
 # TIndex
 class TIndexBits(Structure):
     _fields_ = [
@@ -371,6 +435,37 @@ class TCanMsg(Structure):
         self.Sec=0
         self.USec=0
 
+# TCanFdFlagBits, Len is the number of data bytes (0-64), not the DLC code
+class TCanFdFlagBits(Structure):
+    _fields_ = [('Len',c_ubyte),#8bit
+                ('TxD',c_ubyte,1),#1bit
+                ('Error',c_ubyte,1),#1bit
+                ('RTR',c_ubyte,1),#1bit
+                ('EFF',c_ubyte,1),#1bit
+                ('FDF',c_ubyte,1),#1bit, CAN FD frame
+                ('BRS',c_ubyte,1),#1bit, bit rate switch
+                ('ESI',c_ubyte,1),#1bit, error state indicator
+                ('Reserved1',c_ubyte,1),#1bit
+                ('Source',c_ubyte),#8bit
+                ('Reserved2',c_ubyte)#8bit
+                ]#32bits total
+
+class TCanFdFlags(Union):
+    _fields_ = [('FlagBits',TCanFdFlagBits),
+                ('Uint32',c_ulong)]
+
+# TCanFdMsg
+class TCanFdMsg(Structure):
+    _fields_ = [('Id', c_ulong),
+                ('Flags', TCanFdFlags),
+                ('Data', c_ubyte * 64),
+                ('Sec', c_ulong),
+                ('USec', c_ulong)]
+
+# CAN FD: data length of the DLC codes, valid lengths above 8 bytes
+FD_DLC_LENGTHS = (0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 20, 24, 32, 48, 64)
+FD_LENGTH_DLC = [next(dlc for dlc, n in enumerate(FD_DLC_LENGTHS) if n >= length) for length in range(65)]
+
 class TMsgFilterFlagsBits(Structure):
     _fields_ = [('DLC',c_ubyte,4),#4bit
                 ('Reserved1',c_ubyte,2),#2bit
@@ -423,54 +518,266 @@ class TMsgFilter(Structure):
         self.Flags.Uint32=0
 # Menschel 19.12.2013 - End
 
+# CallbackFunction Prototypes using CFUNCTYPE(ReturnValue, Argument1, Argument2,...)
+PNPCALLBACKFUNC = FUNCTYPE(None, TIndex, c_ulong)
+STATUSEVENTCALLBACKFUNC = FUNCTYPE(None, TIndex, POINTER(TDeviceStatus))
+RXEVENTCALLBACKFUNC = FUNCTYPE(None, TIndex, POINTER(TCanMsg), c_ulong)
+
+# CAN FD functions, only in libraries with CAN FD support
+API_FD_PROTOTYPES = {'CanFdTransmit':(c_int, [c_ulong, POINTER(TCanFdMsg), c_int]),
+                     'CanFdReceive':(c_int, [c_ulong, POINTER(TCanFdMsg), c_int])}
+
+# Function Prototypes of the API, Name:(restype, argtypes), declared once when the library is loaded
+API_PROTOTYPES = {'CanInitDriver':(c_int, [c_char_p]),
+                  'CanDownDriver':(None, []),
+                  'CanSetOptions':(c_int, [c_char_p]),
+                  'CanDeviceOpen':(c_int, [c_ulong, c_char_p]),
+                  'CanDeviceClose':(c_int, [c_ulong]),
+                  'CanSetMode':(c_int, [c_ulong, c_ubyte, c_ushort]),
+                  'CanTransmit':(c_int, [c_ulong, POINTER(TCanMsg), c_int]),
+                  'CanTransmitClear':(c_int, [c_ulong]),
+                  'CanTransmitGetCount':(c_int, [c_ulong]),
+                  'CanTransmitSet':(c_int, [c_ulong, c_ushort, c_ulong]),
+                  'CanReceive':(c_int, [c_ulong, POINTER(TCanMsg), c_int]),
+                  'CanReceiveClear':(c_int, [c_ulong]),
+                  'CanReceiveGetCount':(c_int, [c_ulong]),
+                  'CanSetSpeed':(c_int, [c_ulong, c_ushort]),
+                  'CanSetFilter':(c_int, [c_ulong, POINTER(TMsgFilter)]),
+                  'CanDrvInfo':(c_char_p, []),
+                  'CanDrvHwInfo':(c_char_p, [c_ulong]),
+                  'CanGetDeviceStatus':(c_int, [c_ulong, POINTER(TDeviceStatus)]),
+                  'CanSetPnPEventCallback':(c_int, [PNPCALLBACKFUNC]),
+                  'CanSetStatusEventCallback':(c_int, [STATUSEVENTCALLBACKFUNC]),
+                  'CanSetRxEventCallback':(c_int, [RXEVENTCALLBACKFUNC]),
+                  'CanSetEvents':(c_int, [c_ushort])}
+
+# TCanMsg Array Types by count, creating a ctypes array type is expensive
+TCanMsgArrayTypes = {}
+TCanFdMsgArrayTypes = {}
+
+# Statistics of the Rx Event Callbacks to tune CanRxDMode / MinEventSleepTime
+class RxEventStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.callbacks = 0
+        self.frames = 0
+        self.maxFrames = 0
+        self.time = 0.0 # seconds spent in callbacks
+        self.maxTime = 0.0
+
+    def add(self, count, dt):
+        self.callbacks += 1
+        self.frames += count
+        if count > self.maxFrames:
+            self.maxFrames = count
+        self.time += dt
+        if dt > self.maxTime:
+            self.maxTime = dt
+
+    def framesPerCallback(self):
+        return self.frames / self.callbacks if self.callbacks else 0.0
+
+    def __str__(self):
+        return 'Rx Events: {0} callbacks, {1} frames, {2:.1f} frames/callback (max {3}), {4:.3f}s in callbacks (max {5:.1f}us)'.format(
+            self.callbacks, self.frames, self.framesPerCallback(), self.maxFrames, self.time, self.maxTime * 1e6)
+
+# Device numbers (TIndex.CanDevice) used by the driver instances of this process,
+# CanInitDriver and CanDownDriver are called once for all of them
+MAX_CAN_DEVICES = 16
+UsedCanDevices = set()
+DriverLock = threading.Lock()
+
 # --------------------------------------------------------------------
 # ------------------ Driver Class ------------------------------------
 # --------------------------------------------------------------------
 class MhsTinyCanDriver:
-    def __init__(self, dll=None, options=None):
+    def __init__(self, dll=None, options=None, cacheFile=DRIVER_CACHE_FILE, snr=None, device=None):
         """
         Class Constructor
         @param dll: path to dll / shared library
         @param options: dictionary of options to be set
+        @param cacheFile: cache of library path and driver/device properties between runs, None to disable
+        @param snr: Serial Number of the Device to open, any device if None
+        @param device: device number (TIndex.CanDevice) to use, the lowest free one if None
         @return: nothing
         """
+        self.initStartTime = time.monotonic()
+        self.timeToFirstFrame = None
         self.logger = uselogging.getLogger()
-        self.Index = TIndex() #default FIFO Index 0
+        with DriverLock:
+            if device is None:
+                freeDevices = [d for d in range(MAX_CAN_DEVICES) if d not in UsedCanDevices]
+                if not freeDevices:
+                    raise IndexError('No free CAN device number found.')
+                device = freeDevices[0]
+            elif device in UsedCanDevices:
+                raise IndexError('CAN device number {0} already in use.'.format(device))
+            UsedCanDevices.add(device)
+        self.device = device
+        self.Index = TIndex() #default FIFO Index 0 of the device
+        self.Index.IndexBits.CanDevice = device
         self.UsedTxSlots = [] #for frequent messages, turns into a List of Indexes later
         self.UsedRxSlots = [] #for Can HW Filters, turns into a List of Indexes later
-        self.Options = TCAN_Options
-        self.TCDriverProperties = {}
-        self.TCDeviceProperties = {}#no multidevice support yet
-        if options:
-            self.Options.update(options)
-        self.so = None
-        if dll:
-            if sys.platform == "win32":
-                self.so = WinDLL(dll)
+        self.RxFilters = {} #TIndex.Uint32: (TIndex, code, mask, flags) of the filters, restored by reopenDevice
+        self.TxIntervals = {} #TIndex.Uint32: [TIndex, msgId, msgData, interval, rtr] of the interval messages, restored by reopenDevice
+        self.Options = CompiledOptions(TCAN_Options, TCAN_Types, TCAN_Stages, self.logger) #per instance, TCAN_Options holds the defaults
+        self._TCDriverProperties = None #queried on first use, see TCDriverProperties
+        self._TCDeviceProperties = None #queried on first use, see TCDeviceProperties
+        try:
+            if options:
+                self.Options.update(options)
+            if snr:
+                self.Options['Snr'] = snr
+            self.cacheFile = cacheFile
+            self.cache = LoadDriverCache(cacheFile)
+            self.so = None
+            if dll:
+                self.so = self.loadLibrary(dll)
             else:
-                self.so = CDLL(dll)                            
-        else:                        
-            for sharedLibraryLocation in sharedLibraryLocations:
-                try:
-                    if sys.platform == "win32":
-                        sharedLibrary = sharedLibraryLocation + os.sep + "mhstcan.dll"
-                    else:
-                        sharedLibrary = sharedLibraryLocation + os.sep + "libmhstcan.so"
-                    self.logger.info('search library {0} in {1}'.format(sharedLibrary, sharedLibraryLocation))
-                    if sys.platform == "win32":
-                        self.so = WinDLL(sharedLibrary)
-                    else:
-                        self.so = CDLL(sharedLibrary)                    
-                    self.logger.info('library found')
-                    break
-                except OSError:
-                    self.logger.error('no valid library found')
-                    pass
-        if not self.so:
-            raise RuntimeError('library not found: ' + sharedLibrary)
-        err = self.initComplete(self.Index, self.Options)
-        if err < 0:
-            raise NotImplementedError('Device Init Failed')      
+                self.so = self.findLibrary()
+            if not self.so:
+                raise RuntimeError('library not found in: {0}'.format(sharedLibraryLocations))
+            self.bindApi()
+            self.tracer = None
+            if tracing.TRACE_SAMPLE_RATE:
+                self.tracer = tracing.SampledTracer()
+                self.tracer.instrument(self, HOT_PATH_CALLS)
+            err = self.initComplete(self.Index, self.Options)
+            if err < 0:
+                raise NotImplementedError('Device Init Failed')      
+            self.logger.info('Driver ready after {0:.3f}s'.format(time.monotonic() - self.initStartTime))
+        except BaseException:
+            # the device number is free again if the driver could not be set up
+            with DriverLock:
+                UsedCanDevices.discard(device)
+            raise
+
+    def loadLibrary(self, sharedLibrary):
+        """
+        Load the shared library / DLL
+        @param sharedLibrary: path to the library
+        @return: library object
+        @raise OSError: if the library can not be loaded
+        """
+        if sys.platform == "win32":
+            return WinDLL(sharedLibrary)
+        else:
+            return CDLL(sharedLibrary)
+
+    def bindApi(self):
+        """
+        Declare argtypes/restype of all API functions once and bind them to local attributes,
+        e.g. self.so.CanReceive to self.soCanReceive
+        @return: Nothing
+        """
+        for name, (restype, argtypes) in API_PROTOTYPES.items():
+            try:
+                func = getattr(self.so, name)
+            except AttributeError:
+                self.logger.error('function {0} not found in library'.format(name))
+                continue
+            func.restype = restype
+            func.argtypes = argtypes
+            setattr(self, 'so' + name, func)
+        for name, (restype, argtypes) in API_FD_PROTOTYPES.items():
+            func = getattr(self.so, name, None)
+            if func is None:
+                self.logger.info('function {0} not found in library, no CAN FD'.format(name))
+            else:
+                func.restype = restype
+                func.argtypes = argtypes
+            setattr(self, 'so' + name, func)
+
+    def findLibrary(self):
+        """
+        Load the library from the cached path, search sharedLibraryLocations if that fails
+        @return: library object, None if not found
+        """
+        cachedLibrary = self.cache.get('library')
+        if cachedLibrary:
+            try:
+                return self.loadLibrary(cachedLibrary)
+            except OSError:
+                self.logger.error('cached library {0} not valid anymore'.format(cachedLibrary))
+        if sys.platform == "win32":
+            libraryName = "mhstcan.dll"
+        else:
+            libraryName = "libmhstcan.so"
+        for sharedLibraryLocation in sharedLibraryLocations:
+            sharedLibrary = os.path.abspath(os.path.join(sharedLibraryLocation, libraryName))
+            try:
+                so = self.loadLibrary(sharedLibrary)
+            except OSError:
+                continue
+            self.logger.info('library found: {0}'.format(sharedLibrary))
+            self.cache['library'] = sharedLibrary
+            SaveDriverCache(self.cache, self.cacheFile)
+            return so
+        self.logger.error('no valid library found')
+        return None
+
+    # ----------------------------------------------------------------
+    # --------------- Lazy Driver/Device Properties ------------------
+    # ----------------------------------------------------------------
+
+    def deviceCacheKey(self, serial=None):
+        """
+        @param serial: serial number, the Snr option if None
+        @return: cache key of the device properties, None without a serial number (any device
+                 may have been opened, the properties are queried then)
+        """
+        if serial is None:
+            serial = self.Options.get('Snr')
+        if not serial:
+            return None
+        return 'device-{0}'.format(serial)
+
+    @property
+    def TCDriverProperties(self):
+        """
+        Parsed CanDrvInfo, taken from the cache or queried on first use
+        """
+        if self._TCDriverProperties is None:
+            self._TCDriverProperties = self.cache.get('driver')
+            if self._TCDriverProperties is None:
+                self._TCDriverProperties = ParseOptionString(self._CanDrvInfo())
+                self.cache['driver'] = self._TCDriverProperties
+                SaveDriverCache(self.cache, self.cacheFile)
+        return self._TCDriverProperties
+
+    @property
+    def TCDeviceProperties(self):
+        """
+        Parsed CanDrvHwInfo, taken from the cache or queried on first use
+        """
+        if self._TCDeviceProperties is None:
+            key = self.deviceCacheKey()
+            if key is not None:
+                self._TCDeviceProperties = self.cache.get(key)
+            if self._TCDeviceProperties is None:
+                self._TCDeviceProperties = ParseOptionString(self._CanDrvHwInfo(self.Index))
+                # cached by the serial number of the opened device, a later open by Snr finds it
+                key = self.deviceCacheKey(self._TCDeviceProperties.get('Seriennummer'))
+                if key is not None:
+                    self.cache[key] = self._TCDeviceProperties
+                    SaveDriverCache(self.cache, self.cacheFile)
+        return self._TCDeviceProperties
+
+    def refreshProperties(self):
+        """
+        Query driver and device properties again, e.g. after another device was connected
+        @return: Nothing
+        """
+        self.cache.pop('driver', None)
+        key = self.deviceCacheKey()
+        if key is not None:
+            self.cache.pop(key, None)
+        self._TCDriverProperties = None
+        self._TCDeviceProperties = None
+        self.TCDriverProperties
+        self.TCDeviceProperties
 
     # ----------------------------------------------------------------
     # --------------- Overall Init Function --------------------------
@@ -487,13 +794,13 @@ class MhsTinyCanDriver:
         self.logger.info('initComplete')
         #if Serial Number given use this device 
           
-        if options and (type(options) == dict):
-            UpdateOptionDict(self.Options,options,self.logger)            
+        if options and options is not self.Options:
+            self.Options.update(options)
         if snr:  
-            UpdateOptionDict(self.Options,{'snr':snr},self.logger)  
+            self.Options['Snr'] = snr
         #obtain CAN Speed by prio explicite given parameter >> given option dictionary >> objects option dictionary
         if canSpeed:
-            UpdateOptionDict(self.Options,{'canSpeed1':canSpeed},self.logger)
+            self.Options['CanSpeed1'] = canSpeed
         #Init Cascade: Driver >> Device >> Options >> CAN BUS    
         err = self.initDriver(self.Options)
         if err >= 0:
@@ -503,13 +810,72 @@ class MhsTinyCanDriver:
         if err >= 0:
             err = self.resetCanBus(index)
         if err >= 0:    
-            self.logger.info('initComplete done (with success) for device with snr.: {0}'.format(snr))
+            self.logger.info('initComplete done (with success) for device with snr.: {0}'.format(self.Options['Snr']))
         else:
-            self.logger.info('init failed for device with snr.: {0}'.format(snr))
-            self._CanDownDriver()
+            self.logger.info('init failed for device with snr.: {0}'.format(self.Options['Snr']))
+            with DriverLock:
+                if UsedCanDevices == set([self.device]):
+                    self._CanDownDriver()
             self.so = None                 
         return err
 
+    def shutdown(self):
+        """
+        High Level Function to stop the CAN Bus and close the device, the driver is shut down with the last device
+        @return: Nothing
+        """
+        self.logger.info('shutdown')
+        if self.so:
+            self.resetCanBus()
+            self._CanDeviceClose(self.Index)
+            with DriverLock:
+                UsedCanDevices.discard(self.device)
+                if not UsedCanDevices:
+                    self._CanDownDriver()
+            self.so = None
+
+    def reopenDevice(self):
+        """
+        High Level Function to open the device again after it was unplugged, the driver stays initialized.
+        Uses the compiled option strings, starts the CAN Bus and restores the filters and interval messages.
+        @return: Error Code (0 = No Error)
+        """
+        self.logger.info('reopenDevice')
+        t0 = time.monotonic()
+        err = self.openDevice(self.Index)
+        if err >= 0:
+            err = self.setOptions(self.Options)
+        if err >= 0:
+            err = self.resetCanBus(self.Index)
+        if err >= 0:
+            err = self.restoreSlots()
+        if err >= 0:
+            self.logger.info('reopenDevice done after {0:.3f}s'.format(time.monotonic() - t0))
+        else:
+            self.logger.error('reopenDevice Error-Code: {0}'.format(err))
+        return err
+
+    def restoreSlots(self):
+        """
+        Set the filters of UsedRxSlots and the interval messages of UsedTxSlots again,
+        resetCanBus clears them in the device
+        @return: Error Code of the first failed call (0 = No Error)
+        """
+        result = 0
+        for filterIndex, code, mask, flags in self.RxFilters.values():
+            err = self._CanSetFilter(index=filterIndex, code=code, mask=mask, flags=flags)
+            if err < 0 and result >= 0:
+                result = err
+        for intervalIndex, msgId, msgData, interval, rtr in self.TxIntervals.values():
+            err = self._CanTransmitSet(index=intervalIndex, flags=0x0, interval=interval)
+            if err >= 0:
+                err = self.TransmitData(msgId=msgId, msgData=msgData, index=intervalIndex, rtr=rtr)
+            if err >= 0:
+                err = self._CanTransmitSet(index=intervalIndex, flags=0x8001, interval=interval)
+            if err < 0 and result >= 0:
+                result = err
+        return result
+
 
     # ----------------------------------------------------------------
     # ----------------------------------------------------------------
@@ -527,14 +893,17 @@ class MhsTinyCanDriver:
         @return: Error Code (0 = No Error)
         """        
         self.logger.info('initDriver')
-        if options and (type(options) == dict):
-            UpdateOptionDict(self.Options,options,self.logger)            
-        OptionString = OptionDict2CsvString(OptionDict=self.Options,Keys=TCAN_Keys_CanInitDriver)
+        if options and options is not self.Options:
+            self.Options.update(options)
+        with DriverLock:
+            if UsedCanDevices - set([self.device]):
+                self.logger.info('Driver already initialized for device(s) {0}'.format(UsedCanDevices - set([self.device])))
+                return 0
+        OptionString = self.Options.compile('CanInitDriver')
         err = self._CanInitDriver(OptionString)
         if err < 0:
             self.logger.error('initDriver Error-Code: {0}'.format(err))
             raise RuntimeError('Could not load Driver')
-        self.TCDriverProperties.update(CsvString2OptionDict(self._CanDrvInfo()))
         return err
     
     def CanSetUpEvents(self,PnPEventCallbackfunc=None,StatusEventCallbackfunc=None,RxEventCallbackfunc=None):
@@ -583,19 +952,17 @@ class MhsTinyCanDriver:
         self.logger.info('openDevice')
         if index == None:
             index = self.Index
-        if options and (type(options) == dict):
-            UpdateOptionDict(self.Options,options,self.logger)
+        if options and options is not self.Options:
+            self.Options.update(options)
         if serial:
-            options.update({'snr':serial})
-            UpdateOptionDict(self.Options,{'snr':serial},self.logger) 
+            self.Options['Snr'] = serial
         self.logger.info('CanDeviceClose prior to CanDeviceOpen')                                
         err = self._CanDeviceClose(index)
         if err < 0:
             self.logger.error('CanDeviceClose prior to CanDeviceOpen Error-Code: {0}'.format(err))
-        err = self._CanDeviceOpen(index, OptionDict2CsvString(OptionDict=options,Keys=TCAN_Keys_CanDeviceOpen))
+        err = self._CanDeviceOpen(index, self.Options.compile('CanDeviceOpen'))
         if err < 0:
             self.logger.error('openDevice Error-Code: {0}'.format(err))
-        self.TCDeviceProperties.update(CsvString2OptionDict(self._CanDrvHwInfo(index)))
         return err
     
 
@@ -606,13 +973,13 @@ class MhsTinyCanDriver:
     def setOptions(self,options):
         """
         High Level Function to Set CAN Options
-        @param options: dictionary of options to be set
+        @param options: dictionary of options to be set, the CAN options of self.Options are sent
         @return: Error Code (0 = No Error)
         """
         self.logger.info('setOptions')        
-        if options and (type(options) == dict):
-            UpdateOptionDict(self.Options,options,self.logger)        
-        err = self._CanSetOptions(OptionDict2CsvString(OptionDict=options,Keys=TCAN_Keys_CanSetOption))
+        if options and options is not self.Options:
+            self.Options.update(options)
+        err = self._CanSetOptions(self.Options.compile('CanSetOptions'))
         if err < 0:
             self.logger.error('setOptions Error-Code: {0}'.format(err))
         return err
@@ -645,7 +1012,7 @@ class MhsTinyCanDriver:
         """
         if index == None:
             index = self.Index
-        UpdateOptionDict(self.Options,{'canSpeed1':canSpeed},self.logger)
+        self.Options['CanSpeed1'] = canSpeed
         return self._CanSetSpeed(index, canSpeed)
                
     def setCanMode(self,canMode,index=None):
@@ -685,7 +1052,8 @@ class MhsTinyCanDriver:
 
     def PnPEventCallback(self,index,status):
         """
-        Simple Plug and Play Event Handler to open the device again after reconnection and Print to STOUT
+        Simple Plug and Play Event Handler to open the device again after reconnection and Print to STOUT,
+        see reconnect.ReconnectMonitor for reopening outside of the driver thread
         @param index: Struct commonly used by the Tiny Can API
         @param status: simple Flag, 0 = disconnect, 1 = connect  
         @return: Nothing
@@ -693,9 +1061,11 @@ class MhsTinyCanDriver:
         """
         self.logger.info('PnPEventCallback called with index {0} and status {1}'.format(index.Uint32,status))
         if status:
-            self.CanDeviceOpen(index,self.Options)
-            self.CanSetMode(index,OP_CAN_START, CAN_CMD_ALL_CLEAR)
-            print('Device Connected')           
+            err = self.reopenDevice()
+            if err >= 0:
+                print('Device Connected')
+            else:
+                print('Device Connected, reopen failed with Error-Code {0}'.format(err))
         else:
             print('Device Disconnected')
         return
@@ -718,20 +1088,57 @@ class MhsTinyCanDriver:
         """
         Simple Callback for CAN Rx Event, Just Print Message to STDOUT
         @param index: Struct commonly used by the Tiny Can API
-        @param RxMessagePointer: Pointer to TCAN Message if DriverOption is set, NULL Pointer otherwise
+        @param RxMessagePointer: Pointer to TCAN Message block if DriverOption is set, NULL Pointer otherwise
         @param count: Number of Messages  
         @return: Nothing
         @author: Patrick Menschel (menschel.p@posteo.de)
-        @todo: Check for counts > 1, Implement it, are they possible ?? 
         """
-        if count > 1:
-            raise NotImplementedError('RxEvent with more than 1 Message is not supported yet')
         if RxMessagePointer:
-            RxMessage = RxMessagePointer.contents
-            print("RxEvent from Index {0} with ID {1} Data: {2}  Count{3} ".format(index.Uint32,hex(RxMessage.Id),[hex(x) for x in RxMessage.Data],count))
+            for i in range(count):
+                RxMessage = RxMessagePointer[i]
+                print("RxEvent from Index {0} with ID {1} Data: {2}  Count{3} ".format(index.Uint32,hex(RxMessage.Id),[hex(x) for x in RxMessage.Data],count))
         else:
             print("RxEvent from Index {0} with No Message attached".format(index.Uint32))
         return
+
+    def CanSetRxBatchEvent(self, handler, bufferSize=1024):
+        """
+        High Level Function to receive the Rx Events in batches. The message block passed by the driver
+        is copied once into a preallocated buffer and handed to the handler, counts > 1 are fine.
+        Statistics go to self.RxEventStats.
+        @param handler: function(index, messages, count) called on the driver thread, messages is the
+                        reused buffer (valid for count entries and only during the call) or None if
+                        the driver did not attach messages (CanRxDMode = 0), read the FIFO then
+        @param bufferSize: number of TCanMsg in the buffer, larger blocks are handed over in chunks
+        @return: Error Code (0 = No Error)
+        """
+        self.RxBatchHandler = handler
+        self.RxEventBuffer = (TCanMsg * bufferSize)()
+        self.RxEventStats = RxEventStats()
+        return self._CanSetRxEventCallback(self.RxBatchEventCallback)
+
+    def RxBatchEventCallback(self, index, RxMessagePointer, count):
+        """
+        Rx Event Callback of CanSetRxBatchEvent
+        @param index: Struct commonly used by the Tiny Can API
+        @param RxMessagePointer: Pointer to TCAN Message block if DriverOption is set, NULL Pointer otherwise
+        @param count: Number of Messages
+        @return: Nothing
+        """
+        t0 = time.perf_counter()
+        if RxMessagePointer and count:
+            buf = self.RxEventBuffer
+            size = sizeof(TCanMsg)
+            address = cast(RxMessagePointer, c_void_p).value
+            done = 0
+            while done < count:
+                chunk = min(len(buf), count - done)
+                memmove(buf, address + done * size, chunk * size)
+                self.RxBatchHandler(index, buf, chunk)
+                done += chunk
+        else:
+            self.RxBatchHandler(index, None, count)
+        self.RxEventStats.add(count, time.perf_counter() - t0)
     
     def CanSetEvents(self, events = EVENT_ENABLE_ALL):
         """
@@ -742,7 +1149,7 @@ class MhsTinyCanDriver:
         @todo: change this to a dictionary
         """
         self.logger.info('CanSetEvents')
-        err = self.so.CanSetEvents(c_ushort(events))
+        err = self.soCanSetEvents(events)
         if err < 0:
             self.logger.error('CanSetEvents Error-Code: {0}'.format(err))
         return err
@@ -766,10 +1173,76 @@ class MhsTinyCanDriver:
         RxMessages = self._CanReceive(index, count)
         if RxMessages:
             for RxMessage in RxMessages:
-                formatedMessage =  'ID:{0:08x}, DLC:{1},TxD:{2}, RTR:{3}, EFF:{4}, Source:{5}, Data:{6}'.format(RxMessage.Id,RxMessage.Flags.FlagBits.DLC,RxMessage.Flags.FlagBits.TxD,RxMessage.Flags.FlagBits.RTR,RxMessage.Flags.FlagBits.EFF,RxMessage.Flags.FlagBits.Source,[hex(x) for x in RxMessage.Data])
+                formatedMessage =  SIMPLE_FORMAT.format(RxMessage.Id,RxMessage.Flags.FlagBits.DLC,RxMessage.Flags.FlagBits.TxD,RxMessage.Flags.FlagBits.RTR,RxMessage.Flags.FlagBits.EFF,RxMessage.Flags.FlagBits.Source,[hex(x) for x in RxMessage.Data])
                 formatedMessages.append(formatedMessage)
         return formatedMessages
 
+    def DecodeMessages(self, RxMessages):
+        """
+        Decode step of CanReceiveAndFormatSimple, separate for the profiling of the pipeline stages
+        @param RxMessages: Result of _CanReceive
+        @return: List of Tuples (Id, DLC, TxD, RTR, EFF, Source, List of hex Strings)
+        """
+        if isinstance(RxMessages, int):
+            return []
+        decoded = []
+        for RxMessage in RxMessages:
+            bits = RxMessage.Flags.FlagBits
+            decoded.append((RxMessage.Id, bits.DLC, bits.TxD, bits.RTR, bits.EFF, bits.Source, [hex(x) for x in RxMessage.Data]))
+        return decoded
+
+    def FormatDecodedSimple(self, decoded):
+        """
+        Format step of CanReceiveAndFormatSimple, same output
+        @param decoded: Result of DecodeMessages
+        @return: List of Strings containing formatted Messages
+        """
+        return [SIMPLE_FORMAT.format(*fields) for fields in decoded]
+
+    def CanFdReceiveAndFormatSimple(self, index, count=1):
+        """
+        CanReceiveAndFormatSimple for a bus with CAN FD frames, classic frames give the same lines
+        @param index: Struct commonly used by the Tiny Can API
+        @param count: Number of Messages to be read from FIFO
+        @return: List of Strings containing formatted Messages
+        """
+        return self.FormatFdDecodedSimple(self.DecodeFdMessages(self._CanFdReceive(index, count)))
+
+    def DecodeFdMessages(self, RxMessages):
+        """
+        DecodeMessages for TCanFdMsgs
+        @param RxMessages: Result of _CanFdReceive
+        @return: List of Tuples (Id, DLC, TxD, RTR, EFF, Source, List of hex Strings, FDF, BRS, ESI),
+                 DLC is the DLC code of CAN FD frames
+        """
+        if isinstance(RxMessages, int):
+            return []
+        decoded = []
+        for RxMessage in RxMessages:
+            bits = RxMessage.Flags.FlagBits
+            if bits.FDF:
+                dlc = FD_LENGTH_DLC[bits.Len]
+                decoded.append((RxMessage.Id, dlc, bits.TxD, bits.RTR, bits.EFF, bits.Source,
+                                [hex(x) for x in RxMessage.Data[:FD_DLC_LENGTHS[dlc]]], 1, bits.BRS, bits.ESI))
+            else:
+                decoded.append((RxMessage.Id, bits.Len, bits.TxD, bits.RTR, bits.EFF, bits.Source,
+                                [hex(x) for x in RxMessage.Data[:8]], 0, 0, 0))
+        return decoded
+
+    def FormatFdDecodedSimple(self, decoded):
+        """
+        Format step of CanFdReceiveAndFormatSimple
+        @param decoded: Result of DecodeFdMessages
+        @return: List of Strings containing formatted Messages
+        """
+        lines = []
+        for fields in decoded:
+            line = SIMPLE_FORMAT.format(*fields[:7])
+            if fields[7]:
+                line += FD_FORMAT.format(fields[8], fields[9])
+            lines.append(line)
+        return lines
+
     def FormatCanDeviceStatus(self,drv,can,fifo):
         """
         Simple Function to cast/format the Device Status to readable text by use of dictionaries
@@ -801,10 +1274,11 @@ class MhsTinyCanDriver:
         if index == None:
             index = self.Index
         if len(msgData) > 8:
-            raise NotImplementedError('Messages with more then 8 Bytes are not yet supported')
+            return self.TransmitFdData(msgId, msgData, index=index)
 #         Data = []
         Flags = TCANFlags()   
-        self.logger.info('TransmitData')
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('TransmitData')
         if type(msgData) != list:
             self.logger.error('List expected but got {0} instead'.format(type(msgData)))
             raise ValueError('List expected but got {0} instead'.format(type(msgData)))
@@ -820,10 +1294,39 @@ class MhsTinyCanDriver:
             Flags.FlagBits.EFF = 1
         err = self._CanTransmit(index, msgId, msgData, flags=Flags.Uint32) 
         if err < 0:
-            self.logger.error('TransmitData Error-Code: {0}'.format(err))              
+            self.logger.error('TransmitData Error-Code: %d', err)
         return err   
         
 
+    def TransmitFdData(self, msgId, msgData, index = None, brs = True):
+        """
+        High Level Function to transmit a CAN FD Message, the data is padded with 0 to the next valid length
+        @param msgId: CAN ID of the Message
+        @param msgData: Data of the Message, List of up to 64 Integers
+        @param index: Struct commonly used by the Tiny Can API, Drop the Index to select the FIFO
+        @param brs: send the data phase with the higher bit rate
+        @return: Error Code (0 = No Error)
+        """
+        if index == None:
+            index = self.Index
+        if len(msgData) > 64:
+            raise ValueError('CAN FD Messages have at most 64 Bytes')
+        length = FD_DLC_LENGTHS[FD_LENGTH_DLC[len(msgData)]]
+        msg = (TCanFdMsg * 1)()
+        msg[0].Id = msgId
+        msg[0].Data[:len(msgData)] = msgData
+        bits = msg[0].Flags.FlagBits
+        bits.Len = length
+        bits.TxD = 1
+        bits.FDF = 1
+        bits.BRS = 1 if brs else 0
+        if msgId > 0x7FF:
+            bits.EFF = 1
+        err = self._CanFdTransmit(index, msg, 1)
+        if err < 0:
+            self.logger.error('TransmitFdData Error-Code: %d', err)
+        return err
+
     def SetInvervalMessage(self, msgId, msgData, interval, index = None, rtr = None):
         """
         High Level Function to transmit a CAN Message in given Interval
@@ -840,6 +1343,7 @@ class MhsTinyCanDriver:
             if type(index) == TIndex:
                 IntervalIndex = index
             else:
+                IntervalIndex = TIndex()
                 IntervalIndex.Uint32 = index
         else:
             IntervalIndex = self.GetFreeTxSlot()
@@ -855,7 +1359,37 @@ class MhsTinyCanDriver:
             self.logger.error('SetInvervalMessage Error-Code: {0}'.format(err))
         else:
             self.UsedTxSlots.append(IntervalIndex)
+            self.TxIntervals[IntervalIndex.Uint32] = [IntervalIndex, msgId, msgData, interval, rtr]
         return err,IntervalIndex      
+
+    def UpdateIntervalMessage(self, index, msgId, msgData, rtr = None):
+        """
+        High Level Function to change the message of a running interval buffer,
+        the interval keeps running, the next cycle sends the new data
+        @param index: TIndex of the interval buffer as returned by SetInvervalMessage
+        @param msgId: CAN ID of the Message
+        @param msgData: Data of the Message
+        @param rtr: Remote Transmission Request, Note: obsolete in any known CAN Protocol
+        @return: Error Code (0 = No Error)
+        """
+        interval = self.TxIntervals.get(index.Uint32)
+        if interval is not None:
+            interval[1:3] = msgId, msgData
+        return self.TransmitData(msgId=msgId, msgData=msgData, index=index, rtr=rtr)
+
+    def ClearIntervalMessage(self, index):
+        """
+        High Level Function to stop an interval message and free its buffer
+        @param index: TIndex of the interval buffer as returned by SetInvervalMessage
+        @return: Error Code (0 = No Error)
+        """
+        self.logger.info('ClearIntervalMessage')
+        err = self._CanTransmitSet(index=index, flags=0x0, interval=0)
+        if err < 0:
+            self.logger.error('ClearIntervalMessage Error-Code: {0}'.format(err))
+        self.UsedTxSlots = [idx for idx in self.UsedTxSlots if idx.Uint32 != index.Uint32]
+        self.TxIntervals.pop(index.Uint32, None)
+        return err
         
     
 
@@ -906,6 +1440,7 @@ class MhsTinyCanDriver:
             self.logger.error('FilterSetUp Error-Code: {0}'.format(err))
         else:
             self.UsedRxSlots.append(filterIndex)
+            self.RxFilters[filterIndex.Uint32] = (filterIndex, msgId, msgMask, filterFlags.Uint32)
         return err,filterIndex
 
 
@@ -920,6 +1455,7 @@ class MhsTinyCanDriver:
         fslots = [s for s in range(1,self.TCDeviceProperties['Anzahl Filter']+1) if s not in [idx.IndexBits.SubIndex for idx in self.UsedRxSlots]]
         if fslots:
             NextFreeSlotIndex = TIndex()
+            NextFreeSlotIndex.IndexBits.CanDevice = self.device
             NextFreeSlotIndex.IndexBits.SubIndex = fslots[0]
             return NextFreeSlotIndex
         else:
@@ -936,6 +1472,7 @@ class MhsTinyCanDriver:
         fslots = [s for s in range(1,self.TCDeviceProperties['Anzahl Interval Puffer']+1) if s not in [idx.IndexBits.SubIndex for idx in self.UsedTxSlots]]
         if fslots:
             NextFreeSlotIndex = TIndex()
+            NextFreeSlotIndex.IndexBits.CanDevice = self.device
             NextFreeSlotIndex.IndexBits.SubIndex = fslots[0]
             return NextFreeSlotIndex
         else:
@@ -954,7 +1491,7 @@ class MhsTinyCanDriver:
         """
         self.logger.info('CanInitDriver')
         self.logger.info('- with options = {0}'.format(options))
-        err = self.so.CanInitDriver(c_char_p(options))
+        err = self.soCanInitDriver(options)
         if err < 0:
             self.logger.error('CanInitDriver Error-Code: {0}'.format(err))
         return err
@@ -965,7 +1502,7 @@ class MhsTinyCanDriver:
         @return: Nothing
         """
         self.logger.info('CanDownDriver')
-        self.so.CanDownDriver()
+        self.soCanDownDriver()
         return
     
     def _CanSetOptions(self, options = None):
@@ -976,7 +1513,7 @@ class MhsTinyCanDriver:
         """
         self.logger.info('CanSetOptions')
         self.logger.info('- with options = {0}'.format(options))
-        err = self.so.CanSetOptions(c_char_p(options))
+        err = self.soCanSetOptions(options)
         if err < 0:
             self.logger.error('CanSetOptions Error-Code: {0}'.format(err))
         return err
@@ -990,7 +1527,7 @@ class MhsTinyCanDriver:
         """
         self.logger.info('CanDeviceOpen')
         self.logger.info('- with options = {0}'.format(options))
-        err = self.so.CanDeviceOpen(c_ulong(index.Uint32), c_char_p(options))
+        err = self.soCanDeviceOpen(index.Uint32, options)
         if err < 0:
             self.logger.error('CanDeviceOpen Error-Code: {0}'.format(err))
         return err
@@ -1002,7 +1539,7 @@ class MhsTinyCanDriver:
         @return: Error Code (0 = No Error) 
         """
         self.logger.info('CanDeviceClose')
-        err = self.so.CanDeviceClose(c_ulong(index.Uint32))
+        err = self.soCanDeviceClose(index.Uint32)
         if err < 0:
             self.logger.error('CanDeviceClose Error-Code: {0}'.format(err))
         return err
@@ -1016,7 +1553,7 @@ class MhsTinyCanDriver:
         @return: Error Code (0 = No Error) 
         """
         self.logger.info('CanSetMode')
-        err = self.so.CanSetMode(c_ulong(index.Uint32), c_ubyte(mode), c_ushort(flags)) 
+        err = self.soCanSetMode(index.Uint32, mode, flags)
         if err < 0:
             self.logger.error('CanSetMode Error-Code: {0}'.format(err))
         return err       
@@ -1030,17 +1567,30 @@ class MhsTinyCanDriver:
         @param flags: Flags to be set
         @return: Error Code (0 = No Error)      
         """    
-        self.logger.info('CanTransmit')
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('CanTransmit')
         canMSG = TCanMsg()
-        canMSG.Id = c_ulong(msgId)
-        for i,b in enumerate(msgData):
-                canMSG.Data[i] = b
+        canMSG.Id = msgId
+        canMSG.Data[:len(msgData)] = msgData
         canMSG.Flags.Uint32 = flags
-        err = self.so.CanTransmit(c_ulong(index.Uint32), pointer(canMSG), c_int(1))#transmit once
+        err = self.soCanTransmit(index.Uint32, byref(canMSG), 1)#transmit once
         if err < 0:
-            self.logger.error('CanTransmit Error-Code: {0}'.format(err))
+            self.logger.error('CanTransmit Error-Code: %d', err)
         return err
         
+    def _CanTransmitMsgs(self, index, msgs, count):
+        """
+        API CALL - Transmit several prepared CAN Messages in one call
+        @param index: Struct commonly used by the Tiny Can API
+        @param msgs: ctypes array of TCanMsg, e.g. of TCanMsgArrayTypes
+        @param count: Number of messages of the array to be sent
+        @return: Number of messages put into the transmit FIFO or Error Code
+        """
+        err = self.soCanTransmit(index.Uint32, msgs, count)
+        if err < 0:
+            self.logger.error('CanTransmit Error-Code: %d', err)
+        return err
+
     def _CanTransmitClear(self, index):
         """
         API CALL - Clear the Transmit FIFO
@@ -1048,7 +1598,7 @@ class MhsTinyCanDriver:
         @return: Error Code (0 = No Error)         
         """
         self.logger.info('CanTransmitClear')
-        err = self.so.CanTransmitClear(c_ulong(index.Uint32))
+        err = self.soCanTransmitClear(index.Uint32)
         if err < 0:
             self.logger.error('CanTransmitClear Error-Code: {0}'.format(err))
         return err
@@ -1060,7 +1610,7 @@ class MhsTinyCanDriver:
         @return: Number of Messages         
         """
         self.logger.info('CanTransmitGetCount')
-        num = self.so.CanTransmitGetCount(c_ulong(index.Uint32))
+        num = self.soCanTransmitGetCount(index.Uint32)
         if num < 0:
             self.logger.error('CanTransmitGetCount Error-Code: {0}'.format(num))
         return num
@@ -1076,7 +1626,7 @@ class MhsTinyCanDriver:
         """
         self.logger.info('CanTransmitSet')
         usecs = int(interval*1000)
-        err = self.so.CanTransmitSet(c_ulong(index.Uint32), c_ushort(flags), c_ulong(usecs))
+        err = self.soCanTransmitSet(index.Uint32, flags, usecs)
         if err < 0:
             self.logger.error('CanTransmitSet Error-Code: {0}'.format(err))
         return err
@@ -1088,14 +1638,61 @@ class MhsTinyCanDriver:
         @param count: Number of messages to be read 
         @return: CAN Messages of specified count or Error Code
         """        
-        TCanMsgArrayType = TCanMsg * count # Struct of multiple TCANMsg Instances without using Python List object
+        TCanMsgArrayType = TCanMsgArrayTypes.get(count)
+        if TCanMsgArrayType is None:
+            TCanMsgArrayType = TCanMsgArrayTypes[count] = TCanMsg * count # Struct of multiple TCANMsg Instances without using Python List object
         TCanMsgArray = TCanMsgArrayType()
-        num = self.so.CanReceive(c_ulong(index.Uint32), pointer(TCanMsgArray), count)
+        num = self.soCanReceive(index.Uint32, TCanMsgArray, count)
         if num < 0:
-            self.logger.info('CanReceive, Error-Code: {0}'.format(num))
+            self.logger.error('CanReceive, Error-Code: %d', num)
             return num
-        self.logger.info('CanReceive {0} message(s) received'.format(num))
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('CanReceive %d message(s) received', num)
+        if num and self.timeToFirstFrame is None:
+            self.timeToFirstFrame = time.monotonic() - self.initStartTime
+            self.logger.info('first frame received {0:.3f}s after start'.format(self.timeToFirstFrame))
+        if num < count:
+            return TCanMsgArray[:num] # only the messages filled by the driver
         return TCanMsgArray
+
+    def _CanFdTransmit(self, index, msgs, count):
+        """
+        API CALL - Transmit CAN FD Messages
+        @param index: Struct commonly used by the Tiny Can API
+        @param msgs: ctypes array of TCanFdMsg
+        @param count: Number of messages of the array to be sent
+        @return: Error Code (0 = No Error)
+        """
+        if self.soCanFdTransmit is None:
+            raise NotImplementedError('CAN FD is not supported by this library')
+        err = self.soCanFdTransmit(index.Uint32, msgs, count)
+        if err < 0:
+            self.logger.error('CanFdTransmit Error-Code: %d', err)
+        return err
+
+    def _CanFdReceive(self, index, count=1):
+        """
+        API CALL - Read classic and CAN FD Messages from FIFO or Buffer, depends on index
+        @param index: Struct commonly used by the Tiny Can API
+        @param count: Number of messages to be read
+        @return: TCanFdMsgs of specified count or Error Code
+        """
+        if self.soCanFdReceive is None:
+            raise NotImplementedError('CAN FD is not supported by this library')
+        TCanFdMsgArrayType = TCanFdMsgArrayTypes.get(count)
+        if TCanFdMsgArrayType is None:
+            TCanFdMsgArrayType = TCanFdMsgArrayTypes[count] = TCanFdMsg * count
+        TCanFdMsgArray = TCanFdMsgArrayType()
+        num = self.soCanFdReceive(index.Uint32, TCanFdMsgArray, count)
+        if num < 0:
+            self.logger.error('CanFdReceive, Error-Code: %d', num)
+            return num
+        if num and self.timeToFirstFrame is None:
+            self.timeToFirstFrame = time.monotonic() - self.initStartTime
+            self.logger.info('first frame received {0:.3f}s after start'.format(self.timeToFirstFrame))
+        if num < count:
+            return TCanFdMsgArray[:num]
+        return TCanFdMsgArray
         
     def _CanReceiveClear(self, index):
         """
@@ -1104,7 +1701,7 @@ class MhsTinyCanDriver:
         @return: Error Code (0 = No Error)
         """   
         self.logger.info('CanReceiveClear')
-        err = self.so.CanReceiveClear(c_ulong(index.Uint32))
+        err = self.soCanReceiveClear(index.Uint32)
         if err  < 0:
             self.logger.error('CanReceiveClear Error-Code: {0}'.format(err))
         return err
@@ -1115,10 +1712,11 @@ class MhsTinyCanDriver:
         @param index: Struct commonly used by the Tiny Can API 
         @return: Message Number or Error Code
         """  
-        self.logger.info('CanReceiveGetCount')
-        num = self.so.CanReceiveGetCount(c_ulong(index.Uint32))
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('CanReceiveGetCount')
+        num = self.soCanReceiveGetCount(index.Uint32)
         if num < 0:
-            self.logger.error('CanReceiveGetCount Error-Code: {0}'.format(num))
+            self.logger.error('CanReceiveGetCount Error-Code: %d', num)
         return num
         
     def _CanSetSpeed(self, index, speed):
@@ -1129,7 +1727,7 @@ class MhsTinyCanDriver:
         @return: Error Code (0 = No Error)
         """  
         self.logger.info('CanSetSpeed')
-        err = self.so.CanSetSpeed(c_ulong(index.Uint32), c_ushort(speed))
+        err = self.soCanSetSpeed(index.Uint32, speed)
         if err < 0:
             self.logger.error('CanSetSpeed Error-Code: {0}'.format(err))        
         return err
@@ -1154,7 +1752,7 @@ class MhsTinyCanDriver:
         canMSGFilter.Mask = mask
         canMSGFilter.Code = code
         canMSGFilter.Flags.Uint32 = flags
-        err = self.so.CanSetFilter(c_ulong(index.Uint32), pointer(canMSGFilter))
+        err = self.soCanSetFilter(index.Uint32, byref(canMSGFilter))
         if err  < 0:
             self.logger.error('CanSetFilter Error-Code: {0}'.format(err))
         return int(err)
@@ -1165,8 +1763,7 @@ class MhsTinyCanDriver:
         @return: Version String of DLL / Shared Library
         """
         self.logger.info('CanDrvInfo')
-        self.so.CanDrvInfo.restype = c_char_p
-        return self.so.CanDrvInfo()
+        return self.soCanDrvInfo()
         
     def _CanDrvHwInfo(self, index):
         """
@@ -1174,8 +1771,7 @@ class MhsTinyCanDriver:
         @return: Version String of Hardware Device / Firmware
         """
         self.logger.info('CanDrvHwInfo')
-        self.so.CanDrvHwInfo.restype = c_char_p
-        return self.so.CanDrvHwInfo(c_ulong(index.Uint32))
+        return self.soCanDrvHwInfo(index.Uint32)
         
     def _CanGetDeviceStatus(self, index):
         """
@@ -1184,7 +1780,7 @@ class MhsTinyCanDriver:
         """
         self.logger.info('CanGetDeviceStatus')
         devSTAT = TDeviceStatus()
-        err = self.so.CanGetDeviceStatus(c_ulong(index.Uint32), pointer(devSTAT))
+        err = self.soCanGetDeviceStatus(index.Uint32, byref(devSTAT))
         if err < 0:
             self.logger.error('CanGetDeviceStatus Error-Code: {0}'.format(err))
         return err,devSTAT.DrvStatus,devSTAT.CanStatus,devSTAT.FifoStatus
@@ -1199,13 +1795,8 @@ class MhsTinyCanDriver:
         @todo: Find out why the Callback on Linux does not work for Device connect but on Windows for Connect and Disconnect even if Driver Option is not set
         """
         self.logger.info('CanSetPnpEventCallback')
-        if sys.platform == "win32":
-            PNPCALLBACKFUNC = WINFUNCTYPE(None, TIndex, c_ulong) # CallbackFunction Prototype for PNP Callback using CFUNCTYPE(ReturnValue, Argument1, Argument2,...)
-            
-        else:
-            PNPCALLBACKFUNC = CFUNCTYPE(None, TIndex, c_ulong) # CallbackFunction Prototype for PNP Callback using CFUNCTYPE(ReturnValue, Argument1, Argument2,...)            
         self.PNPCallBack = PNPCALLBACKFUNC(CallbackFunc)
-        err = self.so.CanSetPnPEventCallback(self.PNPCallBack)
+        err = self.soCanSetPnPEventCallback(self.PNPCallBack)
         if err < 0:
             self.logger.error('CanSetPnPEventCallback with Function {0} raised Error Code {1}'.format(CallbackFunc,err))
         return err
@@ -1219,12 +1810,8 @@ class MhsTinyCanDriver:
         @author: Patrick Menschel (menschel.p@posteo.de)
         """
         self.logger.info('CanSetStatusEventCallback')
-        if sys.platform == "win32":
-            STATUSEVENTCALLBACKFUNC = WINFUNCTYPE(None, TIndex, POINTER(TDeviceStatus)) # CallbackFunction Prototype for Status Event Callback using CFUNCTYPE(ReturnValue, Argument1, Argument2,...)
-        else:
-            STATUSEVENTCALLBACKFUNC = CFUNCTYPE(None, TIndex, POINTER(TDeviceStatus)) # CallbackFunction Prototype for Status Event Callback using CFUNCTYPE(ReturnValue, Argument1, Argument2,...)
         self.StatusEventCallBack = STATUSEVENTCALLBACKFUNC(CallbackFunc)
-        err = self.so.CanSetStatusEventCallback(self.StatusEventCallBack)
+        err = self.soCanSetStatusEventCallback(self.StatusEventCallBack)
         if err < 0:
             self.logger.error('CanSetStatusEventCallback with Function {0} raised Error Code {1}'.format(CallbackFunc,err))
         return err           
@@ -1238,14 +1825,8 @@ class MhsTinyCanDriver:
         @author: Patrick Menschel (menschel.p@posteo.de)
         """
         self.logger.info('CanSetRxEventCallback')
-        if sys.platform == "win32":
-            RXEVENTCALLBACKFUNC = WINFUNCTYPE(None, TIndex, POINTER(TCanMsg),c_ulong) # CallbackFunction Prototype for Rx Event Callback using CFUNCTYPE(ReturnValue, Argument1, Argument2,...)
-            
-        else:
-            RXEVENTCALLBACKFUNC = CFUNCTYPE(None, TIndex, POINTER(TCanMsg),c_ulong) # CallbackFunction Prototype for Rx Event Callback using CFUNCTYPE(ReturnValue, Argument1, Argument2,...)
-            
         self.RxEventCallBack = RXEVENTCALLBACKFUNC(CallbackFunc)
-        err = self.so.CanSetRxEventCallback(self.RxEventCallBack)
+        err = self.soCanSetRxEventCallback(self.RxEventCallBack)
         if err < 0:
             self.logger.error('CanSetRxEventCallback with Function {0} raised Error Code {1}'.format(CallbackFunc,err))
         return err
@@ -1283,6 +1864,9 @@ if __name__ == '__main__':
                       help="testing mode:" + \
                            "1=send only, 2=receive only, 3=loop back, 4=send and receive, 5=events, 6=filter", default=1)
 
+    parser.add_option("--profile", action="store_true", dest="profile",
+                      help="time the receive/decode/format/write stages, stack samples to mhsTinyCanDriver.folded", default=False)
+
 
     (options, args) = parser.parse_args()
     if args:
@@ -1329,6 +1913,31 @@ if __name__ == '__main__':
     print(canDriver.FormatCanDeviceStatus(status[1],status[2],status[3]))
 
 
+    # pipeline stage timers and stack sampling for --profile
+    timer = sampler = None
+    if options.profile:
+        import profiling
+        timer = profiling.StageTimer()
+        sampler = profiling.SamplingProfiler()
+        sampler.start()
+
+    def receiveAndPrint(count):
+        if timer is None:
+            for RxMsg in canDriver.CanReceiveAndFormatSimple(canDriver.Index, count=count):
+                print(RxMsg)
+            return
+        t = timer.start()
+        RxMsgs = canDriver._CanReceive(canDriver.Index, count)
+        t = timer.lap('receive', t)
+        decoded = canDriver.DecodeMessages(RxMsgs)
+        t = timer.lap('decode', t)
+        formatted = canDriver.FormatDecodedSimple(decoded)
+        t = timer.lap('format', t)
+        for RxMsg in formatted:
+            print(RxMsg)
+        timer.lap('write', t)
+        timer.frames(len(formatted))
+
     # do test mode forever
     try:
         if testmode == 'receiveOnly':
@@ -1353,9 +1962,7 @@ if __name__ == '__main__':
                 time.sleep(polltime)
                 NumOfRxMsgs = canDriver.CanReceiveGetCount(canDriver.Index)
                 if NumOfRxMsgs > 0:
-                    RxMsgs = canDriver.CanReceiveAndFormatSimple(canDriver.Index, count=NumOfRxMsgs)
-                    for RxMsg in RxMsgs:
-                        print(RxMsgs)
+                    receiveAndPrint(NumOfRxMsgs)
         elif testmode == 'loopBack':
             print ('start', testmode)
             numNotReceived = 0
@@ -1445,9 +2052,11 @@ if __name__ == '__main__':
         elif testmode == 'events':
             print('Set up Events')
             canDriver.CanSetUpEvents()
+            canDriver.CanSetRxBatchEvent(canDriver.RxEventCallback) # prints the frames of every batch
             while True:
                 print('Sending Hello as Integers on ID 0x612')
                 err = canDriver.TransmitData(msgId = 0x610, msgData = [ord(x) for x in "Hello"])
+                print(canDriver.RxEventStats)
                 time.sleep(polltime)
         elif testmode == 'filter':
             myFilterMask = 0x1FFFFFFF
@@ -1469,11 +2078,16 @@ if __name__ == '__main__':
                 myFilterCount = canDriver._CanReceiveGetCount(canDriver.Index)
                 print('{0} Messages in FiFO'.format(myFilterCount))
                 if myFilterCount:
-                    print(canDriver.CanReceiveAndFormatSimple(canDriver.Index,count = myFilterCount))                                       
+                    receiveAndPrint(myFilterCount)
                 time.sleep(polltime)    
     except KeyboardInterrupt:
         pass
 
+    if sampler is not None:
+        sampler.stop()
+        sampler.write('mhsTinyCanDriver.folded')
+        print(timer.totalSummary())
+
     # shutdown
     canDriver.resetCanBus()
     canDriver._CanDownDriver()
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: onchange.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Change-only logging. Cyclic messages mostly repeat their payload,
+#     ChangeFilter keeps the last payload and flags of every ID and lets
+#     a frame pass only if they changed or if the keyframe interval of
+#     the ID has passed. Every frame that passes carries the number of
+#     frames of its ID suppressed before it, so the message rates can be
+#     reconstructed. The totals per ID are saved next to the log, with
+#     the frames suppressed since the last written one (not in the log
+#     yet). Saving them regularly keeps them over a power cut.
+#
+# Usage
+#     >>> changes = onchange.ChangeFilter(keyframeInterval=1.0)
+#     >>> kept, skipped = changes.filter(canDriver._CanReceive(index, count))
+#     >>> lines = [line + onchange.SKIPPED_FORMAT.format(n) for line, n in zip(lines, skipped)]
+#     >>> changes.save('CANlog.txt')
+#
+# ----------------------------------------------------------------------
+
+import os
+import json
+import time
+
+COUNTS_SUFFIX = '.counts.json'
+SKIPPED_FORMAT = ', Skipped:{0}' # appended to the text log lines
+
+
+class ChangeFilter:
+    """
+    Lets frames pass on payload change or after the keyframe interval
+    """
+    def __init__(self, keyframeInterval=1.0):
+        """
+        Class Constructor
+        @param keyframeInterval: seconds after which an unchanged frame is written anyway
+        @return: nothing
+        """
+        self.keyframeInterval = keyframeInterval
+        # per ID: [flags, data, time of the last written frame, suppressed since then, written, suppressed total]
+        self.table = {}
+
+    def filter(self, msgs, now=None):
+        """
+        Filter received frames
+        @param msgs: TCanMsgs, e.g. the result of _CanReceive
+        @param now: host time in seconds, used for frames without hardware timestamp
+        @return: (list of TCanMsgs to write, list of the frames suppressed before each of them)
+        """
+        if isinstance(msgs, int):
+            return [], []
+        if now is None:
+            now = time.monotonic()
+        table = self.table
+        interval = self.keyframeInterval
+        kept = []
+        skipped = []
+        for msg in msgs:
+            t = msg.Sec + msg.USec * 1e-6 or now
+            data = bytes(msg.Data)
+            flags = msg.Flags.Uint32
+            entry = table.get(msg.Id)
+            if entry is None:
+                table[msg.Id] = [flags, data, t, 0, 1, 0]
+                kept.append(msg)
+                skipped.append(0)
+            elif entry[1] == data and entry[0] == flags and 0 <= t - entry[2] < interval:
+                entry[3] += 1
+                entry[5] += 1
+            else:
+                kept.append(msg)
+                skipped.append(entry[3])
+                entry[0] = flags
+                entry[1] = data
+                entry[2] = t
+                entry[3] = 0
+                entry[4] += 1
+        return kept, skipped
+
+    def counts(self):
+        """
+        @return: dictionary of ID: (frames written, frames suppressed)
+        """
+        return dict((msgId, (entry[4], entry[5])) for msgId, entry in self.table.items())
+
+    def save(self, logFileName):
+        """
+        Write the counters per ID to <logFileName>.counts.json, atomically, so it can be called
+        regularly while logging; pending are the frames suppressed after the last written one
+        @return: Nothing
+        """
+        counts = dict(('{0:08x}'.format(msgId), {'written':entry[4], 'suppressed':entry[5], 'pending':entry[3]})
+                      for msgId, entry in self.table.items())
+        tmpFileName = logFileName + COUNTS_SUFFIX + '.tmp'
+        with open(tmpFileName, 'w') as f:
+            json.dump({'keyframeInterval':self.keyframeInterval, 'ids':counts}, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpFileName, logFileName + COUNTS_SUFFIX)
+
+    def __str__(self):
+        written = sum(entry[4] for entry in self.table.values())
+        suppressed = sum(entry[5] for entry in self.table.values())
+        return 'On change: {0} IDs, {1} frames written, {2} suppressed'.format(len(self.table), written, suppressed)
@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: profiling.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Profiling mode of the CAN logging pipeline (--profile).
+#     StageTimer measures the time spent in each stage of the pipeline
+#     (receive, decode, format, write) and prints a summary of the time
+#     per stage per 10000 frames.
+#     SamplingProfiler samples the stack of the logging thread from a
+#     background thread and writes the stacks in the folded format of
+#     flamegraph.pl / speedscope ("frame;frame;frame count" per line).
+#
+# Usage
+#     >>> timer = profiling.StageTimer()
+#     >>> t = timer.start()
+#     >>> msgs = canDriver._CanReceive(index, count)
+#     >>> t = timer.lap('receive', t)
+#     >>> timer.frames(len(msgs))
+#     >>> sampler = profiling.SamplingProfiler()
+#     >>> sampler.start()
+#     >>> sampler.stop(); sampler.write('canpi.folded')
+#     $ flamegraph.pl canpi.folded > canpi.svg
+#
+# ----------------------------------------------------------------------
+
+import os
+import sys
+import time
+import threading
+import collections
+import uselogging
+
+STAGES = ['receive', 'decode', 'format', 'write']
+REPORT_FRAMES = 10000
+
+
+class StageTimer:
+    """
+    Accumulated time per pipeline stage, summary every reportFrames frames
+    """
+    def __init__(self, stages=STAGES, reportFrames=REPORT_FRAMES, output=None):
+        """
+        Class Constructor
+        @param stages: names of the stages in pipeline order
+        @param reportFrames: number of frames per summary
+        @param output: function taking the summary line, print if None
+        @return: nothing
+        """
+        self.stages = list(stages)
+        self.reportFrames = reportFrames
+        self.output = output or print
+        self.times = dict.fromkeys(self.stages, 0.0)
+        self.totals = dict.fromkeys(self.stages, 0.0)
+        self.count = 0
+        self.totalCount = 0
+
+    def start(self):
+        return time.perf_counter()
+
+    def lap(self, stage, t):
+        """
+        Add the time since t to a stage
+        @param stage: name of the stage
+        @param t: result of start() or of the previous lap()
+        @return: current time, start of the next stage
+        """
+        now = time.perf_counter()
+        self.times[stage] = self.times.get(stage, 0.0) + now - t
+        return now
+
+    def frames(self, n):
+        """
+        Count the frames that went through the pipeline, prints a summary every reportFrames frames
+        @param n: number of frames
+        @return: Nothing
+        """
+        self.count += n
+        if self.count >= self.reportFrames:
+            self.output(self.summary())
+            for stage, t in self.times.items():
+                self.totals[stage] = self.totals.get(stage, 0.0) + t
+            self.times = dict.fromkeys(self.stages, 0.0)
+            self.totalCount += self.count
+            self.count = 0
+
+    def summary(self, times=None, count=None):
+        """
+        Time per stage per reportFrames frames
+        @return: String
+        """
+        if times is None:
+            times, count = self.times, self.count
+        if not count:
+            return 'no frames'
+        scale = self.reportFrames / count
+        total = sum(times.values())
+        parts = ['{0} {1:.1f} ms'.format(stage, times[stage] * scale * 1e3) for stage in times]
+        return 'per {0} frames: {1}, total {2:.1f} ms'.format(self.reportFrames, ', '.join(parts), total * scale * 1e3)
+
+    def totalSummary(self):
+        times = dict((stage, self.totals.get(stage, 0.0) + self.times.get(stage, 0.0)) for stage in self.times)
+        return self.summary(times, self.totalCount + self.count)
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Samples the stack of one thread periodically, folded stacks for flame graphs
+    """
+    def __init__(self, interval=0.005, threadId=None):
+        """
+        Class Constructor
+        @param interval: seconds between the samples
+        @param threadId: thread to sample, the calling thread if None
+        @return: nothing
+        """
+        threading.Thread.__init__(self, name='SamplingProfiler')
+        self.daemon = True
+        self.interval = interval
+        self.threadId = threadId if threadId is not None else threading.get_ident()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def write(self, fileName):
+        """
+        Write the folded stacks, input for flamegraph.pl or speedscope
+        @param fileName: output file
+        @return: Nothing
+        """
+        with open(fileName, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{0} {1}\n'.format(stack, count))
+        uselogging.getLogger().info('{0} samples written to {1}'.format(self.samples, fileName))
@@ -0,0 +1,382 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: reconnect.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Automatic reconnect after the adapter was unplugged or the USB
+#     connection dropped. ReconnectMonitor takes the FIFO fill level the
+#     poll loop reads anyway: an error code, a PnP disconnect event, a
+#     status event or a device status below DRV_STATUS_CAN_OPEN (queried
+#     every statusInterval seconds) marks the device lost. Until it is
+#     back the poll loop calls check() as usual, the device is reopened
+#     right away on a PnP connect event and otherwise with a retry interval
+#     doubling up to maxRetryInterval. reopenDevice of the driver uses the
+#     compiled option strings and restores the filters and interval
+#     messages. The callbacks only set flags, the reopen runs in the poll
+#     loop and not on the driver thread. The close and open of the reopen
+#     raise status and PnP events of their own: loss events during the
+#     reopen and settleTime seconds after it are ignored, a device lost
+#     again in that time shows by the error code or the status query.
+#     The log stays open, onLost is called when the device is lost (e.g.
+#     to flush the log), onGap with the session times of the gap when it
+#     is back. The gaps are saved next to the log (<log>.gaps.json), the
+#     log itself gets no marker so its readers are not affected. Calling
+#     save() from onLost and onGap keeps the file current, an open gap is
+#     saved with duration null.
+#     FakeDriver stands in for the adapter and can be unplugged, the self
+#     check (python reconnect.py) runs the reconnect against it.
+#
+# Usage
+#     >>> link = reconnect.ReconnectMonitor(canDriver, clock, onLost=log.flush,
+#     ...                                   onGap=lambda start, end: link.save('CANlog.txt'))
+#     >>> count = canDriver._CanReceiveGetCount(canDriver.Index)
+#     >>> if not link.check(count): time.sleep(link.sleepTime())
+#     >>> link.save('CANlog.txt')
+#
+#     python reconnect.py       (self check with FakeDriver)
+#
+# ----------------------------------------------------------------------
+
+import os
+import json
+import time
+import ctypes
+import uselogging
+from mhsTinyCanDriver import DRV_STATUS_CAN_OPEN, DRV_STATUS_CAN_RUN, DRV_STATUS_PORT_NOT_OPEN, \
+                             DRIVER_STATUS_MODES, EVENT_ENABLE_PNP_CHANGE, EVENT_ENABLE_STATUS_CHANGE, TDeviceStatus
+
+GAPS_SUFFIX = '.gaps.json'
+
+
+class ReconnectMonitor:
+    """
+    Detects a lost device and reopens it from the poll loop
+    """
+    def __init__(self, canDriver, clock=None, onLost=None, onGap=None, statusInterval=0.5,
+                 retryInterval=0.02, maxRetryInterval=1.0, settleTime=0.2, events=True):
+        """
+        Class Constructor
+        @param canDriver: opened MhsTinyCanDriver
+        @param clock: timesync.SessionClock for the gap times, time.monotonic if None
+        @param onLost: function(start) called when the device is lost
+        @param onGap: function(start, end) called when the device is back
+        @param statusInterval: seconds between the device status queries while connected
+        @param retryInterval: seconds to the first reopen attempt, doubled after every failed one
+        @param maxRetryInterval: longest time between two reopen attempts
+        @param settleTime: seconds after a reopen the loss events of the driver are ignored
+        @param events: use the PnP and status events of the driver
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.canDriver = canDriver
+        self.now = clock.now if clock is not None else time.monotonic
+        self.onLost = onLost
+        self.onGap = onGap
+        self.statusInterval = statusInterval
+        self.firstRetry = retryInterval
+        self.maxRetryInterval = maxRetryInterval
+        self.connected = True
+        self.lost = False # set by the event callbacks on the driver thread
+        self.plugged = False
+        self.settleTime = settleTime
+        self.ignoreLossUntil = 0.0 # monotonic time, infinite during a reopen
+        self.lastStatus = time.monotonic()
+        self.retryInterval = retryInterval
+        self.nextRetry = 0.0
+        self.gapStart = None
+        self.gaps = [] # (start, end) session seconds
+        self.reconnects = 0
+        self.attempts = 0
+        if events:
+            self.attach()
+
+    def attach(self):
+        """
+        Set the PnP and status event callbacks of the driver
+        @return: Nothing
+        """
+        self.canDriver._CanSetPnPEventCallback(self.pnpEvent)
+        self.canDriver._CanSetStatusEventCallback(self.statusEvent)
+        self.canDriver.CanSetEvents(EVENT_ENABLE_PNP_CHANGE | EVENT_ENABLE_STATUS_CHANGE)
+
+    def pnpEvent(self, index, status):
+        """
+        PnP event callback, driver thread
+        @param status: 0 = disconnect, 1 = connect
+        """
+        if status:
+            self.plugged = True
+        elif time.monotonic() >= self.ignoreLossUntil:
+            self.lost = True
+
+    def statusEvent(self, index, deviceStatusPointer):
+        """
+        Status event callback, driver thread
+        """
+        if deviceStatusPointer.contents.DrvStatus < DRV_STATUS_CAN_OPEN and time.monotonic() >= self.ignoreLossUntil:
+            self.lost = True
+
+    def check(self, count):
+        """
+        Called every poll with the FIFO fill level
+        @param count: result of _CanReceiveGetCount
+        @return: True if the device is connected and the FIFO can be read
+        """
+        if self.connected:
+            if count >= 0 and not self.lost:
+                now = time.monotonic()
+                if now - self.lastStatus < self.statusInterval:
+                    return True
+                self.lastStatus = now
+                err, drvStatus, canStatus, fifoStatus = self.canDriver._CanGetDeviceStatus(self.canDriver.Index)
+                if err >= 0 and drvStatus >= DRV_STATUS_CAN_OPEN:
+                    return True
+                self.disconnected(err if err < 0 else DRIVER_STATUS_MODES.get(drvStatus, drvStatus))
+            else:
+                self.disconnected(count if count < 0 else 'event')
+        if self.plugged or time.monotonic() >= self.nextRetry:
+            self.reopen()
+        return self.connected
+
+    def disconnected(self, reason):
+        """
+        Start a gap
+        @param reason: error code or status for the log
+        @return: Nothing
+        """
+        self.connected = False
+        self.gapStart = self.now()
+        self.retryInterval = self.firstRetry
+        self.nextRetry = time.monotonic() + self.retryInterval
+        self.logger.error('CAN device lost ({0}) at {1:.3f}s'.format(reason, self.gapStart))
+        if self.onLost is not None:
+            self.onLost(self.gapStart)
+
+    def reopen(self):
+        """
+        One reopen attempt, on success the gap ends
+        @return: True if the device is back
+        """
+        self.plugged = False
+        self.attempts += 1
+        self.ignoreLossUntil = float('inf') # events of the close and open in reopenDevice
+        try:
+            err = self.canDriver.reopenDevice()
+        finally:
+            self.ignoreLossUntil = time.monotonic() + self.settleTime
+        if err < 0:
+            self.retryInterval = min(self.retryInterval * 2, self.maxRetryInterval)
+            self.nextRetry = time.monotonic() + self.retryInterval
+            return False
+        self.lost = False
+        self.plugged = False
+        self.connected = True
+        self.reconnects += 1
+        self.lastStatus = time.monotonic()
+        gap = (self.gapStart, self.now())
+        self.gaps.append(gap)
+        self.logger.error('CAN device back after {0:.3f}s'.format(gap[1] - gap[0]))
+        if self.onGap is not None:
+            self.onGap(*gap)
+        return True
+
+    def sleepTime(self):
+        """
+        @return: seconds to sleep while disconnected, until the next reopen attempt
+        """
+        return max(0.0, min(self.nextRetry - time.monotonic(), self.firstRetry))
+
+    def save(self, logFileName):
+        """
+        Write the gaps to <logFileName>.gaps.json, atomically, a power cut leaves the old or the new file
+        @return: Nothing
+        """
+        gaps = [{'start':start, 'duration':end - start} for start, end in self.gaps]
+        if not self.connected:
+            gaps.append({'start':self.gapStart, 'duration':None})
+        tmpFileName = logFileName + GAPS_SUFFIX + '.tmp'
+        with open(tmpFileName, 'w') as f:
+            json.dump({'reconnects':self.reconnects, 'gaps':gaps}, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpFileName, logFileName + GAPS_SUFFIX)
+
+    def __str__(self):
+        return 'Reconnect: {0} gaps, {1:.3f}s total, {2} reopen attempts'.format(
+            len(self.gaps), sum(end - start for start, end in self.gaps), self.attempts)
+
+
+class FakeDriver:
+    """
+    Stand-in for an opened MhsTinyCanDriver with the calls ReconnectMonitor uses, can be unplugged
+    """
+    def __init__(self, failedOpens=0):
+        """
+        Class Constructor
+        @param failedOpens: reopen attempts failing after a plug in, as if the device was not enumerated yet
+        @return: nothing
+        """
+        self.Index = None
+        self.present = True # plugged in
+        self.open = True
+        self.failedOpens = failedOpens
+        self.failing = 0
+        self.opens = 0
+        self.events = 0
+        self.pnpCallback = None
+        self.statusCallback = None
+        self.lateEvents = [] # status events of a reopen the driver thread delivers afterwards
+
+    def _CanSetPnPEventCallback(self, callback):
+        self.pnpCallback = callback
+
+    def _CanSetStatusEventCallback(self, callback):
+        self.statusCallback = callback
+
+    def CanSetEvents(self, events):
+        self.events = events
+
+    def _CanReceiveGetCount(self, index):
+        while self.lateEvents:
+            self.statusEvent(self.lateEvents.pop(0))
+        return 0 if self.open else -1
+
+    def statusEvent(self, drvStatus):
+        if self.events & EVENT_ENABLE_STATUS_CHANGE:
+            status = TDeviceStatus()
+            status.DrvStatus = drvStatus
+            self.statusCallback(self.Index, ctypes.pointer(status))
+
+    def _CanGetDeviceStatus(self, index):
+        return 0, DRV_STATUS_CAN_RUN if self.open else DRV_STATUS_PORT_NOT_OPEN, 0, 0
+
+    def unplug(self, event=True):
+        """
+        @param event: send the PnP disconnect event, otherwise only the calls fail
+        """
+        self.present = False
+        self.open = False
+        if event and self.events & EVENT_ENABLE_PNP_CHANGE:
+            self.pnpCallback(self.Index, 0)
+
+    def plug(self, event=True):
+        self.present = True
+        self.failing = self.failedOpens
+        if event and self.events & EVENT_ENABLE_PNP_CHANGE:
+            self.pnpCallback(self.Index, 1)
+
+    def reopenDevice(self):
+        self.opens += 1
+        self.statusEvent(DRV_STATUS_PORT_NOT_OPEN) # the close
+        if not self.present:
+            return -1
+        if self.failing:
+            self.failing -= 1
+            return -1
+        self.open = True
+        self.lateEvents.append(DRV_STATUS_PORT_NOT_OPEN)
+        return 0
+
+
+def SelfCheck(logFileName, timeout=2.0):
+    """
+    Unplug and plug a FakeDriver, with and without the PnP events, and check gaps, backoff and gap file
+    @param logFileName: log file name the gaps are saved for
+    @param timeout: seconds to wait for a reconnect
+    @return: ReconnectMonitor of the check
+    @raise AssertionError: if a check fails
+    """
+    canDriver = FakeDriver(failedOpens=2)
+    lost = []
+    gaps = []
+
+    def onLost(start):
+        lost.append(start)
+        link.save(logFileName)
+
+    def onGap(start, end):
+        gaps.append((start, end))
+        link.save(logFileName)
+
+    def savedGaps():
+        with open(logFileName + GAPS_SUFFIX) as f:
+            return json.load(f)['gaps']
+
+    link = ReconnectMonitor(canDriver, onLost=onLost, onGap=onGap,
+                            statusInterval=0.01, retryInterval=0.01, maxRetryInterval=0.04)
+
+    def poll(until):
+        deadline = time.monotonic() + timeout
+        while link.check(canDriver._CanReceiveGetCount(canDriver.Index)) != until:
+            assert time.monotonic() < deadline, 'no {0} within {1}s'.format('reconnect' if until else 'loss', timeout)
+            time.sleep(link.sleepTime() if not link.connected else 0.005)
+
+    assert link.check(0) and canDriver.events & EVENT_ENABLE_PNP_CHANGE
+    # PnP disconnect, retries with backoff while unplugged
+    canDriver.unplug()
+    assert not link.check(0) and len(lost) == 1
+    assert savedGaps() == [{'start':lost[0], 'duration':None}] # open gap on disk right away
+    start = time.monotonic()
+    while time.monotonic() - start < 0.2:
+        link.check(canDriver._CanReceiveGetCount(canDriver.Index))
+        time.sleep(link.sleepTime())
+    assert 3 <= link.attempts <= 10, 'backoff: {0} attempts in 0.2s'.format(link.attempts)
+    assert link.retryInterval == link.maxRetryInterval
+    # PnP connect retries at once, the first opens fail
+    attempts = link.attempts
+    canDriver.plug()
+    poll(True)
+    assert link.attempts - attempts == canDriver.failedOpens + 1
+    assert link.reconnects == 1 and len(gaps) == 1 and gaps[0][1] - gaps[0][0] >= 0.2
+    assert savedGaps()[0]['duration'] == gaps[0][1] - gaps[0][0]
+    # the status events of the reopen, also the ones coming after it, start no new gap
+    for i in range(10):
+        assert link.check(canDriver._CanReceiveGetCount(canDriver.Index)) and len(lost) == 1
+        time.sleep(0.005)
+    # no events, the error code of the FIFO count shows the loss
+    canDriver.events = 0
+    canDriver.unplug(event=False)
+    poll(False)
+    canDriver.plug(event=False)
+    poll(True)
+    assert link.reconnects == 2 and len(lost) == 2 and len(gaps) == 2
+    # a status below DRV_STATUS_CAN_OPEN while the FIFO count still works
+    canDriver.open = False
+    canDriver._CanReceiveGetCount = lambda index: 0
+    poll(False)
+    canDriver.open = True
+    poll(True)
+    assert link.reconnects == 3
+    link.save(logFileName)
+    with open(logFileName + GAPS_SUFFIX) as f:
+        record = json.load(f)
+    assert record['reconnects'] == 3 and len(record['gaps']) == 3
+    assert all(gap['duration'] >= 0 for gap in record['gaps'])
+    return link
+
+
+if __name__ == '__main__':
+
+    import tempfile
+    from optparse import OptionParser
+
+    parser = OptionParser('usage: %prog')
+    (options, args) = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpDir:
+        print(SelfCheck(os.path.join(tmpDir, 'CANlog.txt')))
+    print('ok')
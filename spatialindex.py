@@ -0,0 +1,319 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: spatialindex.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Spatial index over the logged GPS tracks. The tracks are cut into
+#     visits of geohash tiles (precision 7, about 150m x 150m). Every visit
+#     keeps its exact bounding box, the time span, the data file, the byte
+#     offsets of the first and last line and the trip. The visits are
+#     stored in a sqlite database (DataLogs/spatialindex.db) indexed by
+#     tile, a bounding box or radius query is a handful of tile prefix
+#     range scans and does not touch any data file.
+#     Archives are indexed once when they are produced (indexArchive).
+#
+# Usage
+#     >>> index = spatialindex.SpatialIndex('DataLogs/spatialindex.db')
+#     >>> index.indexArchive('DataLogs/2014-12-19/2014-12-19-001-Data.zip')
+#     >>> index.queryRadius(49.4521, 11.0767, 50)
+#
+# ----------------------------------------------------------------------
+
+import os
+import io
+import csv
+import math
+import sqlite3
+import compression
+import uselogging
+import tripindex
+import timesync
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+TILE_PRECISION = 7
+DEFAULT_DATABASE = os.path.join(os.curdir, 'DataLogs', 'spatialindex.db')
+
+# approximate tile size in degrees (lat, lon) for the geohash precisions 1..12
+GEOHASH_TILE_SIZE = [None] + [(180.0 / 2 ** ((5 * p) // 2), 360.0 / 2 ** ((5 * p + 1) // 2)) for p in range(1, 13)]
+
+
+def GeohashEncode(lat, lon, precision=TILE_PRECISION):
+    """
+    Encode a position as geohash
+    @param lat: latitude in degrees
+    @param lon: longitude in degrees
+    @param precision: number of characters
+    @return: geohash string
+    """
+    latRange = [-90.0, 90.0]
+    lonRange = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    ch = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lonRange[0] + lonRange[1]) / 2
+            if lon >= mid:
+                ch = (ch << 1) | 1
+                lonRange[0] = mid
+            else:
+                ch <<= 1
+                lonRange[1] = mid
+        else:
+            mid = (latRange[0] + latRange[1]) / 2
+            if lat >= mid:
+                ch = (ch << 1) | 1
+                latRange[0] = mid
+            else:
+                ch <<= 1
+                latRange[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_BASE32[ch])
+            bits = 0
+            ch = 0
+    return ''.join(chars)
+
+
+def CoveringPrefixes(minLat, minLon, maxLat, maxLon, maxPrefixes=64):
+    """
+    Geohash prefixes covering a bounding box, as fine as possible with at most maxPrefixes
+    @param minLat, minLon, maxLat, maxLon: bounding box in degrees
+    @param maxPrefixes: upper limit of prefixes (range scans) to return
+    @return: set of geohash prefixes
+    """
+    for precision in range(TILE_PRECISION, 0, -1):
+        dLat, dLon = GEOHASH_TILE_SIZE[precision]
+        nLat = int((maxLat - minLat) / dLat) + 2
+        nLon = int((maxLon - minLon) / dLon) + 2
+        if nLat * nLon > maxPrefixes * 4 and precision > 1:
+            continue
+        prefixes = set()
+        for i in range(nLat + 1):
+            lat = min(maxLat, minLat + i * dLat)
+            for j in range(nLon + 1):
+                lon = min(maxLon, minLon + j * dLon)
+                prefixes.add(GeohashEncode(lat, lon, precision))
+        if len(prefixes) <= maxPrefixes or precision == 1:
+            return prefixes
+    return set(GEOHASH_BASE32)
+
+
+class SpatialIndex:
+    """
+    Tile visits of the GPS tracks in a sqlite database
+    """
+    def __init__(self, dbFileName=DEFAULT_DATABASE, tripIndexDir=None):
+        """
+        Class Constructor
+        @param dbFileName: sqlite database, created if missing
+        @param tripIndexDir: directory of the *.tripindex.json files to resolve trips, None for no trips
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.db = sqlite3.connect(dbFileName)
+        self.db.execute('CREATE TABLE IF NOT EXISTS visits (tile TEXT, file TEXT, trip INTEGER, '
+                        'tstart REAL, tend REAL, offsetfirst INTEGER, offsetlast INTEGER, '
+                        'minlat REAL, minlon REAL, maxlat REAL, maxlon REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS visits_tile ON visits (tile)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, mtime REAL)')
+        self.db.commit()
+        self.trips = []
+        if tripIndexDir:
+            self.trips = [(trip['start'], trip['end'], trip['id']) for name, trip in tripindex.FindTrips(tripIndexDir)]
+        self.visit = None
+
+    def tripAt(self, t):
+        for start, end, tripId in self.trips:
+            if start <= t <= end:
+                return tripId
+        return None
+
+    def addPoint(self, lat, lon, t, fileName, offset):
+        """
+        Add a position, consecutive positions within one tile form one visit
+        @param lat, lon: position in degrees
+        @param t: timestamp of the position
+        @param fileName: data file, stored by basename
+        @param offset: byte offset of the line in the data file
+        @return: Nothing
+        """
+        if not (lat or lon): # no fix
+            return
+        tile = GeohashEncode(lat, lon)
+        v = self.visit
+        if v and v[0] == tile and v[1] == fileName:
+            v[4] = t
+            v[6] = offset
+            if lat < v[7]: v[7] = lat
+            if lon < v[8]: v[8] = lon
+            if lat > v[9]: v[9] = lat
+            if lon > v[10]: v[10] = lon
+            return
+        self.endVisit()
+        self.visit = [tile, fileName, self.tripAt(t), t, t, offset, offset, lat, lon, lat, lon]
+
+    def endVisit(self):
+        if self.visit:
+            self.db.execute('INSERT INTO visits VALUES (?,?,?,?,?,?,?,?,?,?,?)', self.visit)
+            self.visit = None
+
+    def flush(self):
+        self.endVisit()
+        self.db.commit()
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def indexCsv(self, f, fileName, latKey='latitude', lonKey='longitude'):
+        """
+        Index a csv data file as written by the GPS logger
+        @param f: binary file object of the csv data
+        @param fileName: name of the data file
+        @param latKey, lonKey: column names of the position
+        @return: number of positions indexed
+        """
+        name = os.path.basename(fileName)
+        offset = 0
+        header = None
+        count = 0
+        for line in f:
+            lineOffset = offset
+            offset += len(line)
+            try:
+                row = next(csv.reader([line.decode('utf-8', 'replace')]))
+            except (csv.Error, StopIteration):
+                continue
+            if header is None:
+                header = dict((key, i) for i, key in enumerate(row))
+                if latKey not in header or lonKey not in header:
+                    self.logger.error('No position columns in {0}'.format(fileName))
+                    return 0
+                continue
+            try:
+                lat = float(row[header[latKey]])
+                lon = float(row[header[lonKey]])
+            except (ValueError, IndexError):
+                continue # truncated line
+            self.addPoint(lat, lon, RowTime(row, header), name, lineOffset)
+            count += 1
+        self.endVisit()
+        return count
+
+    def indexArchive(self, archiveFileName):
+        """
+        Index all csv files in an archive, archives already indexed are skipped
+        @param archiveFileName: zip archive or compressed stream (see compression.py)
+        @return: number of positions indexed
+        """
+        mtime = os.path.getmtime(archiveFileName)
+        row = self.db.execute('SELECT mtime FROM sources WHERE name=?', (archiveFileName,)).fetchone()
+        if row and row[0] == mtime:
+            return 0
+        count = 0
+        for member, f in compression.OpenArchive(archiveFileName):
+            self.db.execute('DELETE FROM visits WHERE file=?', (os.path.basename(member),))
+            count += self.indexCsv(f, member)
+        self.db.execute('INSERT OR REPLACE INTO sources VALUES (?,?)', (archiveFileName, mtime))
+        self.flush()
+        self.logger.info('Indexed {0} positions of {1}'.format(count, archiveFileName))
+        return count
+
+    def queryBBox(self, minLat, minLon, maxLat, maxLon):
+        """
+        Find the visits within a bounding box
+        @param minLat, minLon, maxLat, maxLon: bounding box in degrees
+        @return: list of visit dictionaries sorted by time
+        """
+        self.flush()
+        result = []
+        for prefix in CoveringPrefixes(minLat, minLon, maxLat, maxLon):
+            for row in self.db.execute('SELECT * FROM visits WHERE tile >= ? AND tile < ? '
+                                       'AND maxlat >= ? AND minlat <= ? AND maxlon >= ? AND minlon <= ?',
+                                       (prefix, prefix + '~', minLat, maxLat, minLon, maxLon)):
+                result.append({'tile':row[0], 'file':row[1], 'trip':row[2], 'start':row[3], 'end':row[4],
+                               'offsetFirst':row[5], 'offsetLast':row[6], 'bbox':list(row[7:11])})
+        result.sort(key=lambda v: v['start'])
+        return result
+
+    def queryRadius(self, lat, lon, radius):
+        """
+        Find the visits within a radius around a position
+        @param lat, lon: center in degrees
+        @param radius: radius in meters
+        @return: list of visit dictionaries sorted by time
+        """
+        dLat = math.degrees(radius / tripindex.EARTH_RADIUS)
+        dLon = dLat / max(0.01, math.cos(math.radians(lat)))
+        result = []
+        for v in self.queryBBox(lat - dLat, lon - dLon, lat + dLat, lon + dLon):
+            b = v['bbox']
+            nearLat = min(max(lat, b[0]), b[2])
+            nearLon = min(max(lon, b[1]), b[3])
+            if tripindex.Haversine(lat, lon, nearLat, nearLon) <= radius:
+                result.append(v)
+        return result
+
+
+def RowTime(row, header):
+    """
+    Timestamp of a csv row, GPS date and time if available, millis otherwise
+    @return: float seconds
+    """
+    try:
+        return timesync.GpsDateTime2Epoch(int(row[header['date']]), int(row[header['time']]))
+    except (KeyError, ValueError, IndexError):
+        pass
+    try:
+        return float(row[header['millis']]) / 1000.0
+    except (KeyError, ValueError, IndexError):
+        return 0.0
+
+
+if __name__ == '__main__':
+
+    import time
+    from optparse import OptionParser
+
+    parser = OptionParser('usage: %prog [options] lat lon radius\n       %prog -b [options] datadir')
+    parser.add_option('-d', action='store', type='string', dest='db', metavar='DB',
+                      help='index database, default = ' + DEFAULT_DATABASE, default=DEFAULT_DATABASE)
+    parser.add_option('-b', action='store_true', dest='build',
+                      help='index all new archives of datadir', default=False)
+    (options, args) = parser.parse_args()
+
+    if options.build:
+        dataDir = args[0] if args else os.path.join(os.curdir, 'DataLogs')
+        index = SpatialIndex(options.db, tripIndexDir=dataDir)
+        for root, dirs, files in os.walk(dataDir):
+            for name in sorted(files):
+                if compression.IsArchive(name):
+                    index.indexArchive(os.path.join(root, name))
+        index.close()
+    else:
+        if len(args) != 3:
+            parser.error('incorrect number of arguments')
+        index = SpatialIndex(options.db)
+        t = time.time()
+        visits = index.queryRadius(float(args[0]), float(args[1]), float(args[2]))
+        for v in visits:
+            print('{0} trip {1} {2} bytes {3}-{4}'.format(v['file'], v['trip'],
+                  time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(v['start'])), v['offsetFirst'], v['offsetLast']))
+        print('{0} visits in {1:.3f}s'.format(len(visits), time.time() - t))
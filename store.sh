@@ -1,3 +1,3 @@
 #!/bin/sh
 
-rsync -rvtW --include='*.zip' --exclude='*.csv' /home/pi/CarPC/DataLogs/ /mnt/storage/
+rsync -rvtW --include='*.zip' --include='*.csv.xz' --include='*.csv.zst' --include='*.csv.lz4' --exclude='*.csv' --exclude='*.cpfl' /home/pi/CarPC/DataLogs/ /mnt/storage/
@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: textformat.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Fast CANlog.txt lines. CanReceiveAndFormatSimple formats every
+#     frame with SIMPLE_FORMAT and hex() of every data byte. TextFormatter
+#     gives byte identical lines from tables instead: the strings of the
+#     256 data byte values (with the separator or the end of the line)
+#     are built once, the line start up to 'Data:[' is built once per ID
+#     and flags and cached. The messages are unpacked from the raw buffer
+#     of the receive array with struct, a batch becomes one bytes buffer.
+#     Classic frames only, CAN FD lines still come from the driver.
+#
+# Usage
+#     >>> formatter = textformat.TextFormatter()
+#     >>> log.write(formatter.encode(canDriver._CanReceive(index, count)))
+#     >>> lines = formatter.lines(msgs)   # strings without line end
+#
+#     python benchmarks.py text
+#
+# ----------------------------------------------------------------------
+
+import struct
+from ctypes import Array
+from mhsTinyCanDriver import SIMPLE_FORMAT
+
+# TCanMsg as native struct: Id, Flags, Data[8], Sec, USec (c_ulong is 'L' on every platform,
+# the size equals sizeof(TCanMsg) with native alignment)
+MSG_STRUCT = struct.Struct('@LL8BLL')
+
+# data byte strings as in str() of the list of hex() strings
+HEX_SEP = tuple("'{0}', ".format(hex(x)) for x in range(256))
+HEX_END = tuple("'{0}']".format(hex(x)) for x in range(256))
+HEX_END_LINE = tuple(s + '\n' for s in HEX_END)
+
+PREFIX_CACHE_SIZE = 4096 # cached line starts, cleared when full
+
+
+def LinePrefix(msgId, flags):
+    """
+    Start of a line up to and including 'Data:['
+    @param flags: TCANFlags.Uint32
+    @return: String
+    """
+    return SIMPLE_FORMAT.format(msgId, flags & 0xf, (flags >> 4) & 1, (flags >> 6) & 1, (flags >> 7) & 1, (flags >> 8) & 0xff, '[')
+
+
+class TextFormatter:
+    """
+    CanReceiveAndFormatSimple lines from precomputed strings
+    """
+    def __init__(self, cacheSize=PREFIX_CACHE_SIZE):
+        """
+        Class Constructor
+        @param cacheSize: number of cached line starts (ID, flags)
+        @return: nothing
+        """
+        self.cacheSize = cacheSize
+        self.prefixes = {}
+
+    def unpack(self, msgs):
+        """
+        @param msgs: TCanMsgs, e.g. the result of _CanReceive
+        @return: iterator of (Id, Flags, 8 data bytes, Sec, USec)
+        """
+        if len(self.prefixes) > self.cacheSize:
+            self.prefixes.clear()
+        if isinstance(msgs, Array):
+            return MSG_STRUCT.iter_unpack(msgs)
+        # a slice of the receive array is a list of TCanMsgs
+        return MSG_STRUCT.iter_unpack(b''.join(map(bytes, msgs)))
+
+    def encode(self, msgs, msgIds=None):
+        """
+        Format a batch as one buffer
+        @param msgs: TCanMsgs, e.g. the result of _CanReceive, an error code gives no lines
+        @param msgIds: list the IDs of the messages are appended to, or None
+        @return: bytes, the lines of CanReceiveAndFormatSimple each with '\\n'
+        """
+        if isinstance(msgs, int):
+            return b''
+        prefixes = self.prefixes
+        sep = HEX_SEP
+        end = HEX_END_LINE
+        out = []
+        add = out.extend
+        for msgId, flags, d0, d1, d2, d3, d4, d5, d6, d7, _, _ in self.unpack(msgs):
+            prefix = prefixes.get((msgId, flags))
+            if prefix is None:
+                prefix = prefixes[(msgId, flags)] = LinePrefix(msgId, flags)
+            add((prefix, sep[d0], sep[d1], sep[d2], sep[d3], sep[d4], sep[d5], sep[d6], end[d7]))
+            if msgIds is not None:
+                msgIds.append(msgId)
+        return ''.join(out).encode()
+
+    def lines(self, msgs):
+        """
+        Format a batch as strings, e.g. to append more fields
+        @param msgs: TCanMsgs, e.g. the result of _CanReceive, an error code gives no lines
+        @return: List of Strings, the lines of CanReceiveAndFormatSimple
+        """
+        if isinstance(msgs, int):
+            return []
+        prefixes = self.prefixes
+        sep = HEX_SEP
+        end = HEX_END
+        out = []
+        for msgId, flags, d0, d1, d2, d3, d4, d5, d6, d7, _, _ in self.unpack(msgs):
+            prefix = prefixes.get((msgId, flags))
+            if prefix is None:
+                prefix = prefixes[(msgId, flags)] = LinePrefix(msgId, flags)
+            out.append(''.join((prefix, sep[d0], sep[d1], sep[d2], sep[d3], sep[d4], sep[d5], sep[d6], end[d7])))
+        return out
@@ -0,0 +1,409 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: timesync.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Time handling for the loggers. Logging starts right away with
+#     monotonic session timestamps, the GPS fix is awaited in a background
+#     thread and the wall clock offset is written to a sidecar file
+#     (<logfile>.time) as soon as it is known. Nothing has to wait for the
+#     GPS any more, the data written before the fix is placed on the wall
+#     clock afterwards by adding the offset from the sidecar.
+#     A system time already synchronized (NTP, chrony, as the kernel clock
+#     state tells) gives the reference at the start, a GPS fix replaces
+#     it later. ConnectGps opens the Tinkerforge GPS Bricklet through
+#     brickd (needs the tinkerforge package).
+#     ClockCorrelator places the hardware timestamps of the CAN adapter
+#     (TCanMsg Sec/USec) on the session clock: a running linear fit of
+#     the lower envelope of (host receive time - device time) corrects
+#     the offset and the drift of the adapter clock, adapter resets (the
+#     device time jumps) start a new fit. Sec is a 32 bit seconds counter,
+#     it does not wrap within a session.
+#
+# Usage
+#     >>> clock = timesync.SessionClock('DataLogs/2014-12-19-001-Data.csv')
+#     >>> if timesync.SystemTimeSynchronized(): clock.setReference(time.time(), source='ntp')
+#     >>> sync = timesync.GpsTimeSync(timesync.ConnectGps('qD5'), clock)
+#     >>> sync.start()
+#     >>> t = clock.now()     # seconds since session start
+#
+#     >>> correlator = timesync.ClockCorrelator(clock)
+#     >>> times = correlator.sessionTimes(canDriver._CanReceive(index, count))
+#
+# ----------------------------------------------------------------------
+
+import os
+import json
+import time
+import ctypes
+import calendar
+import collections
+import threading
+import subprocess
+import uselogging
+import metrics
+
+try:
+    from tinkerforge.ip_connection import IPConnection
+    from tinkerforge.bricklet_gps import BrickletGPS
+except ImportError:
+    IPConnection = BrickletGPS = None
+
+# Fix values as reported by the Tinkerforge GPS Bricklet get_status()
+GPS_FIX_NO_FIX  = 1
+GPS_FIX_2D      = 2
+GPS_FIX_3D      = 3
+
+SIDECAR_SUFFIX  = '.time'
+TIME_ERROR      = 5 # adjtimex clock state: not synchronized
+BRICKD_PORT     = 4223
+TIME_FORMAT     = ', Time:{0:.6f}' # session time appended to the text log lines
+
+
+def GpsDateTime2Epoch(date, gpstime):
+    """
+    Convert the date and time of the Tinkerforge GPS Bricklet to seconds since epoch (UTC)
+    @param date: date as integer ddmmyy
+    @param gpstime: time as integer hhmmssmmm (milliseconds in the last 3 digits)
+    @return: float seconds since epoch
+    """
+    d = '{0:06d}'.format(date)
+    t = '{0:09d}'.format(gpstime)
+    tt = (2000 + int(d[4:6]), int(d[2:4]), int(d[0:2]), int(t[0:2]), int(t[2:4]), int(t[4:6]), 0, 0, 0)
+    return calendar.timegm(tt) + int(t[6:9]) / 1000.0
+
+
+def SystemTimeSynchronized():
+    """
+    Is the system time synchronized by NTP or chrony, from the kernel clock state of adjtimex
+    @return: True if synchronized, False if not or unknown (not Linux)
+    """
+    try:
+        timex = ctypes.create_string_buffer(512) # struct timex, modes = 0 only reads
+        state = ctypes.CDLL(None).adjtimex(timex)
+    except (OSError, AttributeError):
+        return False
+    return 0 <= state < TIME_ERROR
+
+
+def ConnectGps(uid, host='localhost', port=BRICKD_PORT):
+    """
+    Tinkerforge GPS Bricklet for GpsTimeSync
+    @param uid: UID of the bricklet
+    @param host: host of brickd
+    @param port: port of brickd
+    @return: BrickletGPS, connected
+    """
+    if BrickletGPS is None:
+        raise ValueError('GPS needs the tinkerforge package')
+    ipcon = IPConnection()
+    gps = BrickletGPS(uid, ipcon)
+    ipcon.connect(host, port)
+    return gps
+
+
+class SessionClock:
+    """
+    Monotonic session clock with a wall clock offset that may be applied later on.
+    The offset record is kept in a sidecar file next to the log file.
+    """
+    def __init__(self, logFileName=None):
+        """
+        Class Constructor
+        @param logFileName: log file the sidecar belongs to, None for no sidecar
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.monotonicStart = time.monotonic()
+        self.systemStart = time.time()
+        self.offset = None # wall clock = monotonic session time + offset
+        self.source = None
+        self.sidecarFileName = None
+        if logFileName:
+            self.sidecarFileName = logFileName + SIDECAR_SUFFIX
+            self.writeSidecar()
+
+    def now(self):
+        """
+        Seconds since session start from the monotonic clock
+        @return: float seconds
+        """
+        return time.monotonic() - self.monotonicStart
+
+    def hasReference(self):
+        return self.offset is not None
+
+    def setReference(self, wallTime, sessionTime=None, source='gps'):
+        """
+        Set the wall clock reference of the session, retroactively valid for all timestamps
+        @param wallTime: wall clock time (seconds since epoch) at sessionTime
+        @param sessionTime: session time the wallTime belongs to, now if None
+        @param source: name of the time source, e.g. gps or system
+        @return: the offset
+        """
+        if sessionTime is None:
+            sessionTime = self.now()
+        self.offset = wallTime - sessionTime
+        self.source = source
+        self.logger.info('Session clock reference from {0}, offset {1:.3f}'.format(source, self.offset))
+        if self.sidecarFileName:
+            self.writeSidecar()
+        return self.offset
+
+    def toWallTime(self, sessionTime):
+        """
+        Convert a session timestamp to wall clock time
+        @param sessionTime: seconds since session start
+        @return: seconds since epoch or None if there is no reference yet
+        """
+        if self.offset is None:
+            return None
+        return sessionTime + self.offset
+
+    def writeSidecar(self):
+        """
+        Write the offset record atomically, a power cut leaves either the old or the new record
+        @return: Nothing
+        """
+        record = {'monotonicStart':self.monotonicStart,
+                  'systemStart':self.systemStart,
+                  'offset':self.offset,
+                  'source':self.source}
+        tmpFileName = self.sidecarFileName + '.tmp'
+        with open(tmpFileName, 'w') as f:
+            json.dump(record, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpFileName, self.sidecarFileName)
+
+
+def ReadSidecar(logFileName):
+    """
+    Read the offset record of a log file
+    @param logFileName: the log file
+    @return: dictionary of the record or None if there is none
+    """
+    try:
+        with open(logFileName + SIDECAR_SUFFIX) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+class GpsTimeSync(threading.Thread):
+    """
+    Background thread waiting for a GPS fix, sets the reference of one or more session clocks
+    and optionally the system time - without blocking the logging
+    """
+    def __init__(self, gps, clocks, minfix=GPS_FIX_2D, pollInterval=1.0, setSystemTime=False):
+        """
+        Class Constructor
+        @param gps: Tinkerforge GPS Bricklet object, needs get_status() and get_date_time()
+        @param clocks: SessionClock or list of SessionClocks
+        @param minfix: minimum fix to accept the GPS time
+        @param pollInterval: seconds between the GPS polls
+        @param setSystemTime: set the system time by sudo date --set once the fix is there
+        @return: nothing
+        """
+        threading.Thread.__init__(self, name='GpsTimeSync')
+        self.daemon = True
+        self.logger = uselogging.getLogger()
+        self.gps = gps
+        if isinstance(clocks, SessionClock):
+            clocks = [clocks]
+        self.clocks = list(clocks)
+        self.minfix = minfix
+        self.pollInterval = pollInterval
+        self.setSystemTime = setSystemTime
+        self.fix = GPS_FIX_NO_FIX
+        metrics.Gauge('carpc_gps_fix', 'GPS fix while waiting for the time sync (1 = no fix, 2 = 2D, 3 = 3D)',
+                      function=lambda: self.fix)
+        self.synced = threading.Event()
+        self.stopped = threading.Event()
+
+    def addClock(self, clock):
+        """
+        Add a clock of a file opened later on, gets the reference right away if already synced
+        @param clock: SessionClock
+        @return: Nothing
+        """
+        self.clocks.append(clock)
+        if self.synced.is_set() and self.clocks[0].hasReference():
+            ref = self.clocks[0]
+            clock.setReference(ref.toWallTime(ref.now()), clock.now(), source=ref.source)
+
+    def stop(self):
+        self.stopped.set()
+
+    def poll(self):
+        """
+        Poll the GPS once
+        @return: seconds since epoch if the fix is good enough, None otherwise
+        """
+        self.fix = self.gps.get_status()[0]
+        if self.fix < self.minfix:
+            return None
+        date, gpstime = self.gps.get_date_time()
+        return GpsDateTime2Epoch(date, gpstime)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                wallTime = self.poll()
+            except Exception as e:
+                self.logger.error('GPS poll failed: {0}'.format(e))
+                wallTime = None
+            if wallTime is not None:
+                for clock in self.clocks:
+                    clock.setReference(wallTime, source='gps')
+                self.synced.set()
+                if self.setSystemTime:
+                    self.applySystemTime(wallTime)
+                return
+            self.stopped.wait(self.pollInterval)
+
+    def applySystemTime(self, wallTime):
+        """
+        Set the system time without waiting for sudo to finish
+        @param wallTime: seconds since epoch
+        @return: Nothing
+        """
+        datestr = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(wallTime))
+        self.logger.info('Set system time to {0} UTC'.format(datestr))
+        try:
+            subprocess.Popen(['sudo', 'date', '-u', '--set', datestr])
+        except OSError as e:
+            self.logger.error('Could not set system time: {0}'.format(e))
+
+
+class ClockCorrelator:
+    """
+    Running linear fit from the device timestamps of a CAN adapter to the session clock.
+    The host receive time is the device time plus a varying latency, so per bin of binSeconds
+    only the smallest difference (the lower envelope) is kept and the fit goes through those.
+    """
+    def __init__(self, clock, binSeconds=1.0, window=300, maxStep=5.0):
+        """
+        Class Constructor
+        @param clock: SessionClock the timestamps are placed on
+        @param binSeconds: device seconds per sample of the fit
+        @param window: number of samples in the fit, window * binSeconds is the time span
+        @param maxStep: seconds the device clock may differ from the host clock between two batches
+                        before it is taken as a reset of the adapter
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.clock = clock
+        self.binSeconds = binSeconds
+        self.samples = collections.deque(maxlen=window) # (device time - origin, host - device)
+        self.maxStep = maxStep
+        self.origin = None # device time of the first sample
+        self.lastDevice = None
+        self.lastHost = None
+        self.binStart = None
+        self.binMin = None
+        self.offset = 0.0 # session time = device time + offset + drift * (device time - origin)
+        self.drift = 0.0
+        self.resets = 0
+        metrics.Gauge('carpc_can_clock_drift_ppm', 'Drift of the CAN adapter clock against the host clock',
+                      function=lambda: self.drift * 1e6)
+
+    def restart(self, deviceTime):
+        self.origin = deviceTime
+        self.samples.clear()
+        self.binStart = None
+        self.binMin = None
+
+    def observe(self, deviceTime, hostTime=None):
+        """
+        Add a pair of the latest device time of a batch and the host time it was read
+        @param deviceTime: raw device time in seconds (Sec + USec / 1e6)
+        @param hostTime: session time of the read, now if None
+        @return: Nothing
+        """
+        if hostTime is None:
+            hostTime = self.clock.now()
+        if self.lastDevice is not None and abs((deviceTime - self.lastDevice) - (hostTime - self.lastHost)) > self.maxStep:
+            self.resets += 1
+            self.logger.warning('CAN adapter clock jumped by {0:.3f}s, new fit'.format(deviceTime - self.lastDevice))
+            self.restart(deviceTime)
+        self.lastDevice = deviceTime
+        self.lastHost = hostTime
+        if self.origin is None:
+            self.restart(deviceTime)
+        x = deviceTime - self.origin
+        y = hostTime - deviceTime
+        if self.binStart is None:
+            self.binStart = x
+            self.binMin = (x, y)
+            if not self.samples:
+                self.offset = y
+        elif y < self.binMin[1]:
+            self.binMin = (x, y)
+        if x - self.binStart >= self.binSeconds:
+            self.samples.append(self.binMin)
+            self.binStart = None
+            self.fit()
+
+    def fit(self):
+        """
+        Least squares line through the samples
+        @return: Nothing
+        """
+        n = len(self.samples)
+        if n == 1:
+            self.offset = self.samples[0][1]
+            self.drift = 0.0
+            return
+        sx = sy = sxx = sxy = 0.0
+        for x, y in self.samples:
+            sx += x
+            sy += y
+            sxx += x * x
+            sxy += x * y
+        d = n * sxx - sx * sx
+        if d <= 0:
+            return
+        self.drift = (n * sxy - sx * sy) / d
+        self.offset = (sy - self.drift * sx) / n
+
+    def toSession(self, deviceTime):
+        """
+        Session time of a device time
+        @param deviceTime: seconds
+        @return: seconds since session start
+        """
+        return deviceTime + self.offset + self.drift * (deviceTime - self.origin)
+
+    def sessionTimes(self, msgs, hostTime=None):
+        """
+        Session times of a batch of received messages, the batch updates the fit
+        @param msgs: TCanMsgs or TCanFdMsgs, e.g. the result of _CanReceive
+        @param hostTime: session time of the read, now if None
+        @return: list of seconds since session start, the host time for messages without hardware timestamp
+        """
+        if isinstance(msgs, int) or not len(msgs):
+            return []
+        if hostTime is None:
+            hostTime = self.clock.now()
+        last = msgs[len(msgs) - 1]
+        if not (last.Sec or last.USec):
+            return [hostTime] * len(msgs)
+        self.observe(last.Sec + last.USec * 1e-6, hostTime)
+        scale = 1.0 + self.drift
+        base = self.offset - self.drift * self.origin
+        return [(msg.Sec + msg.USec * 1e-6) * scale + base for msg in msgs]
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: tracing.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Sampled tracing of the driver API calls. Tracing is selected once
+#     at import time by the environment variable MHSTCAN_TRACE=<n>, which
+#     traces every n-th call of the hot path functions. Without it no
+#     hooks are installed at all and the calls run at full speed.
+#     Each sample records the duration and result of the call, the
+#     samples are logged at uselogging.LOWLEVEL and summed up per call.
+#
+# Usage
+#     $ MHSTCAN_TRACE=100 python canpi.py
+#     >>> print(canDriver.tracer.report())
+#
+# ----------------------------------------------------------------------
+
+import os
+import time
+import uselogging
+
+# every n-th call is traced, 0 = tracing disabled (no hooks installed)
+TRACE_SAMPLE_RATE = int(os.environ.get('MHSTCAN_TRACE', '0') or 0)
+
+
+class SampledTracer:
+    """
+    Counts all calls of the instrumented functions and times every n-th call
+    """
+    def __init__(self, sampleRate=TRACE_SAMPLE_RATE):
+        """
+        Class Constructor
+        @param sampleRate: every sampleRate-th call is timed
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.sampleRate = max(1, sampleRate)
+        self.stats = {} # name: [calls, samples, total time, max time]
+
+    def wrap(self, name, func):
+        """
+        Wrap a function for sampled tracing
+        @param name: name of the call in the statistics
+        @param func: function to wrap
+        @return: wrapped function
+        """
+        stat = self.stats.setdefault(name, [0, 0, 0.0, 0.0])
+        sampleRate = self.sampleRate
+        logger = self.logger
+        perf_counter = time.perf_counter
+
+        def traced(*args, **kwargs):
+            stat[0] += 1
+            if stat[0] % sampleRate:
+                return func(*args, **kwargs)
+            t0 = perf_counter()
+            result = func(*args, **kwargs)
+            dt = perf_counter() - t0
+            stat[1] += 1
+            stat[2] += dt
+            if dt > stat[3]:
+                stat[3] = dt
+            if logger.isEnabledFor(uselogging.LOWLEVEL):
+                logger.log(uselogging.LOWLEVEL, 'trace %s %.1fus -> %r', name, dt * 1e6, result if isinstance(result, int) else type(result))
+            return result
+        traced.__wrapped__ = func
+        return traced
+
+    def instrument(self, obj, names):
+        """
+        Replace methods of an object by traced versions
+        @param obj: object to instrument, e.g. a MhsTinyCanDriver
+        @param names: method names
+        @return: Nothing
+        """
+        for name in names:
+            setattr(obj, name, self.wrap(name, getattr(obj, name)))
+
+    def report(self):
+        """
+        Summary of the traced calls
+        @return: String with one line per call
+        """
+        lines = []
+        for name in sorted(self.stats):
+            calls, samples, total, tmax = self.stats[name]
+            mean = total / samples if samples else 0.0
+            lines.append('{0}: {1} calls, {2} sampled, mean {3:.1f}us, max {4:.1f}us'.format(name, calls, samples, mean * 1e6, tmax * 1e6))
+        return '\n'.join(lines)
@@ -0,0 +1,325 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: tripindex.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Live trip index maintained by the loggers while writing. A trip ends
+#     when no data arrived for gapTime seconds. Every trip keeps start/end
+#     time, GPS bounding box, distance, max speed, the CAN IDs seen and the
+#     first/last byte offset of every file written during the trip.
+#     The index is a small json file (<name>.tripindex.json) next to the
+#     data, it is rewritten atomically every flushInterval seconds and can
+#     be queried without touching the (zipped) data files.
+#     With a timesync.SessionClock the times are session seconds, which do
+#     not jump when the system time is set. Every trip keeps the wall clock
+#     offset of its session (None until the clock has a reference),
+#     FindTrips returns wall clock times then. renameFile() moves the
+#     entries of a data file that was renamed, e.g. rotated on a restart.
+#
+# Usage
+#     >>> index = tripindex.TripIndex('DataLogs/gps.tripindex.json')
+#     >>> index.addPosition(t, lat, lon, speed)
+#     >>> index.addFileOffset('2014-12-19-001-Data.csv', f.tell(), t)
+#     >>> index = tripindex.TripIndex('CANlog.tripindex.json', clock=clock)
+#     >>> index.renameFile('CANlog.txt', 'CANlog-001.txt')
+#     >>> tripindex.FindTrips('DataLogs', start=t0, end=t1)
+#
+# ----------------------------------------------------------------------
+
+import os
+import json
+import glob
+import math
+import uselogging
+
+INDEX_SUFFIX = '.tripindex.json'
+EARTH_RADIUS = 6371000.0 # meters
+
+
+def Haversine(lat1, lon1, lat2, lon2):
+    """
+    Great circle distance of two positions
+    @param lat1, lon1: first position in degrees
+    @param lat2, lon2: second position in degrees
+    @return: distance in meters
+    """
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def NewTrip(tripId, t, clock=None):
+    trip = {'id':tripId,
+            'start':t,
+            'end':t,
+            'bbox':None, # [minLat, minLon, maxLat, maxLon]
+            'distance':0.0,
+            'maxSpeed':None,
+            'canIds':[],
+            'files':{}}
+    if clock is not None:
+        trip['offset'] = clock.offset # wall clock = session time + offset
+    return trip
+
+
+def WallTimes(trip):
+    """
+    Trip with wall clock times
+    @param trip: trip dictionary
+    @return: the trip itself if its times are wall clock times, a copy with the offset added
+             if it has session times, None if its session has no wall clock reference
+    """
+    if 'offset' not in trip:
+        return trip
+    offset = trip['offset']
+    if offset is None:
+        return None
+    trip = dict(trip, start=trip['start'] + offset, end=trip['end'] + offset)
+    trip['files'] = dict((name, dict(entry, start=entry['start'] + offset, end=entry['end'] + offset))
+                         for name, entry in trip['files'].items())
+    del trip['offset']
+    return trip
+
+
+class TripIndex:
+    """
+    Incrementally updated index of the trips of one logger
+    """
+    def __init__(self, indexFileName, gapTime=300, flushInterval=10, clock=None):
+        """
+        Class Constructor
+        @param indexFileName: json file of the index, loaded if it exists
+        @param gapTime: seconds without data that end a trip
+        @param flushInterval: seconds between writes of the index file
+        @param clock: timesync.SessionClock if the timestamps are session times, None for seconds since epoch
+        @return: nothing
+        """
+        self.logger = uselogging.getLogger()
+        self.indexFileName = indexFileName
+        self.clock = clock
+        self.sessionTrips = [] # trips started with this clock
+        self.gapTime = gapTime
+        self.flushInterval = flushInterval
+        self.trips = LoadTripIndex(indexFileName)
+        self.trip = None
+        self.canIds = set()
+        self.lastPosition = None
+        self.lastFlush = None
+        self.dirty = False
+
+    def currentTrip(self, t):
+        """
+        Get the trip for a timestamp, starts a new trip after a gap
+        @param t: timestamp (seconds since epoch or session time)
+        @return: trip dictionary
+        """
+        trip = self.trip
+        if trip is None or t - trip['end'] > self.gapTime:
+            if trip is not None:
+                self.flush()
+            tripId = self.trips[-1]['id'] + 1 if self.trips else 0
+            trip = NewTrip(tripId, t, self.clock)
+            self.trips.append(trip)
+            self.sessionTrips.append(trip)
+            self.trip = trip
+            self.canIds = set()
+            self.lastPosition = None
+            self.lastFlush = t
+            self.logger.info('Trip {0} started'.format(tripId))
+        elif t > trip['end']:
+            trip['end'] = t
+        self.dirty = True
+        return trip
+
+    def addPosition(self, t, lat, lon, speed=None):
+        """
+        Add a GPS position
+        @param t: timestamp (seconds since epoch or session time)
+        @param lat: latitude in degrees
+        @param lon: longitude in degrees
+        @param speed: speed as logged, None if unknown
+        @return: Nothing
+        """
+        trip = self.currentTrip(t)
+        if lat or lon: # 0,0 means no fix
+            bbox = trip['bbox']
+            if bbox is None:
+                trip['bbox'] = [lat, lon, lat, lon]
+            else:
+                if lat < bbox[0]: bbox[0] = lat
+                if lon < bbox[1]: bbox[1] = lon
+                if lat > bbox[2]: bbox[2] = lat
+                if lon > bbox[3]: bbox[3] = lon
+            if self.lastPosition:
+                trip['distance'] += Haversine(self.lastPosition[0], self.lastPosition[1], lat, lon)
+            self.lastPosition = (lat, lon)
+        if speed is not None and (trip['maxSpeed'] is None or speed > trip['maxSpeed']):
+            trip['maxSpeed'] = speed
+        self.maybeFlush(t)
+
+    def addCanIds(self, t, canIds):
+        """
+        Add the CAN IDs seen
+        @param t: timestamp (seconds since epoch or session time)
+        @param canIds: iterable of CAN IDs
+        @return: Nothing
+        """
+        trip = self.currentTrip(t)
+        new = set(canIds) - self.canIds
+        if new:
+            self.canIds.update(new)
+            trip['canIds'] = sorted(self.canIds)
+        self.maybeFlush(t)
+
+    def addFileOffset(self, fileName, offset, t):
+        """
+        Note the byte offset written to a file at a time
+        @param fileName: data file, stored by basename to match the archive members
+        @param offset: byte offset in the file, e.g. f.tell() after the write
+        @param t: timestamp (seconds since epoch or session time)
+        @return: Nothing
+        """
+        trip = self.currentTrip(t)
+        name = os.path.basename(fileName)
+        entry = trip['files'].get(name)
+        if entry is None:
+            trip['files'][name] = {'first':offset, 'last':offset, 'start':t, 'end':t}
+        else:
+            entry['last'] = offset
+            entry['end'] = t
+        self.maybeFlush(t)
+
+    def renameFile(self, fileName, newFileName):
+        """
+        Move the entries of a file to its new name, e.g. after the log of the last start was rotated
+        @param fileName: old name of the data file
+        @param newFileName: new name of the data file
+        @return: Nothing
+        """
+        name = os.path.basename(fileName)
+        newName = os.path.basename(newFileName)
+        for trip in self.trips:
+            entry = trip['files'].pop(name, None)
+            if entry is not None:
+                trip['files'][newName] = entry
+                self.dirty = True
+        self.flush()
+
+    def maybeFlush(self, t):
+        if self.lastFlush is None or t - self.lastFlush >= self.flushInterval:
+            self.lastFlush = t
+            self.flush()
+
+    def flush(self):
+        """
+        Write the index atomically
+        @return: Nothing
+        """
+        if not self.dirty:
+            return
+        if self.clock is not None and self.clock.offset is not None:
+            for trip in self.sessionTrips: # the reference may have come after the start
+                trip['offset'] = self.clock.offset
+        tmpFileName = self.indexFileName + '.tmp'
+        with open(tmpFileName, 'w') as f:
+            json.dump(self.trips, f)
+        os.replace(tmpFileName, self.indexFileName)
+        self.dirty = False
+
+    def close(self):
+        self.flush()
+
+
+def LoadTripIndex(indexFileName):
+    """
+    Load the trips of an index file
+    @param indexFileName: json file of the index
+    @return: list of trip dictionaries, empty if there is no index
+    """
+    try:
+        with open(indexFileName) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return []
+
+
+def FindTrips(dataDir, start=None, end=None, bbox=None, canId=None):
+    """
+    Query the trip indexes of a data directory
+    @param dataDir: directory holding the *.tripindex.json files
+    @param start, end: time window (seconds since epoch), trips overlapping it match
+    @param bbox: [minLat, minLon, maxLat, maxLon], trips whose bounding box intersects it match
+    @param canId: CAN ID that must have been seen in the trip
+    @return: list of (index name, trip dictionary) sorted by trip start, trips with session times are
+             returned with wall clock times, the ones without a wall clock reference only if there is
+             no time window
+    """
+    result = []
+    for indexFileName in glob.glob(os.path.join(dataDir, '*' + INDEX_SUFFIX)):
+        name = os.path.basename(indexFileName)[:-len(INDEX_SUFFIX)]
+        for trip in LoadTripIndex(indexFileName):
+            wallTrip = WallTimes(trip)
+            if wallTrip is None:
+                if start is not None or end is not None:
+                    continue
+            else:
+                trip = wallTrip
+            if start is not None and trip['end'] < start:
+                continue
+            if end is not None and trip['start'] > end:
+                continue
+            if bbox is not None:
+                tb = trip['bbox']
+                if tb is None or tb[0] > bbox[2] or tb[2] < bbox[0] or tb[1] > bbox[3] or tb[3] < bbox[1]:
+                    continue
+            if canId is not None and canId not in trip['canIds']:
+                continue
+            result.append((name, trip))
+    result.sort(key=lambda r: r[1]['start'])
+    return result
+
+
+if __name__ == '__main__':
+
+    import time
+    from optparse import OptionParser
+
+    parser = OptionParser('usage: %prog [options] [datadir]')
+    parser.add_option('-s', action='store', type='string', dest='start', metavar='YYYY-MM-DD HH:MM',
+                      help='only trips ending after this local time', default=None)
+    parser.add_option('-e', action='store', type='string', dest='end', metavar='YYYY-MM-DD HH:MM',
+                      help='only trips starting before this local time', default=None)
+    parser.add_option('-c', action='store', type='string', dest='canid', metavar='ID',
+                      help='only trips with this CAN ID (hex)', default=None)
+    (options, args) = parser.parse_args()
+    dataDir = args[0] if args else os.path.join(os.curdir, 'DataLogs')
+
+    def parseTime(s):
+        return time.mktime(time.strptime(s, '%Y-%m-%d %H:%M')) if s else None
+
+    canId = int(options.canid, 16) if options.canid else None
+    for name, trip in FindTrips(dataDir, start=parseTime(options.start), end=parseTime(options.end), canId=canId):
+        print('{0} trip {1}: {2} - {3}, {4:.1f} km, max speed {5}, bbox {6}'.format(name, trip['id'],
+              time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(trip['start'])),
+              time.strftime('%H:%M:%S', time.localtime(trip['end'])),
+              trip['distance'] / 1000.0, trip['maxSpeed'], trip['bbox']))
+        for fileName in sorted(trip['files']):
+            entry = trip['files'][fileName]
+            print('    {0} bytes {1}-{2}'.format(fileName, entry['first'], entry['last']))
@@ -0,0 +1,440 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: txscheduler.py
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see http://www.gnu.org/licenses.
+#
+# Description
+#     Cyclic transmit of any number of messages. The tinyCAN has only a
+#     few interval buffers ('Anzahl Interval Puffer'), they are given to
+#     the messages with the shortest intervals. All others are sent by a
+#     thread with a timer wheel of 1 ms ticks: the deadlines stay on the
+#     tick grid (no drift), the thread sleeps until shortly before the
+#     next occupied tick and waits the rest actively. All messages due in
+#     the same tick go out in one CanTransmit call.
+#     update() changes the payload in place, the interval keeps running
+#     in both cases. The lateness of every software sent frame against
+#     its deadline is kept per message (mean, stdev, max) and exported as
+#     histogram carpc_tx_jitter_seconds.
+#
+# Usage
+#     >>> scheduler = txscheduler.IntervalScheduler(canDriver)
+#     >>> scheduler.start()
+#     >>> scheduler.add(0x18FF00DA, [1, 2, 3], interval=100)   # milliseconds
+#     >>> scheduler.update(0x18FF00DA, [4, 5, 6])
+#     >>> print(scheduler)
+#     >>> scheduler.stop()
+#
+#     python txscheduler.py [-d LIB] [-b KBIT] [-n COUNT] [-i MS]
+#
+# ----------------------------------------------------------------------
+
+import math
+import time
+import threading
+import uselogging
+import metrics
+from mhsTinyCanDriver import TCanMsg
+
+WHEEL_TICK = 0.001 # seconds
+WHEEL_SIZE = 1024 # ticks per revolution
+SPIN_TIME = 0.0002 # seconds waited actively before a deadline
+JITTER_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+
+class JitterStats:
+    """
+    Mean, standard deviation and maximum of the lateness (Welford)
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.max = 0.0
+
+    def add(self, lateness):
+        self.count += 1
+        delta = lateness - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (lateness - self.mean)
+        if lateness > self.max:
+            self.max = lateness
+
+    def stdev(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else 0.0
+
+    def __str__(self):
+        return '{0} sent, jitter mean {1:.1f}us, stdev {2:.1f}us, max {3:.1f}us'.format(
+            self.count, self.mean * 1e6, self.stdev() * 1e6, self.max * 1e6)
+
+
+class CyclicMessage:
+    """
+    One cyclic message, sent by an interval buffer (slot) or by the timer wheel
+    """
+    def __init__(self, msgId, msgData, interval, rtr=None):
+        """
+        Class Constructor
+        @param msgId: CAN ID of the Message
+        @param msgData: Data of the Message, list of integers
+        @param interval: Interval in milliseconds
+        @param rtr: Remote Transmission Request
+        @return: nothing
+        """
+        self.msgId = msgId
+        self.interval = interval
+        self.rtr = rtr
+        self.msg = TCanMsg()
+        self.msg.Id = msgId
+        self.msg.Flags.FlagBits.TxD = 1
+        if rtr:
+            self.msg.Flags.FlagBits.RTR = 1
+        if msgId > 0x7FF:
+            self.msg.Flags.FlagBits.EFF = 1
+        self.setData(msgData)
+        self.slot = None # TIndex of the interval buffer, None if sent by the timer wheel
+        self.tick = None # tick of the next deadline
+        self.ticks = 1 # interval in ticks
+        self.active = True
+        self.missed = 0 # cycles skipped because the thread was late by more than an interval or the transmit FIFO was full
+        self.stats = JitterStats()
+
+    def setData(self, msgData):
+        if len(msgData) > 8:
+            raise ValueError('Messages with more then 8 Bytes are not supported')
+        self.data = list(msgData)
+        self.msg.Data[:len(msgData)] = self.data
+        self.msg.Flags.FlagBits.DLC = len(msgData)
+
+    def __str__(self):
+        mode = 'hardware slot {0}'.format(self.slot.IndexBits.SubIndex) if self.slot is not None else str(self.stats)
+        return 'ID:{0:08x} every {1}ms, {2}'.format(self.msgId, self.interval, mode)
+
+
+class IntervalScheduler(threading.Thread):
+    """
+    Interval buffers for the fastest messages, timer wheel for the rest
+    """
+    def __init__(self, canDriver, hardwareSlots=None, tick=WHEEL_TICK, wheelSize=WHEEL_SIZE, spin=SPIN_TIME, index=None):
+        """
+        Class Constructor
+        @param canDriver: opened MhsTinyCanDriver
+        @param hardwareSlots: number of interval buffers to use, all free ones if None, 0 for software only
+        @param tick: resolution of the timer wheel in seconds
+        @param wheelSize: ticks per revolution of the wheel
+        @param spin: seconds waited actively before a deadline, 0 to only sleep
+        @param index: TIndex of the transmit FIFO, the Index of the driver if None
+        @return: nothing
+        """
+        threading.Thread.__init__(self, name='IntervalScheduler')
+        self.daemon = True
+        self.logger = uselogging.getLogger()
+        self.canDriver = canDriver
+        if hardwareSlots is None:
+            hardwareSlots = canDriver.TCDeviceProperties.get('Anzahl Interval Puffer', 0) - len(canDriver.UsedTxSlots)
+        self.hardwareSlots = max(0, hardwareSlots)
+        self.tickTime = tick
+        self.wheelSize = wheelSize
+        self.spin = spin
+        self.index = index if index is not None else canDriver.Index
+        self.messages = {} # msgId: CyclicMessage
+        self.wheel = [[] for _ in range(wheelSize)]
+        self.lock = threading.Lock() # message table and wheel, held only briefly
+        self.rebalanceLock = threading.Lock() # one rebalance at a time, held during the driver calls
+        self.wakeup = threading.Event()
+        self.running = False
+        self.origin = time.monotonic()
+        self.batch = (TCanMsg * 16)()
+        self.sendErrors = 0
+        self.jitter = metrics.Histogram('carpc_tx_jitter_seconds', 'Lateness of the software sent cyclic frames', JITTER_BUCKETS)
+        self.framesSent = metrics.Counter('carpc_tx_cyclic_frames_total', 'Cyclic frames sent by the timer wheel')
+        metrics.Gauge('carpc_tx_cyclic_hardware', 'Cyclic messages in interval buffers',
+                      function=lambda: sum(1 for m in list(self.messages.values()) if m.slot is not None))
+        metrics.Gauge('carpc_tx_cyclic_software', 'Cyclic messages on the timer wheel',
+                      function=lambda: sum(1 for m in list(self.messages.values()) if m.slot is None))
+
+    def currentTick(self):
+        return int((time.monotonic() - self.origin) / self.tickTime)
+
+    # ----------------------------------------------------------------
+    # ---- Message Table ---------------------------------------------
+    # ----------------------------------------------------------------
+
+    def add(self, msgId, msgData, interval, rtr=None):
+        """
+        Send a message cyclically, replaces a message with the same ID
+        @param msgId: CAN ID of the Message
+        @param msgData: Data of the Message, list of integers
+        @param interval: Interval in milliseconds
+        @param rtr: Remote Transmission Request
+        @return: CyclicMessage
+        """
+        if msgId in self.messages:
+            self.remove(msgId)
+        message = CyclicMessage(msgId, msgData, interval, rtr)
+        message.ticks = max(1, int(round(interval / 1000.0 / self.tickTime)))
+        with self.lock:
+            self.messages[msgId] = message
+        self.rebalance()
+        if message.slot is None:
+            self.logger.info('Cyclic message {0:08x} every {1}ms on the timer wheel'.format(msgId, interval))
+        return message
+
+    def update(self, msgId, msgData):
+        """
+        Change the payload of a cyclic message, the interval is not restarted
+        @param msgId: CAN ID of the Message
+        @param msgData: Data of the Message, list of integers
+        @return: Error Code (0 = No Error)
+        """
+        message = self.messages[msgId]
+        with self.lock:
+            message.setData(msgData)
+            slot = message.slot
+        if slot is not None:
+            return self.canDriver.UpdateIntervalMessage(slot, msgId, message.data, rtr=message.rtr)
+        return 0
+
+    def remove(self, msgId):
+        """
+        Stop a cyclic message
+        @param msgId: CAN ID of the Message
+        @return: Nothing
+        """
+        with self.lock:
+            message = self.messages.pop(msgId)
+            message.active = False
+            message.tick = None
+        if message.slot is not None:
+            self.canDriver.ClearIntervalMessage(message.slot)
+            message.slot = None
+        self.rebalance()
+
+    def rebalance(self):
+        """
+        Give the interval buffers to the messages with the shortest intervals. The driver calls
+        (blocking USB transfers) are made without holding self.lock, the timer wheel keeps running.
+        @return: Nothing
+        """
+        with self.rebalanceLock:
+            with self.lock:
+                fastest = sorted(self.messages.values(), key=lambda m: m.interval)[:self.hardwareSlots]
+                demote = [m for m in self.messages.values() if m.slot is not None and m not in fastest]
+                promote = [m for m in fastest if m.slot is None]
+            for message in demote:
+                self.canDriver.ClearIntervalMessage(message.slot)
+                with self.lock:
+                    message.slot = None
+                    if message.active:
+                        self.schedule(message, self.currentTick() + 1)
+                self.wakeup.set() # the thread may wait for a later tick
+            for message in promote:
+                data = message.data
+                try:
+                    err, slot = self.canDriver.SetInvervalMessage(message.msgId, data, message.interval, rtr=message.rtr)
+                except IndexError:
+                    err = -1
+                with self.lock:
+                    if err >= 0 and message.active:
+                        message.slot = slot
+                        message.tick = None
+                        changed = message.data != data
+                    elif err < 0 and message.tick is None and message.active:
+                        self.logger.warning('No interval buffer for {0:08x}, using the timer wheel'.format(message.msgId))
+                        self.schedule(message, self.currentTick() + 1)
+                        self.wakeup.set()
+                if err >= 0 and not message.active:
+                    self.canDriver.ClearIntervalMessage(slot) # removed meanwhile
+                elif err >= 0 and changed:
+                    self.canDriver.UpdateIntervalMessage(slot, message.msgId, message.data, rtr=message.rtr)
+            with self.lock:
+                for message in self.messages.values():
+                    if message.slot is None and message.tick is None:
+                        self.schedule(message, self.currentTick() + 1)
+        self.wakeup.set()
+
+    def schedule(self, message, tick):
+        message.tick = tick
+        self.wheel[tick % self.wheelSize].append(message)
+
+    # ----------------------------------------------------------------
+    # ---- Timer Wheel -----------------------------------------------
+    # ----------------------------------------------------------------
+
+    def nextTick(self, tick):
+        """
+        First occupied tick from tick on, within one revolution
+        @return: tick, None if the wheel is empty
+        """
+        wheel = self.wheel
+        size = self.wheelSize
+        for t in range(tick, tick + size):
+            bucket = wheel[t % size]
+            if bucket and any(m.tick == t for m in bucket):
+                return t
+        return tick + size if any(m.slot is None for m in self.messages.values()) else None
+
+    def expire(self, tick):
+        """
+        Take the messages due at tick from the wheel and put them on their next tick
+        @return: list of CyclicMessages due
+        """
+        size = self.wheelSize
+        bucket = self.wheel[tick % size]
+        due = []
+        keep = []
+        for message in bucket:
+            if not message.active or message.slot is not None or message.tick is None:
+                continue
+            if message.tick == tick:
+                due.append(message)
+            elif message.tick > tick and message.tick % size == tick % size and message not in keep:
+                keep.append(message)
+        self.wheel[tick % size] = keep
+        now = self.currentTick()
+        for message in due:
+            nextTick = tick + message.ticks
+            if nextTick <= now:
+                skipped = (now - nextTick) // message.ticks + 1
+                message.missed += skipped
+                nextTick += skipped * message.ticks
+            self.schedule(message, nextTick)
+        return due
+
+    def waitUntil(self, deadline):
+        """
+        Sleep until shortly before the deadline, then wait actively
+        @return: False if woken up by a change of the message table or stop()
+        """
+        timeout = deadline - time.monotonic() - self.spin
+        if timeout > 0 and self.wakeup.wait(timeout):
+            return False
+        while time.monotonic() < deadline:
+            pass
+        return True
+
+    def transmit(self, due, deadline):
+        """
+        Send the due messages in one call and record the lateness of those sent
+        @return: Nothing
+        """
+        count = len(due)
+        if count > len(self.batch):
+            self.batch = (TCanMsg * count)()
+        batch = self.batch
+        with self.lock:
+            for i, message in enumerate(due):
+                batch[i] = message.msg
+        lateness = time.monotonic() - deadline
+        sent = self.canDriver._CanTransmitMsgs(self.index, batch, count)
+        if sent < 0:
+            self.sendErrors += 1
+            sent = 0
+        # the transmit FIFO took the first sent messages, the others miss this cycle
+        for message in due[:sent]:
+            message.stats.add(lateness)
+            self.jitter.observe(lateness)
+        for message in due[sent:]:
+            message.missed += 1
+        self.framesSent.inc(sent)
+
+    def run(self):
+        self.running = True
+        position = self.currentTick() # first tick not processed yet
+        while self.running:
+            self.wakeup.clear()
+            with self.lock:
+                tick = self.nextTick(position)
+            if tick is None:
+                self.wakeup.wait()
+                position = self.currentTick()
+                continue
+            deadline = self.origin + tick * self.tickTime
+            if not self.waitUntil(deadline):
+                continue # the message table changed, look again from position
+            with self.lock:
+                due = self.expire(tick)
+            if due:
+                self.transmit(due, deadline)
+            position = tick + 1
+
+    def stop(self):
+        """
+        Stop the thread and free the interval buffers
+        @return: Nothing
+        """
+        self.running = False
+        self.wakeup.set()
+        if self.is_alive():
+            self.join(1.0)
+        for msgId in list(self.messages):
+            message = self.messages.pop(msgId)
+            message.active = False
+            if message.slot is not None:
+                self.canDriver.ClearIntervalMessage(message.slot)
+                message.slot = None
+
+    def statistics(self):
+        """
+        @return: dictionary of ID: dictionary with interval, slot, sent, jitter mean/stdev/max in seconds, missed cycles
+        """
+        return dict((m.msgId, {'interval':m.interval,
+                               'slot':m.slot.IndexBits.SubIndex if m.slot is not None else None,
+                               'sent':m.stats.count,
+                               'mean':m.stats.mean,
+                               'stdev':m.stats.stdev(),
+                               'max':m.stats.max,
+                               'missed':m.missed}) for m in self.messages.values())
+
+    def __str__(self):
+        lines = ['Cyclic messages: {0}, transmit errors: {1}'.format(len(self.messages), self.sendErrors)]
+        lines.extend(str(m) for m in sorted(self.messages.values(), key=lambda m: m.interval))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+    import mhsTinyCanDriver
+
+    parser = OptionParser('usage: %prog [options]')
+    parser.add_option('-d', action='store', type='string', dest='dll', metavar='LIB',
+                      help='path of the tinyCAN library', default=None)
+    parser.add_option('-b', action='store', type='int', dest='bitrate', metavar='KBIT',
+                      help='can bitrate in kBit/s, default = 250', default=250)
+    parser.add_option('-n', action='store', type='int', dest='count', metavar='COUNT',
+                      help='number of cyclic messages, default = 20', default=20)
+    parser.add_option('-i', action='store', type='int', dest='interval', metavar='MS',
+                      help='interval of the first message, each further one 10ms longer, default = 10', default=10)
+    parser.add_option('-s', action='store_true', dest='software',
+                      help='timer wheel only, no interval buffers', default=False)
+    (options, args) = parser.parse_args()
+
+    canDriver = mhsTinyCanDriver.MhsTinyCanDriver(options.dll, options={'AutoConnect':1, 'CanSpeed1':options.bitrate})
+    scheduler = IntervalScheduler(canDriver, hardwareSlots=0 if options.software else None)
+    scheduler.start()
+    for i in range(options.count):
+        scheduler.add(0x18FF00DA + (i << 8), [i & 0xFF, 0, 0, 0], options.interval + 10 * i)
+    counter = 0
+    try:
+        while True:
+            time.sleep(1)
+            counter += 1
+            scheduler.update(0x18FF00DA, [0, counter & 0xFF, 0, 0])
+            print(scheduler)
+    except KeyboardInterrupt:
+        pass
+    scheduler.stop()
+    canDriver.shutdown()
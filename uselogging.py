@@ -64,6 +64,9 @@
 #     >>> logfile = '/home/xxx/log/logfile.log'
 #     >>> uselogging.enableFileLogging(logfile, level=logging.DEBUG)
 #
+#     Compress the old files with another codec (see compression.py)
+#     >>> uselogging.enableFileLogging(logfile, codec='lzma:1')
+#
 #     Enable only application messages (no errors and so one)
 #     >>> logfile = '/home/user/application/log/logfile.log'
 #     >>> uselogging.enableFileLogging(logfile, level=logging.APPLIC)
@@ -73,7 +76,8 @@
 import os
 import glob
 import time
-import zipfile
+import codecs
+import compression
 
 try:
     import logging
@@ -127,6 +131,8 @@ if loggingAvailable:
     # TODO: this code is not portable from python 2.5 to python m.n!
     class TimedCompressedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
 
+        codec = None # compression.Codec, deflate into a zip if None
+
         def doRollover(self):
             # the follwoing code is an 1:1 copy from /usr/lib/python/2.5/loging/handlers.py...
             self.stream.close()
@@ -150,12 +156,11 @@ if loggingAvailable:
                 self.stream = open(self.baseFilename, 'w')
             self.rolloverAt = self.rolloverAt + self.interval
             # ...copy of code ends here
-            # create the zip file
-            if os.path.exists(dfn + ".zip"):
-                os.remove(dfn + ".zip")
-            file = zipfile.ZipFile(dfn + ".zip", "w")
-            file.write(dfn, os.path.basename(dfn), zipfile.ZIP_DEFLATED)
-            file.close()
+            # create the archive
+            codec = self.codec or compression.GetCodec()
+            if os.path.exists(dfn + codec.suffix):
+                os.remove(dfn + codec.suffix)
+            compression.WriteArchive(codec, dfn + codec.suffix, os.path.basename(dfn), compression.FileChunks(dfn))
             os.remove(dfn)
 
 
@@ -181,11 +186,12 @@ if loggingAvailable:
 
 
     #enable rotating file logger
-    def enableFileLogging(fileNamePath=defaultLogFileName, level=logging.DEBUG, format=fileLogFormat, compressOld=True):
+    def enableFileLogging(fileNamePath=defaultLogFileName, level=logging.DEBUG, format=fileLogFormat, compressOld=True, codec=None):
         if not format: format = fileLogFormat
         logging.getLogger().setLevel(logging.DEBUG)
         if compressOld:
             rotatingFileLogger = TimedCompressedRotatingFileHandler(fileNamePath, when='midnight', interval=1, backupCount=defaultHistoryLogFiles)
+            if codec: rotatingFileLogger.codec = compression.GetCodec(codec)
         else:
             rotatingFileLogger = handlers.TimedRotatingFileHandler(fileNamePath, when='midnight', interval=1, backupCount=defaultHistoryLogFiles)
         rotatingFileLogger.setFormatter(logging.Formatter(format, datefmt=dateFormat)) 
@@ -194,12 +200,13 @@ if loggingAvailable:
 
 
     # enable lowlevel rotating file logger
-    def enableLowlevelFileLogging(fileNamePath=defaultLowlevelLogFileName, level=LOWLEVEL, format=defaultLowlevelFileLogFormat, compressOld=True):
+    def enableLowlevelFileLogging(fileNamePath=defaultLowlevelLogFileName, level=LOWLEVEL, format=defaultLowlevelFileLogFormat, compressOld=True, codec=None):
         if not format: format = fileLogFormat
         logging.getLogger().setLevel(level)
         if compressOld:
             rotatingFileLogger = TimedCompressedRotatingFileHandler(fileNamePath, when='M', \
                                                                     interval=defaultLowlevelRotatingInterval, backupCount=defaultLowlevelHistoryFiles)
+            if codec: rotatingFileLogger.codec = compression.GetCodec(codec)
         else:
             rotatingFileLogger = handlers.TimedRotatingFileHandler(fileNamePath, when='M',  \
                                                                    interval=defaultLowlevelRotatingInterval, backupCount=defaultLowlevelHistoryFiles)
@@ -21,9 +21,23 @@
 # Description
 #     Some more or less stupid simple functions to cope with option handling
 #     of the Tiny CAN Driver, extends mhsTinyCanDriver.py somehow
+#     CompiledOptions is the option dictionary of a driver instance: values
+#     are checked against their type when set, the option strings of the
+#     init stages (CanInitDriver, CanDeviceOpen, CanSetOptions) are built
+#     once and only again after an option of the stage changed, so a
+#     reopen after a reconnect sends the cached strings.
+#     ParseOptionString parses the driver/hardware info strings once.
+#
+# Usage
+#     >>> options = utils.CompiledOptions(TCAN_Options, TCAN_Types, TCAN_Stages, logger)
+#     >>> options.update({'CanSpeed1':500})      # ValueError for invalid values
+#     >>> options.compile('CanSetOptions')       # b'CanSpeed1=500', cached
 #
 # ---------------------------------------------------------------------- 
 
+import re
+import logging
+
 def OptionDict2CsvString(OptionDict = {},Keys = []):
     """
     Turn a Dictionary of Key:Value Tupples into a csv like string
@@ -57,13 +71,22 @@ def UpdateOptionDict(OptionDict, Option2UpdateDict,logger):
     OptionDict.update(Option2UpdateDict)
     return
 
+INT_PATTERN = re.compile(r'[+-]?[0-9]+\Z')
+HEX_PATTERN = re.compile(r'[+-]?0[xX][0-9a-fA-F]+\Z')
+FLOAT_PATTERN = re.compile(r'[+-]?([0-9]+\.[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?\Z')
+
 def String2Type(StrUKnwTp):
-    if ('.' in StrUKnwTp) and (len(StrUKnwTp.split('.'))==2):#isfloat
+    """
+    Value of an option string
+    @param StrUKnwTp: String, e.g. '-5', '0x1F', '2.5' or 'Tiny-CAN'
+    @return: int for decimal or hex (0x/0X, any case) integers with sign, float for decimals, else the String
+    """
+    if INT_PATTERN.match(StrUKnwTp):#isinteger
+        return int(StrUKnwTp)
+    elif HEX_PATTERN.match(StrUKnwTp):#ishexadecimal
+        return int(StrUKnwTp,16)
+    elif FLOAT_PATTERN.match(StrUKnwTp):#isfloat
         return float(StrUKnwTp)
-    elif StrUKnwTp.isnumeric() or StrUKnwTp.isdecimal() or StrUKnwTp.isdigit():#isinteger
-        return int(StrUKnwTp)                     
-    elif StrUKnwTp.isalnum() and (StrUKnwTp.startswith('0x') or StrUKnwTp.startswith('0X')):#ishexadecimal
-        return int(StrUKnwTp[2:],16)
     else:
         return StrUKnwTp#isstring    
 
@@ -78,11 +101,115 @@ def CsvString2OptionDict(CsvString = b''):
     keyValuePairs = CsvString.decode().split(';')
     for kvp in keyValuePairs:
         if kvp:
-            key,value = kvp.split('=')
+            key,value = kvp.split('=',1)
             if ',' in value:
                 uvalues = [String2Type(val.strip()) for val in value.split(',')]
             else:
                 uvalues = String2Type(value)
             OptionDict.update({key:uvalues})
     return OptionDict
-        
\ No newline at end of file
+        
+
+
+ParsedOptionStrings = {}
+
+def ParseOptionString(CsvString):
+    """
+    CsvString2OptionDict with the result kept per string, e.g. for CanDrvInfo and CanDrvHwInfo
+    @param CsvString: String by format Key1=Value1;Key2=Value2,... Python3 bytestring!!
+    @return: OptionDictionary, a copy of the parsed one
+    """
+    parsed = ParsedOptionStrings.get(CsvString)
+    if parsed is None:
+        parsed = ParsedOptionStrings[CsvString] = CsvString2OptionDict(CsvString)
+    return dict(parsed)
+
+
+def CheckOptionValue(key, value, valueType):
+    """
+    Value of an option in its type
+    @param valueType: int or str
+    @return: value converted to valueType, None stays None
+    @raise ValueError: if the value has not the type and can not be converted
+    """
+    if value is None or valueType is None:
+        return value
+    if valueType is int:
+        if isinstance(value, str):
+            value = String2Type(value.strip())
+        if isinstance(value, int):
+            return int(value) # bool to int
+    elif valueType is str:
+        if isinstance(value, (str, int)) and not isinstance(value, bool):
+            return str(value)
+    raise ValueError('Option {0} must be {1}, not {2!r}'.format(key, valueType.__name__, value))
+
+
+class CompiledOptions(dict):
+    """
+    Option Dictionary with typed values and cached option strings per init stage
+    """
+    def __init__(self, defaults, types, stages, logger=None):
+        """
+        Class Constructor
+        @param defaults: Option Dictionary of all known options, None for not set
+        @param types: dictionary of option: int or str
+        @param stages: dictionary of stage name: list of the options of the stage
+        @param logger: a logger object to log the Changes
+        @return: nothing
+        """
+        dict.__init__(self, defaults)
+        self.types = types
+        self.stages = stages
+        self.logger = logger
+        self.compiled = {}
+
+    def check(self, key, value):
+        """
+        @return: value of an option in its type
+        @raise ValueError: if the option is unknown or the value invalid
+        """
+        if key not in self.types:
+            raise ValueError('Unknown option {0}'.format(key))
+        return CheckOptionValue(key, value, self.types[key])
+
+    def __setitem__(self, key, value):
+        value = self.check(key, value)
+        old = self.get(key)
+        if old == value and key in self:
+            return
+        if self.logger and self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('Changed Option %s from %s to %s', key, old, value)
+        dict.__setitem__(self, key, value)
+        for stage, keys in self.stages.items():
+            if key in keys:
+                self.compiled.pop(stage, None)
+
+    def update(self, options=(), **kwargs):
+        """
+        Set several options, all are checked before the first one is set
+        @param options: Option Dictionary
+        @return: Nothing
+        @raise ValueError: if an option is unknown or a value invalid
+        """
+        options = dict(options, **kwargs)
+        checked = [(key, self.check(key, value)) for key, value in options.items()]
+        for key, value in checked:
+            self[key] = value
+
+    def setdefault(self, key, value=None):
+        if key not in self:
+            self[key] = value
+        return self[key]
+
+    def compile(self, stage):
+        """
+        Option string of a stage
+        @param stage: name of the stage, a key of stages
+        @return: String of format Key1=Value1;Key2=Value2,... see OptionDict2CsvString, cached until an option of the stage changes
+        """
+        try:
+            return self.compiled[stage]
+        except KeyError:
+            optionString = self.compiled[stage] = OptionDict2CsvString(OptionDict=self, Keys=self.stages[stage])
+            return optionString